@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""
+memory.py
+Reports the memory footprint of PyBal's per-server state: the number of
+bytes used per Server instance and per monitor instance, compared to an
+equivalent dict-based representation like the one PyBal used before
+Server and MonitoringProtocol declared __slots__.
+
+Usage: python benchmarks/memory.py [number of servers]
+"""
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pybal import util
+from pybal.pybal import Server
+from pybal.monitors.proxyfetch import ProxyFetchMonitoringProtocol
+
+
+class LVSServiceStub(object):
+    name = 'benchmark'
+    ip = '10.0.0.1'
+    port = 80
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+
+
+class Unslotted(object):
+    """Holds the attributes of an instance in a __dict__"""
+    pass
+
+
+def slotNames(cls):
+    """Returns the names of all slots declared in the MRO of cls"""
+
+    return [name for klass in cls.__mro__
+            for name in getattr(klass, '__slots__', ())
+            if name != '__weakref__']
+
+
+def unslotted(obj, private=()):
+    """
+    Returns a dict-based copy of obj. Attributes named in private get a
+    copy of their own, as they did before they were shared or interned.
+    """
+
+    copy = Unslotted()
+    for name in slotNames(type(obj)):
+        try:
+            value = getattr(obj, name)
+        except AttributeError:
+            continue
+        if name in private:
+            value = type(value)(''.join(value)) if isinstance(value, str) else set(value)
+        copy.__dict__[name] = value
+    return copy
+
+
+def footprint(objects):
+    """
+    Returns the average number of bytes per object, counting the object
+    itself, its instance dictionary and its attribute values. Values
+    shared between objects are only counted once.
+    """
+
+    seen = set()
+    total = 0
+    for obj in objects:
+        total += sys.getsizeof(obj)
+        values = [getattr(obj, name) for name in slotNames(type(obj))
+                  if hasattr(obj, name)]
+        if hasattr(obj, '__dict__'):
+            total += sys.getsizeof(obj.__dict__)
+            values.extend(obj.__dict__.values())
+        for value in values:
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total / float(len(objects))
+
+
+def main(count):
+    configuration = util.ConfigDict({
+        'proxyfetch.url': "['http://localhost/']",
+        'proxyfetch.interval': '10',
+    })
+    lvsservice = LVSServiceStub(configuration)
+
+    servers, monitors = [], []
+    for i in xrange(count):
+        # Build each host name at runtime, like the config parser does
+        server = Server('mw%d.eqiad.wmnet' % (i % 1000), lvsservice)
+        monitor = ProxyFetchMonitoringProtocol(None, server, configuration)
+        server.addMonitor(monitor)
+        servers.append(server)
+        monitors.append(monitor)
+
+    before = (
+        footprint([unslotted(s, private=('host', 'ip4_addresses', 'ip6_addresses'))
+                   for s in servers]),
+        footprint([unslotted(m) for m in monitors]))
+    after = (footprint(servers), footprint(monitors))
+
+    print "%d servers, one monitor each" % count
+    print "%-10s %12s %12s" % ('', 'dict-based', 'slotted')
+    for label, b, a in zip(('server', 'monitor'), before, after):
+        print "%-10s %12.0f %12.0f bytes" % (label, b, a)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+"""
+parse_config.py
+Measures the cost of re-reading pool files: parsing a legacy (eval) pool
+file with the fast parser and with ast.literal_eval alone, parsing the
+equivalent JSON file, and the content digest check that skips parsing of
+files that were touched but not changed.
+
+Usage: python benchmarks/parse_config.py [number of servers]
+"""
+
+import ast, hashlib, json, os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pybal.config import FileConfigurationObserver
+
+
+class CoordinatorStub(object):
+    def onConfigUpdate(self, config):
+        pass
+
+
+def timeit(func, *args):
+    """Returns the best wall clock time of a few runs of func(*args)"""
+
+    best = None
+    for i in range(5):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(args):
+    servers = int(args[0]) if args else 10000
+    legacy = '\n'.join(
+        "{ 'host': 'mw%d.eqiad.wmnet', 'weight': %d, 'enabled': %s }" % (
+            i, 10 + i % 20, i % 50 != 0)
+        for i in xrange(servers))
+    observer = FileConfigurationObserver(CoordinatorStub(), 'file:///dev/null')
+    fast = observer.parseLegacyConfig(legacy)
+    observer.parseLegacyLine = lambda line: None
+    assert observer.parseLegacyConfig(legacy) == fast
+    del observer.parseLegacyLine
+    document = json.dumps(fast)
+
+    results = [
+        ('legacy, fast parser', timeit(observer.parseLegacyConfig, legacy)),
+        ('legacy, literal_eval', timeit(
+            lambda raw: [ast.literal_eval(line) for line in raw.split('\n')],
+            legacy)),
+        ('json', timeit(observer.parseJsonConfig, document)),
+        ('sha1 digest only', timeit(hashlib.sha1, legacy)),
+    ]
+    print "%d servers, %d bytes" % (servers, len(legacy))
+    for name, elapsed in results:
+        print "%-22s %8.2f ms" % (name, elapsed * 1000)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+"""
+replay.py
+Measures the throughput of journaling, and of Coordinator and LVSService
+replaying a journal. Replays the given journal files, such as ones
+recorded in production with the journal-file option, or else a synthetic
+journal of a flapping pool.
+
+Usage: python benchmarks/replay.py [journal...]
+       python benchmarks/replay.py --servers 3000 --results 100000
+"""
+
+import os, random, shutil, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pybal.journal import Journal
+from pybal import replay
+
+
+def synthesize(path, servers, results):
+    """Writes a synthetic journal, and returns the number of records/s"""
+
+    Journal.configure(path, maxBytes=sys.maxint)
+    start = time.time()
+    Journal.record(Journal.SERVICE, ['bench', ['tcp', '10.0.0.1', 80, 'wrr'],
+                                     {'monitors': "['ProxyFetch']"}])
+    hosts = ['mw%d.eqiad.wmnet' % i for i in xrange(servers)]
+    Journal.record(Journal.CONFIG, ['bench', dict(
+        (host, {'enabled': True, 'weight': 10}) for host in hosts), [], {}])
+    # Servers flap one at a time: mostly up, sometimes down
+    rand = random.Random(0)
+    for i in xrange(results):
+        Journal.record(Journal.RESULT, ['bench', rand.choice(hosts), 'ProxyFetch',
+                                        rand.random() > 0.2, 'timeout'])
+    elapsed = time.time() - start
+    Journal.configure(None)
+    return (results + 2) / elapsed
+
+
+def main(args):
+    servers, results = 3000, 100000
+    if '--servers' in args:
+        servers = int(args[args.index('--servers') + 1])
+    if '--results' in args:
+        results = int(args[args.index('--results') + 1])
+    paths = [a for a in args if not a.startswith('--') and not a.isdigit()]
+
+    directory = None
+    if not paths:
+        directory = tempfile.mkdtemp()
+        paths = [os.path.join(directory, 'journal')]
+        rate = synthesize(paths[0], servers, results)
+        print "Journaled %d records at %.0f records/s, %d bytes" % (
+            results + 2, rate, os.path.getsize(paths[0]))
+
+    try:
+        replay.main(paths)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -9,30 +9,354 @@
 from __future__ import absolute_import
 
 import ast
+import hashlib
 import json
 import logging
 import os
 import re
+import time
 
-from twisted.internet import task
-from twisted.web import client
+from twisted.internet import reactor, task
+from twisted.python import failure, filepath
+from twisted.web import client, error
+from twisted.web.http_headers import Headers
 
-from pybal.util import get_subclasses, log
+from pybal.util import Backoff, ConfigDict, atomicWrite, get_subclasses, log
+from pybal.version import USER_AGENT_STRING
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
 
 
 class PyBalConfigurationError(Exception):
     pass
 
 
+class ConfigDiff(object):
+    """The difference between two server configurations.
+
+    `added` maps the hostnames of new servers to their configuration,
+    `removed` is the set of hostnames of servers that went away, and
+    `changed` maps the hostnames of existing servers to a dictionary
+    of only those fields that were added or changed.
+    """
+
+    def __init__(self, added=None, removed=None, changed=None):
+        self.added = added or {}
+        self.removed = removed or set()
+        self.changed = changed or {}
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __eq__(self, other):
+        return (isinstance(other, ConfigDiff) and
+                (self.added, self.removed, self.changed) ==
+                (other.added, other.removed, other.changed))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return "{} added, {} changed, {} removed".format(
+            len(self.added), len(self.changed), len(self.removed))
+
+    def record(self, host, old, new):
+        """Record the change of the configuration of one host from old to
+        new, either of which is None if the host is absent."""
+        if new is None:
+            if old is not None:
+                self.removed.add(host)
+        elif old is None:
+            self.added[host] = dict(new)
+        elif new != old:
+            fields = dict((key, value) for key, value in new.iteritems()
+                          if key not in old or old[key] != value)
+            if fields:
+                self.changed[host] = fields
+
+    def apply(self, config):
+        """Apply the difference to a server configuration, in place."""
+        for host, hostConfig in self.added.iteritems():
+            config[host] = hostConfig
+        for host, fields in self.changed.iteritems():
+            config[host] = dict(config.get(host, {}), **fields)
+        for host in self.removed:
+            config.pop(host, None)
+
+    @classmethod
+    def compute(cls, old, new):
+        """Compute the difference between two server configurations."""
+        old = old or {}
+        diff = cls()
+        for host, hostConfig in new.iteritems():
+            diff.record(host, old.get(host), hostConfig)
+        diff.removed = set(old) - set(new)
+        return diff
+
+    def merge(self, other):
+        """Merge a later difference into this one, in place, so that
+        applying the result equals applying both in turn."""
+        for host, hostConfig in other.added.iteritems():
+            if host in self.removed:
+                # Removed and added back: the server stays
+                self.removed.discard(host)
+                self.changed[host] = dict(hostConfig)
+            else:
+                self.changed.pop(host, None)
+                self.added[host] = dict(hostConfig)
+        for host, fields in other.changed.iteritems():
+            if host in self.added:
+                self.added[host] = dict(self.added[host], **fields)
+            else:
+                self.changed[host] = dict(self.changed.get(host, {}), **fields)
+        for host in other.removed:
+            if self.added.pop(host, None) is None:
+                self.changed.pop(host, None)
+                self.removed.add(host)
+
+
+class ConfigCache(object):
+    """Local cache of the last good configuration from a remote source.
+
+    Lets observers of remote configuration sources start with the servers
+    they last applied, while the source is unreachable. Every URL has its
+    own JSON file in the configured directory:
+
+        {
+          "url": "etcd://etcd.example.org/conftool/v1/pools/text",
+          "timestamp": 1500000000.0,
+          "index": 4242,
+          "config": { "mw1200": { "enabled": true, "weight": 10 } }
+        }
+
+    where index is the etcd index of the configuration, if any.
+
+    Sources that change often, such as etcd watches, save through
+    saveLater, which writes the latest configuration of each URL at most
+    every SAVE_INTERVAL seconds.
+    """
+
+    SAVE_INTERVAL = 5
+
+    directory = None    # None disables caching
+    pending = {}        # URL -> callable returning (config, index)
+    saveCall = None
+
+    @classmethod
+    def configure(cls, directory):
+        cls.directory = directory
+
+    @classmethod
+    def path(cls, configUrl):
+        return os.path.join(cls.directory,
+                            hashlib.sha1(configUrl).hexdigest() + '.json')
+
+    @classmethod
+    def save(cls, configUrl, config, index=None):
+        """Save the configuration last applied from a URL."""
+        if cls.directory is None:
+            return
+        try:
+            atomicWrite(cls.path(configUrl), json.dumps({
+                'url': configUrl, 'timestamp': time.time(),
+                'index': index, 'config': config}))
+        except (IOError, OSError) as e:
+            log.warn("Could not cache the configuration of {}: {}".format(
+                configUrl, e))
+
+    @classmethod
+    def saveLater(cls, configUrl, getState):
+        """Save the configuration of a URL within SAVE_INTERVAL seconds,
+        along with any changes until then. getState is called at that
+        time, and returns a tuple (config, index) to save."""
+        if cls.directory is None:
+            return
+        cls.pending[configUrl] = getState
+        if cls.saveCall is None:
+            cls.saveCall = reactor.callLater(cls.SAVE_INTERVAL, cls.savePending)
+
+    @classmethod
+    def savePending(cls):
+        """Save the configurations scheduled by saveLater."""
+        cls.saveCall = None
+        pending, cls.pending = cls.pending, {}
+        for configUrl, getState in pending.iteritems():
+            cls.save(configUrl, *getState())
+
+    @classmethod
+    def load(cls, configUrl):
+        """Return a tuple (config, index) of the cached configuration of
+        a URL, or (None, None) if there is none."""
+        if cls.directory is None:
+            return None, None
+        path = cls.path(configUrl)
+        try:
+            with open(path, 'rb') as f:
+                cached = json.load(f)
+            if cached['url'] != configUrl:
+                raise ValueError("cached for %s" % cached['url'])
+            config, index = cached['config'], cached['index']
+            if not isinstance(config, dict):
+                raise ValueError("not a server configuration")
+        except IOError:
+            return None, None
+        except (ValueError, KeyError, TypeError) as e:
+            log.warn("Ignoring invalid configuration cache {}: {}".format(path, e))
+            return None, None
+        log.info("Using the cached configuration of {} until it is reachable".format(
+            configUrl))
+        return config, index
+
+
+class FileWatcher(object):
+    """Shared inotify watcher of configuration files.
+
+    Watches the parent directories of all watched files rather than the
+    files themselves, so that files replaced by an atomic rename are
+    still noticed. Each directory is watched once, however many pools
+    have their file in it.
+    """
+
+    if inotify is not None:
+        MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE |
+                inotify.IN_MOVED_FROM | inotify.IN_DELETE | inotify.IN_ATTRIB)
+
+    notifier = None
+    observers = {}      # file path -> set of FileConfigurationObservers
+    directories = set()
+    events = 0
+
+    @classmethod
+    def watch(cls, observer):
+        """Notifies observer.onFileEvent() of changes to observer.filePath.
+        Returns False if the file can't be watched with inotify."""
+        if inotify is None:
+            return False
+
+        path = os.path.abspath(observer.filePath)
+        directory = os.path.dirname(path)
+        try:
+            if cls.notifier is None:
+                notifier = inotify.INotify()
+                notifier.startReading()
+                cls.notifier = notifier
+            if directory not in cls.directories:
+                cls.notifier.watch(filepath.FilePath(directory), mask=cls.MASK,
+                                   callbacks=[cls.onEvent])
+                cls.directories.add(directory)
+        except Exception as e:
+            log.warn("Can't watch {} with inotify, polling it instead: {}".format(
+                path, e))
+            return False
+
+        cls.observers.setdefault(path, set()).add(observer)
+        return True
+
+    @classmethod
+    def onEvent(cls, ignored, path, mask):
+        cls.events += 1
+        for observer in list(cls.observers.get(path.path, ())):
+            observer.onFileEvent()
+
+    @classmethod
+    def getStats(cls):
+        """Returns a dictionary of watcher counters"""
+        return {'files': len(cls.observers),
+                'directories': len(cls.directories),
+                'events': cls.events}
+
+
 class ConfigurationObserver(object):
+    """Base class of the observers of a configuration source.
+
+    Subclasses hand new configurations to notifyConfig and incremental
+    changes to notifyConfigDiff. With a config-debounce window, changes
+    arriving in quick succession are coalesced into a single update of
+    the coordinator, which is held back no longer than config-debounce-max
+    seconds after the first of them.
+    """
+
+    DEBOUNCE_MAX = 2
+
+    debounce = 0
+    debounceMax = DEBOUNCE_MAX
+    pendingConfig = None
+    pendingDiff = None
+    firstPending = None
+    flushCall = None
+
     @classmethod
-    def fromUrl(cls, coordinator, configUrl):
-        """Construct an instance of the appropriate subclass for a URL."""
+    def fromUrl(cls, coordinator, configUrl, configuration=None):
+        """Construct an instance of the appropriate subclass for a URL.
+
+        `configuration` is the ConfigDict of the service, for observers
+        that take options."""
         for subclass in get_subclasses(cls):
             if configUrl.startswith(subclass.urlScheme):
-                return subclass(coordinator, configUrl)
+                if configuration is None:
+                    return subclass(coordinator, configUrl)
+                observer = subclass(coordinator, configUrl, configuration=configuration)
+                observer.configureDebounce(configuration)
+                return observer
         raise PyBalConfigurationError('No handler for URL "%s"' % configUrl)
 
+    def configureDebounce(self, configuration):
+        """Read the debounce window from the service configuration."""
+        self.debounce = configuration.getfloat('config-debounce', 0)
+        self.debounceMax = max(self.debounce, configuration.getfloat(
+            'config-debounce-max', self.DEBOUNCE_MAX))
+
+    def notifyConfig(self, config):
+        """Hand a new server configuration to the coordinator, superseding
+        any pending changes."""
+        if not self.debounce:
+            self.coordinator.onConfigUpdate(config)
+            return
+        self.pendingConfig = dict(config)
+        self.pendingDiff = None
+        self.scheduleFlush()
+
+    def notifyConfigDiff(self, diff):
+        """Hand an incremental change of the server configuration to the
+        coordinator, merged with any pending changes."""
+        if not self.debounce:
+            self.coordinator.applyConfigDiff(diff)
+            return
+        if self.pendingConfig is not None:
+            diff.apply(self.pendingConfig)
+        elif self.pendingDiff is not None:
+            self.pendingDiff.merge(diff)
+        else:
+            self.pendingDiff = diff
+        self.scheduleFlush()
+
+    def scheduleFlush(self):
+        """(Re)schedule the update of the coordinator at the end of the
+        debounce window, capped at debounceMax after the first change."""
+        now = reactor.seconds()
+        if self.firstPending is None:
+            self.firstPending = now
+        delay = max(0, min(self.debounce, self.firstPending + self.debounceMax - now))
+        if self.flushCall is not None and self.flushCall.active():
+            self.flushCall.reset(delay)
+        else:
+            self.flushCall = reactor.callLater(delay, self.flush)
+
+    def flush(self):
+        """Hand the pending changes to the coordinator."""
+        if self.flushCall is not None and self.flushCall.active():
+            self.flushCall.cancel()
+        self.flushCall = self.firstPending = None
+        config, self.pendingConfig = self.pendingConfig, None
+        diff, self.pendingDiff = self.pendingDiff, None
+        if config is not None:
+            self.coordinator.onConfigUpdate(config)
+        elif diff:
+            self.coordinator.applyConfigDiff(diff)
+
 
 class FileConfigurationObserver(ConfigurationObserver):
     """ConfigurationObserver for local configuration files.
@@ -60,25 +384,44 @@ class FileConfigurationObserver(ConfigurationObserver):
         { 'host': 'pybal-test2002.codfw.wmnet', 'weight':10, 'enabled': True }
         { 'host': 'pybal-test2003.codfw.wmnet', 'weight':10, 'enabled': True }
 
+    Changes are picked up through the shared FileWatcher where inotify is
+    available, in which case the file is only stat()ed every
+    FALLBACK_INTERVAL seconds as a safety net, and otherwise by polling
+    every reloadIntervalSeconds.
     """
 
     urlScheme = 'file://'
 
-    def __init__(self, coordinator, configUrl, reloadIntervalSeconds=1):
+    FALLBACK_INTERVAL = 60
+
+    def __init__(self, coordinator, configUrl, reloadIntervalSeconds=1,
+                 configuration=None):
         self.coordinator = coordinator
         self.configUrl = configUrl
         self.filePath = configUrl[len(self.urlScheme):]
         self.reloadIntervalSeconds = reloadIntervalSeconds
         self.lastFileStat = None
+        self.lastDigest = None
         self.lastConfig = None
         self.reloadTask = task.LoopingCall(self.reloadConfig)
 
     def startObserving(self):
         """Start (or re-start) watching the configuration file for changes."""
+        interval = self.reloadIntervalSeconds
+        if FileWatcher.watch(self):
+            interval = max(interval, self.FALLBACK_INTERVAL)
         self.reloadTask \
-            .start(self.reloadIntervalSeconds) \
+            .start(interval) \
             .addErrback(self.logError)
 
+    def onFileEvent(self):
+        """Called by FileWatcher when the configuration file may have
+        changed."""
+        try:
+            self.reloadConfig()
+        except Exception:
+            log.err(failure.Failure(), "Could not reload %s" % self.filePath)
+
     def logError(self, failure):
         """Log an error and re-schedule the configuration file monitor."""
         failure.trap(Exception)
@@ -87,6 +430,33 @@ class FileConfigurationObserver(ConfigurationObserver):
         if not self.reloadTask.running:
             self.startObserving()
 
+    # The common legacy line shape, a flat dict literal of strings,
+    # integers and booleans: { 'host': 'mw1200', 'weight': 10, 'enabled': True }
+    legacyFieldPattern = r"""
+        \s* (['"]) ([^'"\\]*) \1 \s* : \s*
+        (?: (['"]) ([^'"\\]*) \3 | (-?[1-9][0-9]*|0) (?![\w.]) | (True|False) \b )
+        \s*"""
+    legacyLine = re.compile(r"\{ (?: %s (?: , | (?=\}) ) )* \s* \}$" % legacyFieldPattern,
+                            re.VERBOSE)
+    legacyField = re.compile(legacyFieldPattern, re.VERBOSE)
+
+    legacyFields = ('enabled', 'fwmethod', 'weight')
+
+    def parseLegacyLine(self, line):
+        """Parse a legacy configuration line of the common shape. Returns
+        None for anything else."""
+        if not self.legacyLine.match(line):
+            return None
+        server = {}
+        for kq, key, vq, string, integer, boolean in self.legacyField.findall(line):
+            if vq:
+                server[key] = string
+            elif integer:
+                server[key] = int(integer)
+            else:
+                server[key] = boolean == 'True'
+        return server
+
     def parseLegacyConfig(self, rawConfig):
         """Parse a legacy (eval) configuration file."""
         config = {}
@@ -95,22 +465,19 @@ class FileConfigurationObserver(ConfigurationObserver):
                 line = line.strip()
                 if not line or line.startswith('#'):
                     continue
-                server = ast.literal_eval(line)
+                server = self.parseLegacyLine(line)
+                if server is None:
+                    server = ast.literal_eval(line)
                 host = server.pop('host')
-            except (KeyError, SyntaxError, TypeError, ValueError) as ex:
+            except (AttributeError, KeyError, SyntaxError, TypeError, ValueError) as ex:
                 # We catch exceptions here (rather than simply allow them to
                 # bubble up to FileConfigurationObserver.logError) because we
                 # want to try and parse as much of the file as we can.
                 log.err(ex, 'Bad configuration line: %s' % line)
                 continue
             else:
-                config[host] = {}
-                try: config[host]['enabled'] = server['enabled']
-                except: pass
-                try: config[host]['fwmethod']= server['fwmethod']
-                except: pass
-                try: config[host]['weight']  = server['weight']
-                except: pass
+                config[host] = dict((key, server[key]) for key in self.legacyFields
+                                    if key in server)
         return config
 
     def parseJsonConfig(self, rawConfig):
@@ -132,24 +499,229 @@ class FileConfigurationObserver(ConfigurationObserver):
         self.lastFileStat = fileStat
         with open(self.filePath, 'rt') as f:
             rawConfig = f.read()
+        # Touched, or rewritten with the same contents
+        digest = hashlib.sha1(rawConfig).digest()
+        if digest == self.lastDigest:
+            return
+        self.lastDigest = digest
         config = self.parseConfig(rawConfig)
         if config != self.lastConfig:
+            self.notifyConfig(config)
+            self.lastConfig = config
+
+
+class PoolDocument(object):
+    """A JSON document with the server configuration of many pools:
+
+        {
+          "text": {
+            "mw1200.eqiad.wmnet": { "enabled": true, "weight": 10 }
+          },
+          "upload": {
+            "cp1050.eqiad.wmnet": { "enabled": true, "weight": 10 }
+          }
+        }
+
+    The document is watched and parsed once for all pools in it, and
+    the pools whose section changed are all notified from the same
+    reactor turn, so that no pool sees a newer version of the document
+    than another. For the same reason, changes are debounced once for
+    the whole document, over the longest window of its pools, rather
+    than by each pool.
+    """
+
+    documents = {}  # path -> PoolDocument
+
+    @classmethod
+    def get(cls, path):
+        """Returns the shared PoolDocument of a path."""
+        document = cls.documents.get(path)
+        if document is None:
+            document = cls.documents[path] = cls(path)
+        return document
+
+    def __init__(self, path):
+        self.path = path
+        self.observers = []
+        self.config = None
+        self.fileObserver = FileConfigurationObserver(self, 'file://' + path)
+        self.fileObserver.parseConfig = self.fileObserver.parseJsonConfig
+
+    def addObserver(self, observer):
+        """Starts notifying a MultiPoolConfigurationObserver of changes
+        to its pool, starting with the current configuration."""
+        self.observers.append(observer)
+        fileObserver = self.fileObserver
+        fileObserver.debounce = max(fileObserver.debounce, observer.debounce)
+        fileObserver.debounceMax = max(fileObserver.debounceMax, observer.debounceMax)
+        if fileObserver.reloadTask.running:
+            if self.config is not None:
+                observer.onDocumentUpdate(self.config)
+        else:
+            fileObserver.startObserving()
+
+    def onConfigUpdate(self, config):
+        self.config = config
+        for observer in self.observers:
+            observer.onDocumentUpdate(config)
+
+
+class MultiPoolConfigurationObserver(ConfigurationObserver):
+    """ConfigurationObserver for one pool of a PoolDocument.
+
+    Handles the 'pools://' scheme.
+    For example: 'pools:///etc/pybal/pools.json#text'. Without a
+    fragment, the section named after the service is used.
+    """
+
+    urlScheme = 'pools://'
+
+    def __init__(self, coordinator, configUrl, configuration=None):
+        self.coordinator = coordinator
+        self.configUrl = configUrl
+        path, _, pool = configUrl[len(self.urlScheme):].partition('#')
+        self.path = path
+        self.pool = pool or coordinator.lvsservice.name
+        self.lastConfig = None
+
+    def startObserving(self):
+        """Start watching the pool's section of the document."""
+        PoolDocument.get(self.path).addObserver(self)
+
+    def onDocumentUpdate(self, document):
+        config = document.get(self.pool)
+        if config is None:
+            # Rather than depooling everything
+            log.warn("Pool {} is missing from {}, keeping its servers".format(
+                self.pool, self.path))
+        elif config != self.lastConfig:
+            # Already debounced by the document
             self.coordinator.onConfigUpdate(config)
             self.lastConfig = config
 
 
 class HttpConfigurationObserver(FileConfigurationObserver):
-    """ConfigurationObserver for configuration served over HTTP."""
+    """ConfigurationObserver for configuration served over HTTP.
+
+    Handles the 'http://' scheme.
+
+    Polls the URL every `config-interval` seconds, over persistent
+    connections shared by all pools. Requests are conditional on the
+    ETag and Last-Modified of the last configuration received, so an
+    unchanged configuration costs a 304 response. Failed requests are
+    retried with exponential backoff and jitter, up to
+    `config-backoff-max` seconds apart.
+    """
 
     urlScheme = 'http://'
 
+    TIMEOUT = 5
+    BACKOFF_MAX = 60
+    MAX_CONNECTIONS = 10
+
+    agent = None
+    stats = {'requests': 0, 'notModified': 0, 'errors': 0,
+             'bytes': 0, 'parseTime': 0.0}
+
+    def __init__(self, coordinator, configUrl, configuration=None):
+        configuration = configuration or ConfigDict()
+        self.coordinator = coordinator
+        self.configUrl = configUrl
+        self.reloadIntervalSeconds = configuration.getfloat('config-interval', 1)
+        self.timeout = configuration.getfloat('config-timeout', self.TIMEOUT)
+        self.backoff = Backoff(self.reloadIntervalSeconds, configuration.getfloat(
+            'config-backoff-max', self.BACKOFF_MAX))
+        self.lastConfig = None
+        self.etag = None
+        self.lastModified = None
+        self.reloadCall = None
+
+    @classmethod
+    def getAgent(cls):
+        """Returns the Agent shared by all HTTP configuration observers"""
+        if cls.agent is None:
+            pool = client.HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = cls.MAX_CONNECTIONS
+            cls.agent = client.Agent(reactor, connectTimeout=cls.TIMEOUT, pool=pool)
+        return cls.agent
+
+    @classmethod
+    def getStats(cls):
+        """Returns a dictionary of HTTP configuration counters"""
+        return dict(cls.stats)
+
+    def startObserving(self):
+        """Start polling the configuration URL, starting from the cached
+        configuration, if any."""
+        config, index = ConfigCache.load(self.configUrl)
+        if config is not None and self.lastConfig is None:
+            self.lastConfig = config
+            self.notifyConfig(config)
+        self.reload()
+
+    def reload(self):
+        if self.reloadCall is not None and self.reloadCall.active():
+            self.reloadCall.cancel()
+        self.reloadCall = None
+        self.reloadConfig().addCallbacks(self.onReloadDone, self.logError)
+
+    def scheduleReload(self, delay):
+        self.reloadCall = reactor.callLater(delay, self.reload)
+
+    def onReloadDone(self, result):
+        self.backoff.reset()
+        self.scheduleReload(self.reloadIntervalSeconds)
+
+    def logError(self, failure):
+        """Log an error and retry after a backoff delay."""
+        failure.trap(Exception)
+        self.stats['errors'] += 1
+        delay = self.backoff.nextDelay()
+        log.err(failure, "Could not fetch %s, retrying in %.1fs" % (
+            self.configUrl, delay))
+        self.scheduleReload(delay)
+
     def reloadConfig(self):
-        dfd = client.getPage(self.configUrl)
-        dfd.addCallbacks(self.onConfigReceived, self.logError)
-        return dfd
+        """Fetch the configuration if it has changed, and notify the
+        coordinator if the parsed configuration has changed."""
+        headers = Headers({'User-Agent': [USER_AGENT_STRING]})
+        if self.etag is not None:
+            headers.addRawHeader('If-None-Match', self.etag)
+        if self.lastModified is not None:
+            headers.addRawHeader('If-Modified-Since', self.lastModified)
+
+        self.stats['requests'] += 1
+        dfd = self.getAgent().request('GET', self.configUrl, headers)
+        dfd.addCallback(self.onResponse)
+        timeoutCall = reactor.callLater(self.timeout, dfd.cancel)
+
+        def cancelTimeout(result):
+            if timeoutCall.active():
+                timeoutCall.cancel()
+            return result
+        return dfd.addBoth(cancelTimeout)
+
+    def onResponse(self, response):
+        if response.code == 304:
+            self.stats['notModified'] += 1
+            return None
+        return client.readBody(response).addCallback(self.onBody, response)
+
+    def onBody(self, rawConfig, response):
+        if response.code != 200:
+            raise error.Error(str(response.code), response.phrase, rawConfig)
+        self.stats['bytes'] += len(rawConfig)
+        self.onConfigReceived(rawConfig)
+        # Only remember validators of a configuration that parsed
+        headers = response.headers
+        self.etag = (headers.getRawHeaders('ETag') or [None])[0]
+        self.lastModified = (headers.getRawHeaders('Last-Modified') or [None])[0]
 
     def onConfigReceived(self, rawConfig):
+        start = time.time()
         config = self.parseConfig(rawConfig)
+        self.stats['parseTime'] += time.time() - start
         if config != self.lastConfig:
-            self.coordinator.onConfigUpdate(config)
+            self.notifyConfig(config)
             self.lastConfig = config
+            ConfigCache.save(self.configUrl, config)
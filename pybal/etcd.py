@@ -8,19 +8,23 @@
 """
 from __future__ import absolute_import
 
-import copy
 import json
+import re
 import urllib
 
+from OpenSSL import SSL
 from twisted.internet import defer, reactor, ssl
 from twisted.python import failure
-from twisted.web import error
+from twisted.web import error, http
 from twisted.web.client import HTTPClientFactory
 from twisted.web.http import HTTPClient, urlparse
 
-from .config import ConfigurationObserver
+from .config import ConfigCache, ConfigDiff, ConfigurationObserver
 from .version import USER_AGENT_STRING
-from .util import log
+from .util import Backoff, log
+
+# etcd error code of a watch whose index has been compacted away
+EVENT_INDEX_CLEARED = 401
 
 def decode_node(node):
     """Decode an individual node from an etcd response."""
@@ -42,18 +46,43 @@ def decode_etcd_data(data):
     from key names, decoding JSON values, and removing etcd metadata."""
     node = data['node']
     if node.get('dir'):
-        return dict(decode_node(child) for child in node['nodes'])
+        return dict(decode_node(child) for child in node.get('nodes', ()))
     else:
         key, value = decode_node(node)
         return {key: value}
 
 
 class EtcdClient(HTTPClient):
-    """Represents a client for the etcd HTTP API."""
+    """Represents a client for the etcd HTTP API.
+
+    Speaks HTTP/1.1 and keeps the connection open across requests. The
+    initial recursive GET is followed by a streaming watch
+    (wait=true&stream=true) on the same connection, whose chunked body
+    is a sequence of JSON events that are decoded as they arrive. The
+    watch is re-issued on the same connection whenever etcd ends it.
+    """
     etcdIndex = 0
 
+    # Largest partial event to buffer
+    MAX_BUFFER = 16 * 1024 * 1024
+
+    jsonDecoder = json.JSONDecoder()
+    whitespace = re.compile(r'\s*')
+
     def connectionMade(self):
-        self.sendCommand('GET', self.factory.getPath())
+        self.sendRequest()
+
+    def sendRequest(self):
+        """Send the next request, and reset the response parser"""
+        self.firstLine = True
+        self._header = ''
+        self.length = None
+        self.chunked = False
+        self.persistent = False
+        self.decoder = None
+        self.buffer = ''
+        self.transport.writeSequence(
+            ['GET ', self.factory.getPath(), ' HTTP/1.1\r\n'])
         self.sendHeader('Host', self.factory.host)
         self.sendHeader('User-Agent', self.factory.agent)
         self.endHeaders()
@@ -62,23 +91,105 @@ class EtcdClient(HTTPClient):
         self.version = version
         self.status = status
         self.message = message
+        self.persistent = version == 'HTTP/1.1'
+
+    def handleHeader(self, key, val):
+        key = key.lower()
+        if key == 'x-etcd-index':
+            self.etcdIndex = int(val)
+        elif key == 'transfer-encoding':
+            self.chunked = val.lower() == 'chunked'
+        elif key == 'connection' and val.lower() == 'close':
+            self.persistent = False
+
+    def handleEndHeaders(self):
+        if self.status == '200':
+            self.factory.onResponding()
+        if self.chunked:
+            self.decoder = http._ChunkedTransferDecoder(
+                self.chunkReceived, self.chunksFinished)
+
+    def handleResponsePart(self, data):
+        if self.decoder is not None:
+            self.decoder.dataReceived(data)
+        else:
+            HTTPClient.handleResponsePart(self, data)
+
+    def chunkReceived(self, data):
+        self.buffer += data
+        if self.status != '200':
+            return
+        try:
+            self.decodeEvents()
+        except Exception:
+            self.factory.onFailure(failure.Failure())
+            self.transport.loseConnection()
+
+    def decodeEvents(self):
+        """Hand all complete JSON events in the buffer to the factory"""
+        buffer, pos = self.buffer, 0
+        while True:
+            pos = self.whitespace.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            try:
+                event, pos = self.jsonDecoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Incomplete event
+                if len(buffer) - pos > self.MAX_BUFFER:
+                    raise
+                break
+            self.factory.onUpdate(event, self.etcdIndex)
+        self.buffer = buffer[pos:]
+
+    def chunksFinished(self, rest):
+        """The chunked response ended, e.g. because etcd ended the watch"""
+        self.decoder = None
+        if self.status != '200':
+            self.handleResponse(self.buffer)
+        else:
+            self.nextRequest()
+        self.setLineMode(rest)
+
+    def nextRequest(self):
+        """Send the next request on this connection, or reconnect"""
+        if self.persistent:
+            self.sendRequest()
+        else:
+            self.transport.loseConnection()
 
     def handleResponse(self, response):
         if self.status != '200':
+            if self.getErrorCode(response) == EVENT_INDEX_CLEARED:
+                self.factory.resync()
+                self.nextRequest()
+                return
             err = error.Error(self.status, self.message, response)
             self.factory.onFailure(failure.Failure(err))
+            self.transport.loseConnection()
+            return
+
+        try:
+            config = json.loads(response)
+            self.factory.onUpdate(config, self.etcdIndex)
+        except Exception:
+            self.factory.onFailure(failure.Failure())
+            self.transport.loseConnection()
         else:
-            try:
-                config = json.loads(response)
-                self.factory.onUpdate(config, self.etcdIndex)
-            except Exception:
-                self.factory.onFailure(failure.Failure())
+            self.nextRequest()
 
-        self.transport.loseConnection()
+    def getErrorCode(self, response):
+        """Returns the etcd error code of an error response, if any"""
+        try:
+            return json.loads(response).get('errorCode')
+        except (ValueError, AttributeError):
+            return None
 
-    def handleHeader(self, key, val):
-        if key == 'X-Etcd-Index':
-            self.etcdIndex = int(val)
+    def connectionLost(self, reason):
+        # Only a response delimited by the end of the connection is
+        # complete; a chunked or Content-Length one was cut short
+        if self.decoder is None and self.length is None:
+            HTTPClient.connectionLost(self, reason)
 
     def timeout(self):
         err = defer.TimeoutError(
@@ -88,10 +199,79 @@ class EtcdClient(HTTPClient):
         self.transport.loseConnection()
 
 
-class EtcdConfigurationObserver(ConfigurationObserver, HTTPClientFactory):
-    """A factory that will continuously monitor an etcd key for changes."""
-
-    urlScheme = 'etcd://'
+class EtcdContextFactory(ssl.ClientContextFactory):
+    """Client TLS context factory that reuses one context, and its
+    session cache, for all connections to etcd"""
+
+    context = None
+
+    def getContext(self):
+        if self.context is None:
+            self.context = ssl.ClientContextFactory.getContext(self)
+            self.context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        return self.context
+
+
+class EtcdHealth(object):
+    """Connection health of an etcd cluster, shared by all observers of
+    keys on it, so that they back off together during an outage rather
+    than each reconnecting in a tight loop."""
+
+    BACKOFF_MAX = 60
+
+    clusters = {}   # (host, port) -> EtcdHealth
+
+    @classmethod
+    def get(cls, host, port):
+        health = cls.clusters.get((host, port))
+        if health is None:
+            health = cls.clusters[(host, port)] = cls(host, port)
+        return health
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.healthy = True
+        self.failures = 0
+        self.resyncs = 0
+        self.backoff = Backoff(1, self.BACKOFF_MAX)
+
+    def failed(self, reason):
+        """Records a failure, and returns the delay before retrying"""
+        self.failures += 1
+        delay = self.backoff.nextDelay()
+        if self.healthy:
+            log.warn("etcd cluster {}:{} is unavailable: {}".format(
+                self.host, self.port, reason.getErrorMessage()))
+            self.healthy = False
+        return delay
+
+    def succeeded(self):
+        """Records a successful response"""
+        if not self.healthy:
+            log.info("etcd cluster {}:{} is available again".format(
+                self.host, self.port))
+            self.healthy = True
+        self.backoff.reset()
+
+    @classmethod
+    def getStats(cls):
+        """Returns a dictionary of counters per cluster"""
+        return dict(('%s:%d' % key, {'healthy': int(health.healthy),
+                                     'failures': health.failures,
+                                     'resyncs': health.resyncs})
+                    for key, health in cls.clusters.iteritems())
+
+
+class EtcdSession(HTTPClientFactory):
+    """A single connection to an etcd cluster, shared by the observers of
+    all keys on it.
+
+    Reads and watches the longest common prefix of the observed keys,
+    and routes the tree and the watch events under it to the observers
+    of the keys concerned, so that the number of connections and
+    watches doesn't grow with the number of pools.
+    """
 
     agent = USER_AGENT_STRING
     method = 'GET'
@@ -100,22 +280,63 @@ class EtcdConfigurationObserver(ConfigurationObserver, HTTPClientFactory):
     timeout = 0
     followRedirect = False
     afterFoundGet = False
-
-    def __init__(self, coordinator, configUrl):
-        self.coordinator = coordinator
-        self.configUrl = configUrl
-        self.host, self.port, self.key = self.parseConfigUrl(configUrl)
+    contextFactory = EtcdContextFactory()
+
+    sessions = {}   # (host, port) -> EtcdSession
+
+    @classmethod
+    def get(cls, host, port):
+        session = cls.sessions.get((host, port))
+        if session is None:
+            session = cls.sessions[(host, port)] = cls(host, port)
+        return session
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.key = None
+        self.observers = {}     # key -> [EtcdConfigurationObserver, ...]
         self.waitIndex = None
-        self.lastConfig = {}
-
-    def startObserving(self):
-        """Start (or re-start) watching the configuration file for changes."""
-        reactor.connectSSL(self.host, self.port, self,
-                           ssl.ClientContextFactory())
-
-    def parseConfigUrl(self, configUrl):
-        parsed = urlparse(configUrl)
-        return parsed.hostname, parsed.port or 2379, parsed.path
+        self.health = EtcdHealth.get(host, port)
+        self.responding = False
+        self.connector = None
+        self.connectCall = None
+
+    def addObserver(self, observer):
+        """Starts routing the configuration of observer.key to observer"""
+        self.observers.setdefault(observer.key, []).append(observer)
+        if self.connector is None:
+            # Wait for the other pools being set up in this reactor turn
+            if self.connectCall is None:
+                self.connectCall = reactor.callLater(0, self.connect)
+        else:
+            # Read the (possibly wider) tree again, for the new observer
+            self.key = self.commonPrefix(self.observers.keys())
+            self.waitIndex = None
+            if self.connector.state == 'connected':
+                self.connector.disconnect()
+
+    @staticmethod
+    def commonPrefix(keys):
+        """Returns the longest common path prefix of keys"""
+        paths = [key.strip('/').split('/') for key in keys]
+        prefix = []
+        for components in zip(*paths):
+            if len(set(components)) > 1:
+                break
+            prefix.append(components[0])
+        return '/' + '/'.join(prefix)
+
+    def connect(self):
+        self.connectCall = None
+        self.key = self.commonPrefix(self.observers.keys())
+        # Resume watching from the cached configurations, if all are cached
+        indexes = [observer.waitIndex for observers in self.observers.itervalues()
+                   for observer in observers]
+        if None not in indexes:
+            self.waitIndex = min(indexes)
+        self.connector = reactor.connectSSL(self.host, self.port, self,
+                                            self.contextFactory)
 
     def getPath(self):
         path = '/v2/keys/%s' % self.key.lstrip('/')
@@ -123,44 +344,146 @@ class EtcdConfigurationObserver(ConfigurationObserver, HTTPClientFactory):
         if self.waitIndex is not None:
             params['waitIndex'] = self.waitIndex
             params['wait'] = 'true'
+            params['stream'] = 'true'
         path = '%s?%s' % (path, urllib.urlencode(params))
         return path
 
+    def startedConnecting(self, connector):
+        self.responding = False
+
+    def onResponding(self):
+        """Called when etcd starts a successful response"""
+        self.responding = True
+        self.health.succeeded()
+
     def clientConnectionFailed(self, connector, reason):
-        connector.connect()
+        self.reconnect(connector, reason)
 
-    def clientConnectionLost(self, connector, unused_reason):
-        connector.connect()
+    def clientConnectionLost(self, connector, reason):
+        if self.responding:
+            # A healthy connection that was closed, e.g. by an etcd restart
+            connector.connect()
+        else:
+            self.reconnect(connector, reason)
+
+    def reconnect(self, connector, reason):
+        """Reconnect after a backoff delay"""
+        reactor.callLater(self.health.failed(reason), connector.connect)
+
+    def resync(self):
+        """The watch index was compacted away: fetch the whole tree again,
+        and watch from its index."""
+        log.warn("etcd index {} of {} was cleared, resyncing".format(
+            self.waitIndex, self.key))
+        self.health.resyncs += 1
+        self.waitIndex = None
 
-    def getMaxModifiedIndex(self, root):
-        root = root.get('node', root)
-        index = root['modifiedIndex']
-        for node in root.get('nodes', ()):
-            index = max(index, self.getMaxModifiedIndex(node))
-        return index
+    @staticmethod
+    def findNode(root, key):
+        """Returns the node of key in the tree under root, or None"""
+        node = root
+        while node.get('key', '/').rstrip('/') != key:
+            for child in node.get('nodes', ()):
+                if key == child['key'] or key.startswith(child['key'] + '/'):
+                    node = child
+                    break
+            else:
+                return None
+        return node
 
     def onUpdate(self, update, etcdIdx):
-        if self.waitIndex is not None:
-            # This is already the result yielded by a watch operation
-            self.waitIndex = self.getMaxModifiedIndex(update) + 1
-        else:
+        root = update['node']
+        if self.waitIndex is None:
+            # A full read of the tree under the common prefix
             self.waitIndex = etcdIdx + 1
-        config = copy.deepcopy(self.lastConfig)
+            for key, observers in self.observers.iteritems():
+                node = self.findNode(root, key)
+                if node is None:
+                    log.warn("etcd key {} not found".format(key))
+                    continue
+                for observer in observers:
+                    self.deliver(observer.onFullRead, key, {'node': node}, etcdIdx)
+            return
+
+        # A watch event, of a key in or of an observed directory
+        self.waitIndex = root['modifiedIndex'] + 1
+        key = root['key']
+        observers = self.observers.get(key) or self.observers.get(
+            key.rsplit('/', 1)[0], ())
+        for observer in observers:
+            self.deliver(observer.onUpdate, key, update, etcdIdx)
+
+    @staticmethod
+    def deliver(handler, key, update, etcdIdx):
+        """Passes an update to one observer, so that a bad value only
+        affects the pool concerned"""
+        try:
+            handler(update, etcdIdx)
+        except Exception:
+            log.err(failure.Failure(), "Could not apply the etcd update of {}".format(key))
 
-        # Read new data
-        new_data = decode_etcd_data(update)
-        config.update(new_data)
+    def onFailure(self, reason):
+        log.error('failed: %s' % reason)
+
+
+class EtcdConfigurationObserver(ConfigurationObserver):
+    """Monitors an etcd directory of server configurations for changes,
+    through the EtcdSession of its cluster."""
+
+    urlScheme = 'etcd://'
+
+    def __init__(self, coordinator, configUrl, configuration=None):
+        self.coordinator = coordinator
+        self.configUrl = configUrl
+        self.host, self.port, self.key = self.parseConfigUrl(configUrl)
+        self.waitIndex = None
+        self.resumeIndex = 0
+        self.lastConfig = {}
 
-        # Remove deleted/inactive nodes
-        to_remove = [k for k, v in new_data.items() if v is None]
-        for k in to_remove:
-            if k in config:
-                del config[k]
+    def startObserving(self):
+        """Start watching the configuration directory for changes,
+        starting from the cached configuration, if any."""
+        config, index = ConfigCache.load(self.configUrl)
+        if config is not None:
+            self.lastConfig = config
+            self.waitIndex = self.resumeIndex = index
+            self.notifyConfig(dict(config))
+        EtcdSession.get(self.host, self.port).addObserver(self)
 
-        # Now update pybal config
+    def parseConfigUrl(self, configUrl):
+        parsed = urlparse(configUrl)
+        return parsed.hostname, parsed.port or 2379, '/' + parsed.path.strip('/')
+
+    def onFullRead(self, update, etcdIdx):
+        """A full read of the tree replaces the configuration"""
+        new_data = decode_etcd_data(update)
+        self.waitIndex = etcdIdx + 1
+        config = dict((k, v) for k, v in new_data.iteritems() if v is not None)
         if config != self.lastConfig:
-            self.coordinator.onConfigUpdate(copy.deepcopy(config))
             self.lastConfig = config
+            self.notifyConfig(dict(config))
+        ConfigCache.saveLater(self.configUrl, self.getCacheState)
 
-    def onFailure(self, reason):
-        log.error('failed: %s' % reason)
+    def onUpdate(self, update, etcdIdx):
+        """A watch event, for the change with this index. Apply the changed
+        nodes in place, and pass on only their differences."""
+        new_data = decode_etcd_data(update)
+        index = update['node']['modifiedIndex']
+        if index < self.resumeIndex:
+            # Already in the cached configuration this observer resumed
+            # from, as the session resumes from the oldest cache
+            return
+        self.waitIndex = index + 1
+        diff = ConfigDiff()
+        for key, value in new_data.iteritems():
+            diff.record(key, self.lastConfig.get(key), value)
+            if value is None:
+                self.lastConfig.pop(key, None)
+            else:
+                self.lastConfig[key] = value
+        if diff:
+            self.notifyConfigDiff(diff)
+            ConfigCache.saveLater(self.configUrl, self.getCacheState)
+
+    def getCacheState(self):
+        return self.lastConfig, self.waitIndex
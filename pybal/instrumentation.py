@@ -10,9 +10,13 @@
   /pools  - a list of the available pools
   /pools/<pool> - The full state of a pool
   /pools/<pool>/<host> - the state of a single host in a pool
+  /metrics - internal counters, e.g. of the probe budget
 
   All results are returned either as human-readable lists or as json
   structures, depending on the Accept header of the request.
+
+  A POST request to /pools/<pool>/<host> resets the backoff of the
+  host's monitors and checks it again right away.
 """
 
 from twisted.web.resource import Resource
@@ -46,6 +50,8 @@ class ServerRoot(Resource):
             return PoolsRoot()
         if path == 'alerts':
             return Alerts()
+        if path == 'metrics':
+            return Metrics()
         else:
             return Resp404()
 
@@ -79,6 +85,44 @@ class Alerts(Resource):
         else:
             return "%s - %s" % (resp['status'].upper(), resp['msg'])
 
+class Metrics(Resource):
+    """Internal counters resource.
+
+    Serves /metrics
+
+    Every registered source is a callable returning a (nested)
+    dictionary of counters.
+    """
+    _sources = {}
+    isLeaf = True
+
+    @classmethod
+    def addSource(cls, name, source):
+        cls._sources[name] = source
+
+    @classmethod
+    def removeSource(cls, name):
+        cls._sources.pop(name, None)
+
+    def render_GET(self, request):
+        metrics = dict((name, source())
+                       for name, source in self._sources.items())
+        if wantJson(request):
+            return json.dumps(metrics)
+        else:
+            return "".join("%s: %s\n" % (k, v)
+                           for k, v in sorted(self.flatten(metrics)))
+
+    @classmethod
+    def flatten(cls, metrics, prefix=''):
+        for key, value in metrics.items():
+            if isinstance(value, dict):
+                for item in cls.flatten(value, prefix + key + '.'):
+                    yield item
+            else:
+                yield prefix + key, value
+
+
 class PoolsRoot(Resource):
     """Pools base resource.
 
@@ -154,3 +198,10 @@ class PoolServer(Resource):
             return json.dumps(self.server.dumpState())
         else:
             return self.server.textStatus() + "\n"
+
+    def render_POST(self, request):
+        self.server.recheck()
+        if wantJson(request):
+            return json.dumps({'recheck': True})
+        else:
+            return "Recheck scheduled\n"
@@ -4,7 +4,7 @@ Copyright (C) 2006-2015 by Mark Bergsma <mark@nedworks.org>
 
 LVS state/configuration classes for PyBal
 """
-from . import util
+from . import util, journal
 
 import os
 log = util.log
@@ -28,6 +28,7 @@ class IPVSManager(object):
 
         if cls.Debug:
             log.debug(cmdList)
+        journal.Journal.record(journal.Journal.IPVS, cmdList)
         if cls.DryRun: return
 
         command = [cls.ipvsPath, '-R']
@@ -205,6 +206,17 @@ class LVSService:
         self.ipvsManager.DryRun = configuration.getboolean('dryrun', False)
         self.ipvsManager.Debug = configuration.getboolean('debug', False)
         self.persist = configuration.getboolean('persistent', False)
+        self.depoolThreshold = configuration.getfloat('depool-threshold', .5)
+
+        journal.Journal.record(journal.Journal.SERVICE, [
+            name, [protocol, ip, port, scheduler], dict(configuration)])
+
+        self.addServiceIP()
+        self.createService()
+
+    def addServiceIP(self):
+        """Adds the service IP to the loopback interface, and to the BGP
+        announcements if enabled."""
 
         if self.configuration.getboolean('bgp', False):
             from pybal import BGPFailover
@@ -214,8 +226,6 @@ class LVSService:
         from pybal import Loopback
         Loopback.addIP(self.ip)
 
-        self.createService()
-
     def service(self):
         """Returns a tuple (protocol, ip, port, scheduler) that
         describes this LVS instance."""
@@ -246,6 +256,28 @@ class LVSService:
         self.servers = newServers
         self.ipvsManager.modifyState(cmdList)
 
+    def updateServers(self, servers):
+        """Updates the LVS state of a subset of servers in a single batch:
+        pooled servers are added or edited, others are removed."""
+
+        cmdList = []
+        for server in servers:
+            if server.pooled:
+                if server in self.servers:
+                    cmdList.append(self.ipvsManager.commandEditServer(
+                        self.service(), server))
+                else:
+                    cmdList.append(self.ipvsManager.commandAddServer(
+                        self.service(), server))
+                    self.servers.add(server)
+            elif server in self.servers:
+                cmdList.append(self.ipvsManager.commandRemoveServer(
+                    self.service(), server))
+                self.servers.remove(server)
+
+        if cmdList:
+            self.ipvsManager.modifyState(cmdList)
+
     def addServer(self, server):
         """Adds (pools) a single Server to the LVS state."""
 
@@ -273,6 +305,17 @@ class LVSService:
         server.pooled = False
         self.ipvsManager.modifyState(cmdList)
 
+    def changeServerIP(self, server, oldIP):
+        """Moves a pooled Server from oldIP to its current address, with
+        a single LVS state change."""
+
+        newIP, server.ip = server.ip, oldIP
+        cmdList = [self.ipvsManager.commandRemoveServer(self.service(), server)]
+        server.ip = newIP
+        cmdList.append(self.ipvsManager.commandAddServer(self.service(), server))
+
+        self.ipvsManager.modifyState(cmdList)
+
     def initServer(self, server):
         """Initializes a server instance with LVS service specific
         configuration."""
@@ -283,4 +326,4 @@ class LVSService:
         """Returns the threshold below which no more down servers will
         be depooled."""
 
-        return self.configuration.getfloat('depool-threshold', .5)
+        return self.depoolThreshold
@@ -0,0 +1,124 @@
+"""
+journal.py
+
+Append-only journal of PyBal state transitions
+"""
+
+from . import util
+
+import json, os, struct, time
+
+log = util.log
+
+
+class Journal(object):
+    """
+    Append-only binary journal of monitor results, server state
+    transitions, configuration diffs and IPVS command lists, for
+    post-incident analysis and replay (see pybal.replay).
+
+    Each record is a fixed header (timestamp, record type, payload
+    length) followed by a compact JSON payload. The journal file is
+    rotated when it grows beyond maxBytes, keeping a number of backups.
+    """
+
+    # Record types
+    SERVICE = 1         # [service, [protocol, ip, port, scheduler], configuration]
+    CONFIG = 2          # [service, added, removed, changed]
+    RESULT = 3          # [service, host, monitor, up, reason]
+    TRANSITION = 4      # [service, host, attribute, value]
+    IPVS = 5            # [command, ...]
+
+    header = struct.Struct('!dBI')
+
+    MAX_BYTES = 64 * 1024 * 1024
+    BACKUPS = 5
+
+    path = None
+    file = None
+    maxBytes = MAX_BYTES
+    backups = BACKUPS
+    records = 0
+
+    @classmethod
+    def configure(cls, path, maxBytes=MAX_BYTES, backups=BACKUPS):
+        """Starts journaling to path, or stops journaling if path is None"""
+
+        cls.close()
+        cls.path = path
+        cls.maxBytes = maxBytes
+        cls.backups = backups
+        cls.records = 0
+        if path is not None:
+            cls.file = open(path, 'ab')
+
+    @classmethod
+    def close(cls):
+        f, cls.file = cls.file, None
+        if f is not None:
+            f.close()
+
+    @classmethod
+    def record(cls, recordType, data, now=None):
+        """
+        Appends a record, if journaling is enabled. Journaling stops at
+        the first write error, rather than interfere with the state
+        changes being recorded.
+        """
+
+        if cls.file is None:
+            return
+
+        payload = json.dumps(data, separators=(',', ':'))
+        try:
+            cls.file.write(cls.header.pack(time.time() if now is None else now, recordType, len(payload)))
+            cls.file.write(payload)
+            cls.file.flush()
+            cls.records += 1
+
+            if cls.file.tell() >= cls.maxBytes:
+                cls.rotate()
+        except (IOError, OSError) as e:
+            log.error("Could not write to journal {}, disabling it: {}".format(cls.path, e))
+            try:
+                cls.close()
+            except (IOError, OSError):
+                pass
+
+    @classmethod
+    def rotate(cls):
+        """Moves the journal file to path.1, path.1 to path.2, and so on"""
+
+        cls.close()
+        for i in range(cls.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (cls.path, i)):
+                os.rename('%s.%d' % (cls.path, i), '%s.%d' % (cls.path, i + 1))
+        if cls.backups:
+            os.rename(cls.path, cls.path + '.1')
+        else:
+            os.unlink(cls.path)
+        cls.file = open(cls.path, 'ab')
+
+    @classmethod
+    def read(cls, f):
+        """
+        Generates tuples (timestamp, recordType, data) from a journal file
+        object. Stops at a truncated record at the end of the file.
+        """
+
+        while True:
+            header = f.read(cls.header.size)
+            if len(header) < cls.header.size:
+                return
+            timestamp, recordType, length = cls.header.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                log.warn("Truncated journal record at offset {}".format(f.tell()))
+                return
+            yield timestamp, recordType, json.loads(payload)
+
+    @classmethod
+    def getStats(cls):
+        """Returns a dictionary of journal counters"""
+
+        return {'records': cls.records}
@@ -8,43 +8,423 @@ from twisted.internet import reactor
 from . import util
 import logging
 
+import errno, socket, struct
+
+log = util.log
 _log = util._log
 
 
+class MonitorPlan(object):
+    """
+    The monitors configured for an LVS service: the 'monitors' list is
+    parsed and its classes are resolved once, and then shared by all
+    servers of the service. The options of the monitors are likewise
+    parsed once, through the cache of the service's ConfigDict.
+    """
+
+    _plans = {}
+
+    def __init__(self, name, configuration):
+        """Constructor"""
+
+        self.name = name
+        self.configuration = configuration
+        self.monitorClasses = []
+
+        try:
+            monitorlist = eval(configuration['monitors'])
+        except KeyError:
+            log.critical(
+                "LVS service {} does not have a 'monitors' configuration option set.".format(
+                    name)
+            )
+            raise
+
+        if type(monitorlist) != list:
+            msg = "option 'monitors' in LVS service section {} is not a python list"
+            log.err(msg.format(name))
+            return
+
+        for monitorname in monitorlist:
+            try:
+                monitormodule = getattr(__import__('pybal.monitors', fromlist=[monitorname.lower()], level=0), monitorname.lower())
+            except AttributeError:
+                log.err("Monitor {} does not exist".format(monitorname))
+            else:
+                self.monitorClasses.append(
+                    getattr(monitormodule, monitorname + 'MonitoringProtocol'))
+
+    @classmethod
+    def forService(cls, lvsservice):
+        """Returns the (cached) plan for an LVS service"""
+
+        plan = cls._plans.get(lvsservice.name)
+        if plan is None or plan.configuration is not lvsservice.configuration:
+            plan = cls(lvsservice.name, lvsservice.configuration)
+            cls._plans[lvsservice.name] = plan
+        return plan
+
+    def createMonitors(self, coordinator, server):
+        """Returns new (not yet running) monitor instances for a server"""
+
+        return [monitorclass(coordinator, server, self.configuration)
+                for monitorclass in self.monitorClasses]
+
+
+class ProbeBudget(object):
+    """
+    Global budget of health check probes per second, shared by the
+    monitors of all pools. Probes of 'critical' pools always run; those
+    of 'normal' pools wait for a token, and those of 'low' priority pools
+    additionally leave part of the burst capacity in reserve, so their
+    check intervals stretch first under overload.
+    """
+
+    # Fraction of the burst size to keep in reserve, per priority
+    PRIORITIES = {'critical': None, 'normal': 0.0, 'low': 0.5}
+
+    bucket = None
+    granted = 0
+    exhausted = 0
+    deferred = {}
+
+    @classmethod
+    def configure(cls, rate, burst=None, now=0):
+        """(Re)configures the budget; a rate of 0 means unlimited"""
+
+        cls.bucket = rate and util.TokenBucket(rate, burst, now) or None
+        cls.granted = cls.exhausted = 0
+        cls.deferred = dict((p, 0) for p in cls.PRIORITIES)
+
+    @classmethod
+    def acquire(cls, priority, now, retry=False):
+        """
+        Requests permission to start a probe. Returns 0 if it may start
+        right away, or the number of seconds to defer it by. Retries of
+        a deferred probe pass retry, so it is counted as deferred once.
+        """
+
+        if cls.bucket is None:
+            return 0
+
+        reserve = cls.PRIORITIES[priority]
+        cls.bucket.refill(now)
+        if cls.bucket.tokens < 1:
+            cls.exhausted += 1
+        if reserve is None:
+            delay = cls.bucket.consume(now, force=True)
+        else:
+            delay = cls.bucket.consume(now, reserve * cls.bucket.burst)
+
+        if not delay:
+            cls.granted += 1
+        elif not retry:
+            cls.deferred[priority] += 1
+        return delay
+
+    @classmethod
+    def getStats(cls):
+        """Returns a dictionary of budget counters"""
+
+        if cls.bucket is None:
+            return {'rate': 0}
+        cls.bucket.refill(reactor.seconds())
+        return {'rate': cls.bucket.rate,
+                'tokens': cls.bucket.tokens,
+                'granted': cls.granted,
+                'exhausted': cls.exhausted,
+                'deferred': dict(cls.deferred)}
+
+
+class SourceAddressPool(object):
+    """
+    Pool of local source addresses that outbound checks are spread over.
+    Optionally accounts for the ephemeral ports in use (including those
+    lingering in TIME_WAIT) from every source address toward each
+    destination, to avoid running out of them.
+    """
+
+    # Connect errors caused by lack of local resources rather than by the
+    # remote server
+    LOCAL_EXHAUSTION_ERRNOS = frozenset([
+        errno.EADDRNOTAVAIL, errno.EADDRINUSE, errno.EAGAIN,
+        errno.EMFILE, errno.ENFILE, errno.ENOBUFS])
+
+    TIME_WAIT = 60
+    DEFAULT_PORT_RANGE = 28232
+    portRangePath = '/proc/sys/net/ipv4/ip_local_port_range'
+
+    addresses = {}
+    position = {}
+    portRange = None
+    inUse = {}
+    localExhaustion = 0
+    portsExhausted = 0
+
+    @classmethod
+    def configure(cls, addresses):
+        """Sets the list of local source addresses to use"""
+
+        cls.addresses = {
+            socket.AF_INET: [a for a in addresses if ':' not in a],
+            socket.AF_INET6: [a for a in addresses if ':' in a]
+        }
+        cls.position = {}
+        cls.inUse = {}
+        cls.localExhaustion = cls.portsExhausted = 0
+
+    @classmethod
+    def getPortRange(cls):
+        """Returns the number of ephemeral ports available per destination"""
+
+        if cls.portRange is None:
+            try:
+                with open(cls.portRangePath) as f:
+                    low, high = f.read().split()
+                cls.portRange = int(high) - int(low) + 1
+            except (IOError, ValueError):
+                cls.portRange = cls.DEFAULT_PORT_RANGE
+        return cls.portRange
+
+    @classmethod
+    def acquire(cls, host, port, accounting=False):
+        """
+        Returns the local address to connect to host:port from, '' for the
+        system default, or None if port accounting is enabled and all
+        source addresses ran out of ports toward host:port.
+        """
+
+        family = (':' in host) and socket.AF_INET6 or socket.AF_INET
+        sources = cls.addresses.get(family) or ['']
+
+        if not accounting:
+            i = cls.position.get(family, 0)
+            cls.position[family] = (i + 1) % len(sources)
+            return sources[i % len(sources)]
+
+        source = min(sources, key=lambda s: cls.inUse.get((s, host, port), 0))
+        key = (source, host, port)
+        if cls.inUse.get(key, 0) >= cls.getPortRange():
+            cls.portsExhausted += 1
+            return None
+        cls.inUse[key] = cls.inUse.get(key, 0) + 1
+        return source
+
+    @classmethod
+    def release(cls, source, host, port, lingered=False):
+        """
+        Releases a port acquired with accounting. Unless the connection
+        was closed with SO_LINGER, the port stays in TIME_WAIT for a while.
+        """
+
+        if lingered:
+            cls._release((source, host, port))
+        else:
+            reactor.callLater(cls.TIME_WAIT, cls._release, (source, host, port))
+
+    @classmethod
+    def _release(cls, key):
+        count = cls.inUse.get(key, 0) - 1
+        if count > 0:
+            cls.inUse[key] = count
+        else:
+            cls.inUse.pop(key, None)
+
+    @classmethod
+    def isLocalExhaustion(cls, failure):
+        """
+        Returns whether a connection failure was caused by local resource
+        exhaustion, and counts it if so.
+        """
+
+        if getattr(failure.value, 'osError', None) in cls.LOCAL_EXHAUSTION_ERRNOS:
+            cls.localExhaustion += 1
+            return True
+        return False
+
+    @classmethod
+    def getStats(cls):
+        """Returns a dictionary of source address counters"""
+
+        return {'addresses': sum(len(a) for a in cls.addresses.values()),
+                'ports-in-use': sum(cls.inUse.values()),
+                'ports-exhausted': cls.portsExhausted,
+                'local-exhaustion': cls.localExhaustion}
+
+
+class MonitorRegistry(object):
+    """
+    Registry of all running monitors. Monitors register when they start
+    running and deregister when they stop, and a single shutdown trigger
+    stops all monitors still registered at that time.
+    """
+
+    monitors = set()
+    shutdownTrigger = None
+
+    @classmethod
+    def register(cls, monitor):
+        """Adds a running monitor to the registry"""
+
+        if cls.shutdownTrigger is None:
+            cls.shutdownTrigger = reactor.addSystemEventTrigger(
+                'before', 'shutdown', cls.stopAll)
+        cls.monitors.add(monitor)
+
+    @classmethod
+    def deregister(cls, monitor):
+        """Removes a monitor from the registry"""
+
+        cls.monitors.discard(monitor)
+
+    @classmethod
+    def stopAll(cls):
+        """Stops all running monitors"""
+
+        cls.shutdownTrigger = None
+        for monitor in list(cls.monitors):
+            monitor.stop()
+        cls.monitors.clear()
+
+    @classmethod
+    def getStats(cls):
+        """Returns a dictionary of registry counters"""
+
+        return {'running': len(cls.monitors)}
+
+
 class MonitoringProtocol(object):
     """
     Base class for all monitoring protocols. Declares a few obligatory
     abstract methods, and some commonly useful functions.
     """
 
+    # Backoff policy for checks scheduled while the monitor is down;
+    # a factor of 1 disables backoff
+    BACKOFF_FACTOR = 1.0
+    BACKOFF_MAX = 300
+
+    # Whether checks send probes to the server, and so draw from the
+    # global ProbeBudget
+    probing = True
+
+    # Monitors exist for every server of every service, so keep them
+    # compact; subclasses declare their own additional __slots__
+    __slots__ = ('coordinator', 'server', 'configuration', '_up', 'reactor',
+                 'active', 'firstCheck', 'checkCall', 'nextCheck',
+                 'backoffFactor', 'backoffMax', 'backoffSteps',
+                 'lingerClose', 'portAccounting', 'priority', '__name__')
+
     def __init__(self, coordinator, server, configuration={}, reactor=reactor):
         """Constructor"""
 
         self.coordinator = coordinator
         self.server = server
         self.configuration = configuration
-        self.up = None    # None, False (Down) or True (Up)
+        self._up = None    # None, False (Down) or True (Up)
         self.reactor = reactor
 
         self.active = False
         self.firstCheck = True
+        self.checkCall = None
+        self.nextCheck = None
+        self.backoffFactor = self.BACKOFF_FACTOR
+        self.backoffMax = self.BACKOFF_MAX
+        self.backoffSteps = 0
+        self.lingerClose = False
+        self.portAccounting = False
+
+        # Options are named after the monitor; bare instances of this
+        # base class have no name, and keep the defaults
+        if hasattr(self, '__name__'):
+            self.backoffFactor = self._getConfigFloat('backoff-factor', self.BACKOFF_FACTOR)
+            self.backoffMax = self._getConfigInt('backoff-max', self.BACKOFF_MAX)
+            self.lingerClose = self._getConfigBool('linger-close', False)
+            self.portAccounting = self._getConfigBool('port-accounting', False)
 
-        # Install cleanup handler
-        self.reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        self.priority = configuration.get('probe-priority', 'normal')
+        if self.priority not in ProbeBudget.PRIORITIES:
+            raise ValueError("Invalid probe-priority %s" % self.priority)
+
+    @property
+    def up(self):
+        return self._up
+
+    @up.setter
+    def up(self, up):
+        """Sets the monitoring state, and lets the server keep count of
+        its monitors that are up."""
+        wasUp, self._up = self._up, up
+        if bool(wasUp) != bool(up) and self.server is not None:
+            try:
+                monitorUpChanged = self.server.monitorUpChanged
+            except AttributeError:
+                return
+            monitorUpChanged(self, bool(up))
 
     def run(self):
         """Start the monitoring"""
         assert self.active is False
         self.active = True
+        MonitorRegistry.register(self)
 
     def stop(self):
         """Stop the monitoring; cancel any running or upcoming checks"""
         self.active = False
+        MonitorRegistry.deregister(self)
 
     def name(self):
         """Returns a printable name for this monitor"""
         return self.__name__
 
+    def recheck(self):
+        """Resets the backoff, and runs the next check right away if it
+        was waiting to be scheduled."""
+        self.backoffSteps = 0
+        if (self.active and self.nextCheck is not None
+                and self.checkCall and self.checkCall.active()):
+            self.checkCall.cancel()
+            self.checkCall = self.reactor.callLater(0, self._startCheck, self.nextCheck)
+
+    def _scheduleCheck(self, interval, check):
+        """Schedules the next check to start after interval seconds, or
+        later if the monitor is backing off or the global probe budget is
+        exhausted by then."""
+        self.nextCheck = check
+        self.checkCall = self.reactor.callLater(
+            self._backoffInterval(interval), self._startCheck, check)
+        return self.checkCall
+
+    def _backoffInterval(self, interval):
+        """Returns the interval to the next check, growing exponentially
+        up to backoffMax while the monitor stays down."""
+        if self.up is not False or self.backoffFactor <= 1:
+            self.backoffSteps = 0
+            return interval
+        self.backoffSteps += 1
+        return max(interval, min(interval * self.backoffFactor ** self.backoffSteps,
+                                 self.backoffMax))
+
+    def _startCheck(self, check, retry=False):
+        if not self.probing:
+            check()
+            return
+        delay = ProbeBudget.acquire(self.priority, self.reactor.seconds(), retry)
+        if delay:
+            self.checkCall = self.reactor.callLater(delay, self._startCheck, check, True)
+        else:
+            check()
+
+    @staticmethod
+    def _setLinger(transport):
+        """Makes closing a TCP connection reset it rather than leave its
+        local port in TIME_WAIT"""
+        try:
+            transport.getHandle().setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except (AttributeError, socket.error):
+            pass
+
     def _resultUp(self):
         """Sets own monitoring state to Up and notifies the coordinator
         if this implies a state change.
@@ -52,6 +432,7 @@ class MonitoringProtocol(object):
         if self.active and self.up is False or self.firstCheck:
             self.up = True
             self.firstCheck = False
+            self.backoffSteps = 0
             if self.coordinator:
                 self.coordinator.resultUp(self)
 
@@ -74,13 +455,21 @@ class MonitoringProtocol(object):
         s = "%s %s" % (self.server.lvsservice.name, self.__name__)
         _log(msg, level, s)
 
+    # Typed options are shared by all monitors of the service, and so are
+    # parsed and validated only once
+
     def _getConfigBool(self, optionname, default=None):
-        return self.configuration.getboolean(
-            '%s.%s' % (self.__name__.lower(), optionname), default)
+        return self.configuration.getparsed(
+            '%s.%s' % (self.__name__.lower(), optionname),
+            util.ConfigDict.parseBoolean, default)
+
+    def _getConfigFloat(self, optionname, default=None):
+        return self.configuration.getparsed(
+            '%s.%s' % (self.__name__.lower(), optionname), float, default)
 
     def _getConfigInt(self, optionname, default=None):
-        return self.configuration.getint(
-            '%s.%s' % (self.__name__.lower(), optionname), default)
+        return self.configuration.getparsed(
+            '%s.%s' % (self.__name__.lower(), optionname), int, default)
 
     def _getConfigString(self, optionname):
         val = self.configuration[self.__name__.lower() + '.' + optionname]
@@ -94,7 +483,11 @@ class MonitoringProtocol(object):
         consists of either a single string, or a single list of
         strings."""
         key = self.__name__.lower() + '.' + optionname
-        val = eval(self.configuration[key], locals, globals)
+        if locals is None and globals is None:
+            # Shared by all monitors of the service; parse it only once
+            val = self.configuration.getparsed(key, eval)
+        else:
+            val = eval(self.configuration[key], locals, globals)
         if type(val) == str:
             return val
         elif (isinstance(val, list) and
@@ -5,4 +5,4 @@ Copyright (C) 2006-2014 by Mark Bergsma <mark@nedworks.org>
 The monitors package contains all (complete) monitoring implementations of PyBal
 """
 
-__all__ = [ 'proxyfetch', 'idleconnection', 'runcommand', 'dnsquery' ]
+__all__ = [ 'proxyfetch', 'idleconnection', 'runcommand', 'dnsquery', 'ipvsstats' ]
@@ -7,19 +7,39 @@ DNS Monitor class implementation for PyBal
 
 from pybal import monitor
 
-from twisted.internet import reactor, defer
+from twisted.internet import defer
+from twisted.internet import error as ierror
 from twisted.names import client, dns, error
 from twisted.python import runtime
 import logging
 
 import random, socket
 
+class SourceBoundResolver(client.Resolver):
+    """Resolver that sends its queries from a given local address"""
+
+    sourceAddress = ''
+
+    def _connectedProtocol(self):
+        proto = dns.DNSDatagramProtocol(self, reactor=self._reactor)
+        while True:
+            try:
+                self._reactor.listenUDP(dns.randomSource(), proto,
+                                        interface=self.sourceAddress)
+            except ierror.CannotListenError:
+                pass
+            else:
+                return proto
+
+
 class DNSQueryMonitoringProtocol(monitor.MonitoringProtocol):
     """
     Monitor that checks a DNS server by doing repeated DNS queries
     """
 
     __name__ = 'DNSQuery'
+    __slots__ = ('intvCheck', 'toQuery', 'hostnames', 'failOnNXDOMAIN',
+                 'resolver', 'sourceAddress', 'checkStartTime', 'DNSQueryDeferred')
 
     INTV_CHECK = 10
     TIMEOUT_QUERY = 5
@@ -42,7 +62,7 @@ class DNSQueryMonitoringProtocol(monitor.MonitoringProtocol):
         self.failOnNXDOMAIN = self._getConfigBool('fail-on-nxdomain', False)
 
         self.resolver = None
-        self.checkCall = None
+        self.sourceAddress = None
         self.DNSQueryDeferred = defer.Deferred()
         self.checkStartTime = None
 
@@ -51,11 +71,18 @@ class DNSQueryMonitoringProtocol(monitor.MonitoringProtocol):
 
         super(DNSQueryMonitoringProtocol, self).run()
 
-        # Create a resolver
-        self.resolver = client.createResolver([(self.server.ip, 53)])
+        # Create a resolver. With port accounting, the source address is
+        # chosen for every query instead
+        source = not self.portAccounting and monitor.SourceAddressPool.acquire(
+            self.server.ip, 53)
+        if source or self.portAccounting:
+            self.resolver = SourceBoundResolver(servers=[(self.server.ip, 53)])
+            self.resolver.sourceAddress = source or ''
+        else:
+            self.resolver = client.createResolver([(self.server.ip, 53)])
 
         if not self.checkCall or not self.checkCall.active():
-            self.checkCall = reactor.callLater(self.intvCheck, self.check)
+            self._scheduleCheck(self.intvCheck, self.check)
 
     def stop(self):
         """Stop the monitoring"""
@@ -69,6 +96,15 @@ class DNSQueryMonitoringProtocol(monitor.MonitoringProtocol):
     def check(self):
         """Periodically called method that does a single uptime check."""
 
+        if self.portAccounting:
+            self.sourceAddress = monitor.SourceAddressPool.acquire(
+                self.server.ip, 53, True)
+            if self.sourceAddress is None:
+                self.report('No local ports left, skipping check', level=logging.WARN)
+                self._scheduleCheck(self.intvCheck, self.check)
+                return
+            self.resolver.sourceAddress = self.sourceAddress
+
         hostname = random.choice(self.hostnames)
         query = dns.Query(hostname, type=random.choice([dns.A, dns.AAAA]))
 
@@ -142,8 +178,14 @@ class DNSQueryMonitoringProtocol(monitor.MonitoringProtocol):
 
         self.checkStartTime = None
 
+        if self.sourceAddress is not None:
+            # UDP ports do not linger in TIME_WAIT
+            monitor.SourceAddressPool.release(self.sourceAddress, self.server.ip,
+                                              53, lingered=True)
+            self.sourceAddress = None
+
         # Schedule the next check
         if self.active:
-            self.checkCall = reactor.callLater(self.intvCheck, self.check)
+            self._scheduleCheck(self.intvCheck, self.check)
 
         return result
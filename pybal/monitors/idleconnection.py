@@ -44,6 +44,8 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         self.keepAliveIdle = self._getConfigInt('keepalive-idle', self.KEEPALIVE_IDLE)
         self.keepAliveInterval = self._getConfigInt('keepalive-interval', self.KEEPALIVE_INTERVAL)
 
+        self.sourceAddress = None
+
     def run(self):
         """Start the monitoring"""
 
@@ -56,6 +58,16 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         super(IdleConnectionMonitoringProtocol, self).stop()
 
         self.stopTrying()
+        self._releaseSource()
+
+    def recheck(self):
+        """Reconnects right away if waiting for a reconnection attempt"""
+
+        super(IdleConnectionMonitoringProtocol, self).recheck()
+
+        self.resetDelay()
+        if self._callID is not None and self._callID.active():
+            self._callID.reset(0)
 
     def startedConnecting(self, connector):
         self.transport = getattr(connector, 'transport', None)
@@ -67,10 +79,15 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         if not self.active:
             return
 
-        # Immediately set status to down
-        self._resultDown(reason.getErrorMessage())
+        if monitor.SourceAddressPool.isLocalExhaustion(reason):
+            # Not the server's fault
+            self.report("Connection failed due to local resource exhaustion: %s" %
+                        reason.getErrorMessage(), level=logging.WARN)
+        else:
+            # Immediately set status to down
+            self._resultDown(reason.getErrorMessage())
 
-        self.report("Connection failed.", level=logging.WARN)
+            self.report("Connection failed.", level=logging.WARN)
 
         # Slowly reconnect
         self.retry(connector)
@@ -106,6 +123,8 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
             sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, self.keepAliveIdle)
             sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, self.keepAliveRetries)
             sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, self.keepAliveInterval)
+        if self.transport is not None and self.lingerClose:
+            self._setLinger(self.transport)
 
         # Set status to up
         self._resultUp()
@@ -129,4 +148,29 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
     def _connect(self, *args, **kwargs):
         """Starts a TCP connection attempt"""
 
+        # Reconnection attempts reuse the port accounted for here, until
+        # the next call
+        self._releaseSource()
+        source = monitor.SourceAddressPool.acquire(
+            self.server.ip, self.server.port, self.portAccounting)
+        if source is None:
+            self.report('No local ports left, postponing connection attempt',
+                        level=logging.WARN)
+            self._callID = self.reactor.callLater(self.delay, self._reconnect, *args, **kwargs)
+            return
+        self.sourceAddress = source
+        if source:
+            kwargs['bindAddress'] = (source, 0)
         self.reactor.connectTCP(self.server.ip, self.server.port, self, *args, **kwargs)
+
+    def _reconnect(self, *args, **kwargs):
+        self._callID = None
+        self._connect(*args, **kwargs)
+
+    def _releaseSource(self):
+        """Releases the port accounted for the connection, if any"""
+
+        if self.portAccounting and self.sourceAddress is not None:
+            monitor.SourceAddressPool.release(self.sourceAddress, self.server.ip,
+                                              self.server.port, self.lingerClose)
+        self.sourceAddress = None
@@ -0,0 +1,235 @@
+"""
+ipvsstats.py
+
+Passive IPVS statistics monitor class implementation for PyBal
+"""
+
+from pybal import monitor
+
+import logging
+
+import binascii, socket, string
+
+
+class IPVSSnapshot(object):
+    """
+    Indexed snapshot of the kernel IPVS connection table, parsed in a
+    single pass from /proc/net/ip_vs and /proc/net/ip_vs_stats.
+    """
+
+    def __init__(self, services=None, totals=None):
+        # (protocol, address, port) -> {(address, port): (active, inactive)}
+        self.services = services or {}
+        # Global counters and rates from /proc/net/ip_vs_stats
+        self.totals = totals or {}
+
+    def destination(self, service, destination):
+        """
+        Returns a tuple (active, inactive) for a destination of a service,
+        or None if it is not present in the table.
+        """
+
+        return self.services.get(service, {}).get(destination)
+
+    def serviceConnections(self, service):
+        """Returns the total number of connections of a service."""
+
+        return sum(active + inactive for active, inactive
+                   in self.services.get(service, {}).itervalues())
+
+    @staticmethod
+    def parseAddress(addr):
+        """
+        Parses an address:port string as found in /proc/net/ip_vs, and
+        returns a normalized (address, port) tuple.
+        """
+
+        addr, port = addr.rsplit(':', 1)
+        if addr.startswith('['):
+            addr = socket.inet_ntop(socket.AF_INET6,
+                                    socket.inet_pton(socket.AF_INET6, addr[1:-1]))
+        else:
+            addr = socket.inet_ntoa(binascii.unhexlify(addr))
+        return addr, int(port, 16)
+
+    @classmethod
+    def parseTable(cls, lines):
+        """
+        Parses the lines of /proc/net/ip_vs into a dictionary of services
+        mapping to dictionaries of destinations.
+        """
+
+        services = {}
+        destinations = None
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            elif fields[0] in ('TCP', 'UDP', 'SCTP'):
+                address, port = cls.parseAddress(fields[1])
+                destinations = services.setdefault(
+                    (fields[0].lower(), address, port), {})
+            elif fields[0] == '->' and fields[1][0] in '0123456789ABCDEF[':
+                if destinations is not None:
+                    destinations[cls.parseAddress(fields[1])] = (
+                        int(fields[4]), int(fields[5]))
+            else:
+                # Header lines and firewall mark services
+                destinations = None
+        return services
+
+    @staticmethod
+    def parseStats(lines):
+        """
+        Parses the lines of /proc/net/ip_vs_stats into a dictionary of
+        global counters and rates.
+        """
+
+        names = ('conns', 'inpkts', 'outpkts', 'inbytes', 'outbytes')
+        # Header lines always contain non-hexadecimal words
+        values = [line.split() for line in lines
+                  if line.strip() and all(c in string.hexdigits
+                                          for c in line.replace(' ', '').strip())]
+        totals = {}
+        if len(values) >= 1:
+            totals.update(zip(names, [int(v, 16) for v in values[0]]))
+        if len(values) >= 2:
+            totals.update(zip([n + '/s' for n in names],
+                              [int(v, 16) for v in values[1]]))
+        return totals
+
+    @classmethod
+    def read(cls, tablePath='/proc/net/ip_vs', statsPath='/proc/net/ip_vs_stats'):
+        """Reads and parses a new snapshot from the kernel."""
+
+        with open(tablePath, 'rt') as f:
+            services = cls.parseTable(f)
+        try:
+            with open(statsPath, 'rt') as f:
+                totals = cls.parseStats(f.readlines())
+        except IOError:
+            totals = {}
+        return cls(services, totals)
+
+
+class IPVSStatsMonitoringProtocol(monitor.MonitoringProtocol):
+    """
+    Passive monitor that periodically inspects the connection counters the
+    kernel keeps for the server's IPVS destination, and reports the server
+    down when they look anomalous: many inactive connections but no active
+    ones, or a destination that stopped receiving connections while the
+    rest of the service still does.
+    """
+
+    __name__ = 'IPVSStats'
+    # Reads kernel counters rather than probing the server
+    probing = False
+    __slots__ = ('intvCheck', 'maxInactive', 'minServiceConnections',
+                 'samples', 'anomalies', 'sawTraffic')
+
+    INTV_CHECK = 10
+    MAX_INACTIVE = 100
+    MIN_SERVICE_CONNECTIONS = 10
+    SAMPLES = 3
+
+    tablePath = '/proc/net/ip_vs'
+    statsPath = '/proc/net/ip_vs_stats'
+
+    # Snapshot shared by all instances, refreshed at most once per interval
+    snapshot = None
+    snapshotTime = None
+
+    def __init__(self, coordinator, server, configuration):
+        """Constructor"""
+
+        # Call ancestor constructor
+        super(IPVSStatsMonitoringProtocol, self).__init__(coordinator, server, configuration)
+
+        self.intvCheck = self._getConfigInt('interval', self.INTV_CHECK)
+        self.maxInactive = self._getConfigInt('max-inactive', self.MAX_INACTIVE)
+        self.minServiceConnections = self._getConfigInt(
+            'min-service-connections', self.MIN_SERVICE_CONNECTIONS)
+        self.samples = self._getConfigInt('samples', self.SAMPLES)
+
+        self.anomalies = 0
+        self.sawTraffic = False
+
+    def run(self):
+        """Start the monitoring"""
+
+        super(IPVSStatsMonitoringProtocol, self).run()
+
+        if not self.checkCall or not self.checkCall.active():
+            self._scheduleCheck(self.intvCheck, self.check)
+
+    def stop(self):
+        """Stop the monitoring"""
+
+        super(IPVSStatsMonitoringProtocol, self).stop()
+
+        if self.checkCall and self.checkCall.active():
+            self.checkCall.cancel()
+
+    @classmethod
+    def getSnapshot(cls, now, maxAge):
+        """
+        Returns the shared IPVS snapshot, rereading the kernel tables only
+        if the current one is older than maxAge seconds.
+        """
+
+        if cls.snapshot is None or now - cls.snapshotTime >= maxAge:
+            cls.snapshot = IPVSSnapshot.read(cls.tablePath, cls.statsPath)
+            cls.snapshotTime = now
+        return cls.snapshot
+
+    def check(self):
+        """Periodically called method that inspects the IPVS counters."""
+
+        try:
+            snapshot = self.getSnapshot(self.reactor.seconds(), self.intvCheck)
+        except (IOError, ValueError) as e:
+            self.report("Could not read IPVS statistics: %s" % e,
+                        level=logging.WARN)
+        else:
+            self.inspect(snapshot)
+
+        # Schedule the next check
+        if self.active:
+            self._scheduleCheck(self.intvCheck, self.check)
+
+    def inspect(self, snapshot):
+        """Evaluates a snapshot for this server's destination."""
+
+        lvsservice = self.server.lvsservice
+        service = (lvsservice.protocol, lvsservice.ip, lvsservice.port)
+        counters = snapshot.destination(service, (self.server.ip, self.server.port))
+
+        if counters is None:
+            # Not pooled; there is no passive evidence against the server,
+            # so leave its fate to the other monitors
+            self.sawTraffic = False
+            self.anomalies = 0
+            self._resultUp()
+            return
+
+        active, inactive = counters
+        anomaly = None
+        if active == 0 and inactive >= self.maxInactive:
+            anomaly = "%d inactive connections and no active ones" % inactive
+        elif (active + inactive == 0 and self.sawTraffic and
+              snapshot.totals.get('conns/s', 1) and
+              snapshot.serviceConnections(service) >= self.minServiceConnections):
+            anomaly = "no longer receiving connections"
+
+        if active + inactive:
+            self.sawTraffic = True
+
+        if anomaly is None:
+            self.anomalies = 0
+            self._resultUp()
+        else:
+            self.anomalies += 1
+            self.report("IPVS anomaly (%d/%d): %s" % (
+                self.anomalies, self.samples, anomaly), level=logging.WARN)
+            if self.anomalies >= self.samples:
+                self._resultDown(anomaly)
@@ -97,6 +97,8 @@ class ProxyFetchMonitoringProtocol(monitor.MonitoringProtocol):
     HTTP_STATUS = 200
 
     __name__ = 'ProxyFetch'
+    __slots__ = ('intvCheck', 'toGET', 'expectedStatus', 'URL',
+                 'checkStartTime', 'getPageDeferred', 'sourceAddress')
 
     from twisted.internet import error
     from twisted.web import error as weberror
@@ -113,10 +115,10 @@ class ProxyFetchMonitoringProtocol(monitor.MonitoringProtocol):
         self.expectedStatus = self._getConfigInt('http_status',
                                                  self.HTTP_STATUS)
 
-        self.checkCall = None
         self.getPageDeferred = defer.Deferred()
 
         self.checkStartTime = None
+        self.sourceAddress = None
 
         self.URL = self._getConfigStringList('url')
 
@@ -126,7 +128,7 @@ class ProxyFetchMonitoringProtocol(monitor.MonitoringProtocol):
         super(ProxyFetchMonitoringProtocol, self).run()
 
         if not self.checkCall or not self.checkCall.active():
-            self.checkCall = reactor.callLater(self.intvCheck, self.check)
+            self._scheduleCheck(self.intvCheck, self.check)
 
     def stop(self):
         """Stop all running and/or upcoming checks"""
@@ -150,6 +152,13 @@ class ProxyFetchMonitoringProtocol(monitor.MonitoringProtocol):
 
         url = random.choice(self.URL)
 
+        self.sourceAddress = monitor.SourceAddressPool.acquire(
+            self.server.ip, self.server.port, self.portAccounting)
+        if self.sourceAddress is None:
+            self.report('No local ports left, skipping check', level=logging.WARN)
+            self._scheduleCheck(self.intvCheck, self.check)
+            return
+
         self.checkStartTime = seconds()
         self.getPageDeferred = self.getProxyPage(
             url,
@@ -157,6 +166,8 @@ class ProxyFetchMonitoringProtocol(monitor.MonitoringProtocol):
             host=self.server.ip,
             port=self.server.port,
             status=self.expectedStatus,
+            bindAddress=self.sourceAddress and (self.sourceAddress, 0) or None,
+            linger=self.lingerClose,
             timeout=self.toGET,
             followRedirect=False
         ).addCallbacks(
@@ -179,6 +190,12 @@ class ProxyFetchMonitoringProtocol(monitor.MonitoringProtocol):
         if failure.check(defer.CancelledError):
             return None
 
+        # Nor if we ran out of local resources
+        if monitor.SourceAddressPool.isLocalExhaustion(failure):
+            self.report('Fetch failed due to local resource exhaustion: %s' %
+                        failure.getErrorMessage(), level=logging.WARN)
+            return None
+
         self.report('Fetch failed, %.3f s' % (seconds() - self.checkStartTime),
                     level=logging.WARN)
 
@@ -194,14 +211,19 @@ class ProxyFetchMonitoringProtocol(monitor.MonitoringProtocol):
 
         self.checkStartTime = None
 
+        if self.portAccounting and self.sourceAddress is not None:
+            monitor.SourceAddressPool.release(self.sourceAddress, self.server.ip,
+                                              self.server.port, self.lingerClose)
+
         # Schedule the next check
         if self.active:
-            self.checkCall = reactor.callLater(self.intvCheck, self.check)
+            self._scheduleCheck(self.intvCheck, self.check)
 
         return result
 
     def getProxyPage(url, contextFactory=None, host=None, port=None,
-                     status=None, *args, **kwargs):
+                     status=None, bindAddress=None, linger=False,
+                     *args, **kwargs):
         """Download a web page as a string. (modified from twisted.web.client.getPage)
 
         Download a page. Return a deferred, which will callback with a
@@ -221,8 +243,12 @@ class ProxyFetchMonitoringProtocol(monitor.MonitoringProtocol):
         if factory.scheme == 'https':
             if contextFactory is None:
                 contextFactory = SSLClientContextFactory(factory.host)
-            reactor.connectSSL(host, port, factory, contextFactory)
+            connector = reactor.connectSSL(host, port, factory, contextFactory,
+                                           bindAddress=bindAddress)
         else:
-            reactor.connectTCP(host, port, factory)
+            connector = reactor.connectTCP(host, port, factory,
+                                           bindAddress=bindAddress)
+        if linger:
+            monitor.MonitoringProtocol._setLinger(connector.transport)
         return factory.deferred
     getProxyPage = staticmethod(getProxyPage)
@@ -84,6 +84,8 @@ class RunCommandMonitoringProtocol(monitor.MonitoringProtocol):
     """
 
     __name__ = 'RunCommand'
+    __slots__ = ('intvCheck', 'timeout', 'command', 'arguments',
+                 'logOutput', 'runningProcess', 'timeoutCall')
 
     INTV_CHECK = 60
 
@@ -104,7 +106,6 @@ class RunCommandMonitoringProtocol(monitor.MonitoringProtocol):
         self.arguments = self._getConfigStringList('arguments', locals=locals)
         self.logOutput = self._getConfigBool('log-output', True)
 
-        self.checkCall = None
         self.runningProcess = None
 
     def run(self):
@@ -113,7 +114,7 @@ class RunCommandMonitoringProtocol(monitor.MonitoringProtocol):
         super(RunCommandMonitoringProtocol, self).run()
 
         if not self.checkCall or not self.checkCall.active():
-            self.checkCall = reactor.callLater(self.intvCheck, self.runCommand)
+            self._scheduleCheck(self.intvCheck, self.runCommand)
 
     def stop(self):
         """Stop all running and/or upcoming checks"""
@@ -164,7 +165,7 @@ class RunCommandMonitoringProtocol(monitor.MonitoringProtocol):
 
         # Schedule the next check
         if self.active:
-            self.checkCall = reactor.callLater(self.intvCheck, self.runCommand)
+            self._scheduleCheck(self.intvCheck, self.runCommand)
 
         reason.trap(error.ProcessDone, error.ProcessTerminated)
 
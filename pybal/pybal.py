@@ -11,26 +11,20 @@ from __future__ import absolute_import
 
 import os, sys, signal, socket, random
 import logging
-from pybal import ipvs, util, config, etcd, instrumentation
+from pybal import ipvs, monitor, util, config, etcd, instrumentation, resolver, state, journal
 
 from twisted.python import failure
 from twisted.internet import reactor, defer
-from twisted.names import client, dns
 
 log = util.log
 
-try:
-    from twisted.internet import inotify
-except ImportError:
-    inotify = None
-
 try:
     from pybal import bgp
 except ImportError:
     pass
 
 
-class Server:
+class Server(object):
     """
     Class that maintains configuration and state of a single (real)server
     """
@@ -39,14 +33,34 @@ class Server:
     DEF_STATE = True
     DEF_WEIGHT = 10
     DEF_FWMETHOD = 'g'
+    DEF_STARTUP_DEADLINE = 15
 
     # Set of attributes allowed to be overridden in a server list
     allowedConfigKeys = [ ('host', str), ('weight', int), ('fwmethod', str), ('enabled', bool) ]
 
+    # Large installations have many thousands of servers; keep them compact
+    __slots__ = ('host', 'lvsservice', 'addressFamily', 'ip', 'port',
+                 'ip4_addresses', 'ip6_addresses', 'monitors', 'upMonitors',
+                 'coordinator', 'weight', 'fwmethod', '_up', '_pooled',
+                 'enabled', 'ready', 'modified', 'refreshCall', 'destroyed',
+                 'startupDeferred', 'startupCall', 'savedState')
+
+    # Shared by all servers until their hostname is resolved
+    NO_ADDRESSES = frozenset()
+
+    @staticmethod
+    def internHost(host):
+        """Interns a hostname. Hostnames from JSON configurations are
+        unicode, and intern() only takes byte strings."""
+
+        if isinstance(host, unicode):
+            host = host.encode('utf-8')
+        return intern(host)
+
     def __init__(self, host, lvsservice, addressFamily=None):
         """Constructor"""
 
-        self.host = host
+        self.host = self.internHost(host)
         self.lvsservice = lvsservice
         if addressFamily:
             self.addressFamily = addressFamily
@@ -54,22 +68,29 @@ class Server:
             self.addressFamily = (':' in self.lvsservice.ip) and socket.AF_INET6 or socket.AF_INET
         self.ip = self.host if self.is_valid_ip() else None
         self.port = 80
-        self.ip4_addresses = set()
-        self.ip6_addresses = set()
+        self.ip4_addresses = self.NO_ADDRESSES
+        self.ip6_addresses = self.NO_ADDRESSES
         self.monitors = set()
+        self.upMonitors = 0    # Number of monitors that are up
 
         # A few invariants that SHOULD be maintained (but currently may not be):
         # P0: pooled => enabled /\ ready
         # P1: up => pooled \/ !enabled \/ !ready
         # P2: pooled => up \/ !canDepool
 
+        self.coordinator = None    # Set while part of a Coordinator
         self.weight = self.DEF_WEIGHT
         self.fwmethod = self.DEF_FWMETHOD
-        self.up = False
-        self.pooled = False
+        self._up = False
+        self._pooled = False
         self.enabled = True
         self.ready = False
         self.modified = None
+        self.refreshCall = None
+        self.destroyed = False
+        self.startupDeferred = None
+        self.startupCall = None
+        self.savedState = None    # State saved by a previous run
 
     def __eq__(self, other):
         return isinstance(other, Server) and self.host == other.host and self.lvsservice == other.lvsservice
@@ -77,10 +98,33 @@ class Server:
     def __hash__(self):
         return hash(self.host)
 
+    @property
+    def up(self):
+        return self._up
+
+    @up.setter
+    def up(self, up):
+        wasUp, self._up = self._up, up
+        if bool(wasUp) != bool(up) and self.coordinator is not None:
+            self.coordinator.serverUpChanged(self, bool(up))
+
+    @property
+    def pooled(self):
+        return self._pooled
+
+    @pooled.setter
+    def pooled(self, pooled):
+        wasPooled, self._pooled = self._pooled, pooled
+        if bool(wasPooled) != bool(pooled) and self.coordinator is not None:
+            self.coordinator.serverPooledChanged(self, bool(pooled))
+
     def addMonitor(self, monitor):
         """Adds a monitor instance to the set"""
 
-        self.monitors.add(monitor)
+        if monitor not in self.monitors:
+            self.monitors.add(monitor)
+            if monitor.up:
+                self.upMonitors += 1
 
     def removeMonitors(self):
         """Removes all monitors"""
@@ -89,6 +133,19 @@ class Server:
             monitor.stop()
 
         self.monitors.clear()
+        self.upMonitors = 0
+
+    def monitorUpChanged(self, monitor, up):
+        """Called by a monitor of this server when its up state changes"""
+
+        if monitor in self.monitors:
+            self.upMonitors += up and 1 or -1
+
+    def recheck(self):
+        """Resets the backoff of all monitors and checks again right away"""
+
+        for monitor in self.monitors:
+            monitor.recheck()
 
     def is_valid_ip(self):
         """Validates IP addresses.
@@ -118,35 +175,20 @@ class Server:
     def resolveHostname(self):
         """Attempts to resolve the server's hostname to an IP address for better reliability."""
 
-        timeout = [1, 2, 5]
-        lookups = []
+        return resolver.HostnameCache.lookup(self.host, self.addressFamily
+            ).addCallback(self._lookupFinished).addBoth(self._hostnameResolved)
 
-        query = dns.Query(self.host, dns.A)
-        lookups.append(client.lookupAddress(self.host, timeout
-            ).addCallback(self._lookupFinished, socket.AF_INET, query))
-
-        query = dns.Query(self.host, dns.AAAA)
-        lookups.append(client.lookupIPV6Address(self.host, timeout
-            ).addCallback(self._lookupFinished, socket.AF_INET6, query))
-
-        return defer.DeferredList(lookups).addBoth(self._hostnameResolved)
-
-    def _lookupFinished(self, (answers, authority, additional), addressFamily, query):
-        ips = set([socket.inet_ntop(addressFamily, r.payload.address)
-                   for r in answers
-                   if r.name == query.name and r.type == query.type])
-
-        if query.type == dns.A:
-            self.ip4_addresses = ips
-        elif query.type == dns.AAAA:
-            self.ip6_addresses = ips
+    def _lookupFinished(self, (addresses, ttl)):
+        if self.addressFamily == socket.AF_INET6:
+            self.ip6_addresses = addresses
+        else:
+            self.ip4_addresses = addresses
 
-        # TODO: expire TTL
-        #if self.ip:
-        #    minTTL = min([r.ttl for r in answers
-        #          if r.name == query.name and r.type == query.type])
+        # Re-resolve when the answer expires, also while disabled
+        if not self.destroyed:
+            self.refreshCall = reactor.callLater(ttl, self.refreshHostname)
 
-        return ips
+        return addresses
 
     def _hostnameResolved(self, result):
         # Pick *1* main ip address to use. Prefer any existing one
@@ -167,15 +209,58 @@ class Server:
         try:
             if not self.ip or self.ip not in ip_addresses:
                 self.ip = random.choice(list(ip_addresses))
-                # TODO: (re)pool
         except IndexError:
             return failure.Failure() # TODO: be more specific?
         else:
             return True
 
+    def refreshHostname(self):
+        """
+        Re-resolves the hostname in the background, and moves the server
+        to a new address if its current one is no longer valid.
+        """
+
+        self.refreshCall = None
+        oldIP = self.ip
+
+        def _refreshed(result):
+            if isinstance(result, failure.Failure):
+                log.warn("Could not re-resolve {}, keeping address {}".format(
+                    self.host, self.ip))
+            elif oldIP and self.ip != oldIP and not self.destroyed:
+                self.changeIP(oldIP)
+
+            # Retry later if the lookup itself failed
+            if self.refreshCall is None and not self.destroyed:
+                self.refreshCall = reactor.callLater(
+                    resolver.HostnameCache.NEGATIVE_TTL, self.refreshHostname)
+
+        return self.resolveHostname().addBoth(_refreshed)
+
+    def changeIP(self, oldIP):
+        """
+        Moves the server from oldIP to its current address: swaps the
+        LVS destination and restarts the monitors against the new address.
+        """
+
+        log.info("Server {} moved from {} to {}".format(self.host, oldIP, self.ip),
+                 system=self.lvsservice.name)
+        if self.pooled:
+            self.lvsservice.changeServerIP(self, oldIP)
+        if self.monitors and self.coordinator is not None:
+            self.removeMonitors()
+            self.createMonitoringInstances(self.coordinator)
+
     def destroy(self):
         self.enabled = False
+        self.destroyed = True
+        if self.refreshCall is not None and self.refreshCall.active():
+            self.refreshCall.cancel()
+        self.refreshCall = None
         self.removeMonitors()
+        if self.startupDeferred is not None:
+            self._startupDone()
+        self.maintainState()
 
     def initialize(self, coordinator):
         """
@@ -183,7 +268,9 @@ class Server:
         when ready for use (self.ready == True)
         """
 
-        if self.ip:
+        if self.ip and self.lvsservice.configuration.getboolean('startup-check', False):
+            d = defer.succeed(coordinator)
+        elif self.ip:
             d = defer.Deferred()
             reactor.callLater(1, d.callback, coordinator)
         else:
@@ -196,6 +283,25 @@ class Server:
         Called when initialization has finished.
         """
 
+        configuration = self.lvsservice.configuration
+        startupCheck = configuration.getboolean('startup-check', False)
+        state, self.savedState = self.savedState, None
+
+        if state is not None and not startupCheck:
+            # Resume from the state saved by a previous run
+            self.restoreState(state, coordinator)
+            return True
+
+        if startupCheck:
+            # Let the monitors check right away, and only become ready
+            # when they have all reported, or at the deadline. Saved
+            # results stand in for monitors that have not reported by then
+            self.createMonitoringInstances(
+                coordinator, state is not None and state.get('monitors') or None)
+            self.recheck()
+            return self.awaitStartup(
+                configuration.getint('startup-deadline', self.DEF_STARTUP_DEADLINE))
+
         self.ready = True
         self.up = self.DEF_STATE
         self.pooled = self.DEF_STATE
@@ -205,6 +311,43 @@ class Server:
 
         return True
 
+    def awaitStartup(self, deadline):
+        """
+        Returns a Deferred that fires when all monitors have reported
+        their first result, or after deadline seconds.
+        """
+
+        self.startupDeferred = defer.Deferred()
+        self.startupCall = reactor.callLater(deadline, self._startupDone)
+        d = self.startupDeferred
+        self.checkStartup()
+        return d
+
+    def checkStartup(self):
+        """Called when a monitor reports a result during startup"""
+
+        if (self.startupDeferred is not None and
+                not any(monitor.firstCheck for monitor in self.monitors)):
+            self._startupDone()
+
+    def _startupDone(self):
+        """
+        Sets the initial state from the first monitoring results, when
+        initializing with startup-check.
+        """
+
+        if self.startupCall is not None and self.startupCall.active():
+            self.startupCall.cancel()
+        self.startupCall = None
+        d, self.startupDeferred = self.startupDeferred, None
+
+        self.ready = True
+        self.up = self.calcStatus()
+        self.pooled = self.enabled and self.up
+        self.maintainState()
+
+        d.callback(True)
+
     def _initFailed(self, fail):
         """
         Called when initialization failed
@@ -216,50 +359,39 @@ class Server:
 
         return False # Continue on success callback chain
 
-    def createMonitoringInstances(self, coordinator):
-        """Creates and runs monitoring instances for this Server"""
-
-        lvsservice = self.lvsservice
-
-        try:
-            monitorlist = eval(lvsservice.configuration['monitors'])
-        except KeyError:
-            log.critical(
-                "LVS service {} does not have a 'monitors' configuration option set.".format(
-                    lvsservice.name)
-            )
-            raise
+    def createMonitoringInstances(self, coordinator, monitorStates=None):
+        """
+        Creates and runs monitoring instances for this Server, optionally
+        with the results saved by a previous run.
+        """
 
-        if type(monitorlist) != list:
-            msg = "option 'monitors' in LVS service section {} is not a python list"
-            log.err(msg.format(lvsservice.name))
-        else:
-            for monitorname in monitorlist:
-                try:
-                    monitormodule = getattr(__import__('pybal.monitors', fromlist=[monitorname.lower()], level=0), monitorname.lower())
-                except AttributeError:
-                    log.err("Monitor {} does not exist".format(monitorname))
-                else:
-                    monitorclass = getattr(monitormodule, monitorname + 'MonitoringProtocol')
-                    monitor = monitorclass(coordinator, self, lvsservice.configuration)
-                    self.addMonitor(monitor)
-                    monitor.run()
+        plan = monitor.MonitorPlan.forService(self.lvsservice)
+        for m in plan.createMonitors(coordinator, self):
+            if monitorStates:
+                saved = monitorStates.get(m.name(), {})
+                m.up = saved.get('up')
+                m.backoffSteps = saved.get('backoffSteps', 0)
+            self.addMonitor(m)
+            m.run()
 
     def calcStatus(self):
         """AND quantification of monitor.up over all monitoring instances of a single Server"""
 
-        # Always return up if no monitors attached to the service
-        if len(self.monitors) == 0: return True
-        # Global status is up if all monitors report up
-        return reduce(lambda b,monitor: b and monitor.up, self.monitors, len(self.monitors) != 0)
+        # Global status is up if all monitors report up, or if there are
+        # no monitors attached to the service
+        return self.upMonitors == len(self.monitors)
 
     def calcPartialStatus(self):
         """OR quantification of monitor.up over all monitoring instances of a single Server"""
 
-        # Always return up if no monitors attached to the service
-        if len(self.monitors) == 0: return True
-        # Partial status is up if one of the monitors reports up
-        return reduce(lambda b,monitor: b or monitor.up, self.monitors, len(self.monitors) == 0)
+        # Partial status is up if one of the monitors reports up, or if
+        # there are no monitors attached to the service
+        return self.upMonitors > 0 or len(self.monitors) == 0
+
+    def calcQuorumStatus(self, quorum):
+        """k-of-n quantification of monitor.up over all monitoring instances of a single Server"""
+
+        return self.upMonitors >= min(quorum, len(self.monitors))
 
     def textStatus(self):
         return "%s/%s/%s" % (self.enabled and "enabled" or "disabled",
@@ -279,12 +411,15 @@ class Server:
     def merge(self, configuration):
         """Merges in configuration from a dictionary of (allowed) attributes"""
 
-        for key, value in configuration.iteritems():
+        for key, value in configuration.items():
             if (key, type(value)) not in self.allowedConfigKeys:
                 del configuration[key]
 
         # Overwrite configuration
-        self.__dict__.update(configuration)
+        for key, value in configuration.iteritems():
+            setattr(self, key, value)
+        if 'host' in configuration:
+            self.host = self.internHost(self.host)
         self.maintainState()
         self.modified = True    # Indicate that this instance previously existed
 
@@ -293,6 +428,34 @@ class Server:
         return {'pooled': self.pooled, 'weight': self.weight,
                 'up': self.up, 'enabled': self.enabled}
 
+    def snapshotState(self):
+        """Dump current state of the server and its monitors, for saving"""
+        state = self.dumpState()
+        state['monitors'] = dict(
+            (monitor.name(), {'up': monitor.up, 'backoffSteps': monitor.backoffSteps})
+            for monitor in self.monitors)
+        return state
+
+    def restoreState(self, state, coordinator):
+        """
+        Makes this server ready with the state saved by a previous run,
+        instead of the defaults, and creates its monitors with their
+        saved results.
+        """
+
+        self.ready = True
+        self.up = state.get('up', self.DEF_STATE)
+        self.pooled = state.get('pooled', self.DEF_STATE)
+        self.maintainState()
+
+        if self.pooled and not self.up:
+            # Kept pooled because too many servers were down; a down
+            # result would not change its state, so have the Coordinator
+            # depool it as soon as it can
+            coordinator.pooledDownServers.add(self)
+
+        self.createMonitoringInstances(coordinator, state.get('monitors', {}))
+
     @classmethod
     def buildServer(cls, hostName, configuration, lvsservice):
         """
@@ -315,18 +478,40 @@ class Coordinator:
 
     serverConfigUrl = 'file:///etc/pybal/squids'
 
+    serverClass = Server
+
     intvLoadServers = 60
 
-    def __init__(self, lvsservice, configUrl):
+    def __init__(self, lvsservice, configUrl, savedState=None):
         """Constructor"""
 
         self.servers = {}
+        self.savedState = savedState or {}    # host -> saved server state
         self.lvsservice = lvsservice
         self.pooledDownServers = set()
+        self.upServers = 0
+        self.pooledServers = 0
         self.configHash = None
+        self.serverConfig = None
         self.serverConfigUrl = configUrl
         self.serverInitDeferredList = defer.Deferred()
-        self.configObserver = config.ConfigurationObserver.fromUrl(self, configUrl)
+
+        # Limit the rate of depool/repool changes of this pool
+        configuration = lvsservice.configuration
+        changeRate = configuration.getfloat('change-rate', 0)
+        self.changeBucket = changeRate and util.TokenBucket(
+            changeRate, configuration.getfloat('change-burst', max(changeRate, 1)),
+            reactor.seconds()) or None
+        self.pendingServers = set()    # Servers with a rate limited change
+        self.flushCall = None
+
+        # Dampen flapping servers
+        self.dampeningHalfLife = configuration.getfloat('dampening-half-life', 0)
+        self.dampeners = {}    # host -> util.Dampener
+        self.reuseCalls = {}    # host -> DelayedCall
+
+        self.configObserver = config.ConfigurationObserver.fromUrl(
+            self, configUrl, configuration)
         self.configObserver.startObserving()
 
     def __str__(self):
@@ -342,14 +527,49 @@ class Coordinator:
         self.lvsservice.assignServers(
             set([server for server in self.servers.itervalues() if server.pooled]))
 
-    def refreshModifiedServers(self):
+    def addServer(self, server):
+        """Adds a Server instance, and starts keeping count of its state"""
+
+        self.servers[server.host] = server
+        server.coordinator = self
+        self.upServers += bool(server.up)
+        self.pooledServers += bool(server.pooled)
+
+    def removeServer(self, server):
+        """Removes a Server instance"""
+
+        del self.servers[server.host]
+        server.coordinator = None
+        self.upServers -= bool(server.up)
+        self.pooledServers -= bool(server.pooled)
+        self.pooledDownServers.discard(server)
+
+    def serverUpChanged(self, server, up):
+        """Called by a Server of this Coordinator when its up state changes"""
+
+        self.upServers += up and 1 or -1
+        journal.Journal.record(journal.Journal.TRANSITION,
+                               [self.lvsservice.name, server.host, 'up', up])
+
+    def serverPooledChanged(self, server, pooled):
+        """Called by a Server of this Coordinator when its pooled state changes"""
+
+        self.pooledServers += pooled and 1 or -1
+        journal.Journal.record(journal.Journal.TRANSITION,
+                               [self.lvsservice.name, server.host, 'pooled', pooled])
+
+    def snapshotState(self):
+        """Returns the state of all servers, for saving"""
+
+        return dict((hostName, server.snapshotState())
+                    for hostName, server in self.servers.iteritems())
+
+    def refreshModifiedServers(self, servers):
         """
-        Calculates the status of every server that existed before the config change.
+        Calculates the status of servers that existed before the config change.
         """
 
-        for server in self.servers.itervalues():
-            if not server.modified: continue
-
+        for server in servers:
             server.up = server.calcStatus()
             server.pooled = server.enabled and server.up
 
@@ -360,6 +580,8 @@ class Coordinator:
         """
 
         server = monitor.server
+        journal.Journal.record(journal.Journal.RESULT, [
+            self.lvsservice.name, server.host, monitor.name(), False, reason])
 
         data = {'service': self, 'monitor': monitor.name(),
                 'host': server.host, 'status': server.textStatus(),
@@ -370,8 +592,12 @@ class Coordinator:
 
         if server.up:
             server.up = False
+            self.dampen(server)
             if server.pooled: self.depool(server)
 
+        if server.startupDeferred is not None:
+            server.checkStartup()
+
     def resultUp(self, monitor):
         """
         Accepts a 'up' notification status result from a single monitoring instance
@@ -379,6 +605,8 @@ class Coordinator:
         """
 
         server = monitor.server
+        journal.Journal.record(journal.Journal.RESULT, [
+            self.lvsservice.name, server.host, monitor.name(), True, None])
 
         if not server.up and server.calcStatus():
             log.info("Server {} ({}) is up".format(server.host,
@@ -387,14 +615,18 @@ class Coordinator:
             server.up = True
             if server.enabled and server.ready: self.repool(server)
 
+        if server.startupDeferred is not None:
+            server.checkStartup()
+
     def depool(self, server):
         """Depools a single Server, if possible"""
 
         assert server.pooled
 
         if self.canDepool():
-            self.lvsservice.removeServer(server)
             self.pooledDownServers.discard(server)
+            if self.changeAllowed(server):
+                self.lvsservice.removeServer(server)
         else:
             self.pooledDownServers.add(server)
             msg = "Could not depool server " \
@@ -410,7 +642,11 @@ class Coordinator:
         assert server.enabled and server.ready
 
         if not server.pooled:
-            self.lvsservice.addServer(server)
+            if self.isSuppressed(server):
+                log.info("Leaving flapping server {} depooled until it is stable".format(
+                    server.host), system=self.lvsservice.name)
+            elif self.changeAllowed(server):
+                self.lvsservice.addServer(server)
         else:
             msg = "Leaving previously pooled but down server {} pooled"
             log.info(msg.format(server.host), system=self.lvsservice.name)
@@ -422,66 +658,226 @@ class Coordinator:
         while len(self.pooledDownServers) > 0 and self.canDepool():
             self.depool(self.pooledDownServers.pop())
 
+    def changeAllowed(self, server):
+        """
+        Returns whether the pool change rate allows changing a server
+        right now. If not, the change is made later.
+        """
+
+        if self.changeBucket is None:
+            return True
+
+        self.pendingServers.discard(server)
+        delay = self.changeBucket.consume(reactor.seconds())
+        if not delay:
+            return True
+
+        self.pendingServers.add(server)
+        if self.flushCall is None or not self.flushCall.active():
+            self.flushCall = reactor.callLater(delay, self.flushPendingServers)
+        return False
+
+    def flushPendingServers(self):
+        """Makes the rate limited changes that are still needed"""
+
+        self.flushCall = None
+        pending, self.pendingServers = self.pendingServers, set()
+        for server in pending:
+            self.reconcile(server)
+
+    def reconcile(self, server):
+        """Depools or repools a server if its state calls for it"""
+
+        if self.servers.get(server.host) is not server:
+            return    # Removed in the mean time
+        if server.pooled and not server.up:
+            self.depool(server)
+        elif not server.pooled and server.up and server.enabled and server.ready:
+            self.repool(server)
+
+    def dampen(self, server):
+        """Adds the penalty of a flap of a server, if dampening is enabled"""
+
+        if not self.dampeningHalfLife:
+            return
+
+        now = reactor.seconds()
+        dampener = self.dampeners.get(server.host)
+        if dampener is None:
+            configuration = self.lvsservice.configuration
+            dampener = self.dampeners[server.host] = util.Dampener(
+                self.dampeningHalfLife,
+                configuration.getint('dampening-penalty', 1000),
+                configuration.getint('dampening-suppress', 2000),
+                configuration.getint('dampening-reuse', 750),
+                configuration.getfloat('dampening-max-suppress', 0),
+                now)
+        if dampener.flap(now):
+            log.warn("Suppressing flapping server {}, penalty {:.0f}".format(
+                server.host, dampener.value), system=self.lvsservice.name)
+
+    def isSuppressed(self, server):
+        """
+        Returns whether a server is suppressed because of flapping, and
+        if so makes sure it is reconsidered when the suppression ends.
+        """
+
+        dampener = self.dampeners.get(server.host)
+        if dampener is None:
+            return False
+
+        now = reactor.seconds()
+        if not dampener.isSuppressed(now):
+            return False
+
+        reuseCall = self.reuseCalls.get(server.host)
+        if reuseCall is None or not reuseCall.active():
+            self.reuseCalls[server.host] = reactor.callLater(
+                dampener.reuseDelay(now) + 1, self._reuse, server)
+        return True
+
+    def _reuse(self, server):
+        """Called when the suppression of a server may have ended"""
+
+        del self.reuseCalls[server.host]
+        self.reconcile(server)
+
+    def getChangeStats(self):
+        """Returns the rate limiting and dampening state of this pool"""
+
+        now = reactor.seconds()
+        for host, dampener in self.dampeners.items():
+            dampener.decay(now)
+            if dampener.value < 1:
+                del self.dampeners[host]
+
+        return {
+            'pending': len(self.pendingServers),
+            'suppressed': sorted(host for host, d in self.dampeners.iteritems()
+                                 if d.suppressed),
+            'penalties': dict((host, round(d.value))
+                              for host, d in self.dampeners.iteritems())
+        }
+
     def canDepool(self):
         """Returns a boolean denoting whether another server can be depooled"""
 
-        # Construct a list of servers that have status 'down'
-        downServers = [server for server in self.servers.itervalues() if not server.up]
+        # The total amount of up servers may never drop below a configured
+        # threshold. Servers held back by the change rate or dampening are
+        # up but not serving, so they don't count
+        upServers = self.upServers - self.heldBackServers()
+        return upServers >= len(self.servers) * self.lvsservice.getDepoolThreshold()
+
+    def heldBackServers(self):
+        """
+        Returns the number of servers that are up, but kept out of the
+        pool by the change rate or dampening.
+        """
+
+        heldBack = set(self.pendingServers)
+        heldBack.update(self.servers[host] for host, dampener in self.dampeners.iteritems()
+                        if dampener.suppressed and host in self.servers)
+        return sum(1 for server in heldBack if server.up and not server.pooled)
+
+    def onConfigUpdate(self, serverConfig):
+        """Computes the changes to the server list, and applies them."""
+
+        diff = config.ConfigDiff.compute(self.serverConfig, serverConfig)
+        self.serverConfig = serverConfig
+        self.onConfigDiff(diff)
 
-        # The total amount of pooled servers may never drop below a configured threshold
-        return len(self.servers) - len(downServers) >= len(self.servers) * self.lvsservice.getDepoolThreshold()
+    def applyConfigDiff(self, diff):
+        """Applies a ConfigDiff computed by an incremental configuration
+        observer, without comparing the full server lists."""
 
-    def onConfigUpdate(self, config):
-        """Parses the server list and changes the state accordingly."""
+        if self.serverConfig is None:
+            self.serverConfig = {}
+        diff.apply(self.serverConfig)
+        self.onConfigDiff(diff)
 
-        delServers = self.servers.copy()    # Shallow copy
+    def onConfigDiff(self, diff):
+        """Changes the state according to a ConfigDiff of the server list."""
+
+        journal.Journal.record(journal.Journal.CONFIG, [
+            self.lvsservice.name, diff.added, sorted(diff.removed), diff.changed])
 
         initList = []
+        newServers = []
+        modifiedServers = []
+        removedServers = []
 
-        for hostName, hostConfig in config.items():
+        for hostName, hostConfig in diff.added.iteritems():
             if hostName in self.servers:
-                # Existing server. merge
-                server = delServers.pop(hostName)
-                server.merge(hostConfig)
-                data = {'status': (server.enabled and "enabled" or "disabled"),
-                        'host': hostName, 'weight': server.weight}
-                log.info(
-                    "Merged {status} server {host}, weight {weight}".format(**data),
-                    system=self.lvsservice.name
-                )
-            else:
-                # New server
-                server = Server.buildServer(hostName, hostConfig, self.lvsservice)
-                data = {'status': (server.enabled and "enabled" or "disabled"),
-                        'host': hostName, 'weight': server.weight}
-                # Initialize with LVS service specific configuration
-                self.lvsservice.initServer(server)
-                self.servers[hostName] = server
-                initList.append(server.initialize(self))
-                log.info(
-                    "New {status} server {host}, weight {weight}".format(**data),
-                    system=self.lvsservice.name
-                )
+                # Out of sync with the server list; treat as a change
+                diff.changed[hostName] = hostConfig
+                continue
+            # New server
+            server = self.serverClass.buildServer(hostName, hostConfig, self.lvsservice)
+            server.savedState = self.savedState.pop(hostName, None)
+            # Initialize with LVS service specific configuration
+            self.lvsservice.initServer(server)
+            self.addServer(server)
+            newServers.append(server)
+            initList.append(server.initialize(self))
+            log.debug("New {} server {}, weight {}".format(
+                server.enabled and "enabled" or "disabled", hostName, server.weight),
+                system=self.lvsservice.name)
+
+        for hostName, fields in diff.changed.iteritems():
+            server = self.servers.get(hostName)
+            if server is None: continue
+            # Existing server. merge
+            server.merge(fields)
+            modifiedServers.append(server)
+            log.debug("Merged {} server {}, weight {}".format(
+                server.enabled and "enabled" or "disabled", hostName, server.weight),
+                system=self.lvsservice.name)
 
         # Remove old servers
-        for hostName, server in delServers.iteritems():
-            log.info("{} Removing server {} (no longer found in new configuration)".format(self, hostName))
+        for hostName in diff.removed:
+            server = self.servers.get(hostName)
+            if server is None: continue
             server.destroy()
-            del self.servers[hostName]
+            self.removeServer(server)
+            self.dampeners.pop(hostName, None)
+            reuseCall = self.reuseCalls.pop(hostName, None)
+            if reuseCall is not None and reuseCall.active():
+                reuseCall.cancel()
+            removedServers.append(server)
+            log.debug("Removing server {} (no longer found in new configuration)".format(
+                hostName), system=self.lvsservice.name)
+
+        log.info("{} Configuration updated: {}".format(self, diff),
+                 system=self.lvsservice.name)
 
         # Calculate up status for previously existing, modified servers
-        self.refreshModifiedServers()
+        self.refreshModifiedServers(modifiedServers)
 
         # Wait for all new servers to finish initializing
-        self.serverInitDeferredList = defer.DeferredList(initList).addCallback(self._serverInitDone)
+        self.serverInitDeferredList = defer.DeferredList(initList).addCallback(
+            self._serverInitDone, newServers,
+            newServers + modifiedServers + removedServers)
 
-    def _serverInitDone(self, result):
+    def _serverInitDone(self, result, newServers, servers):
         """Called when all (new) servers have finished initializing"""
 
         log.info("{} Initialization complete".format(self))
 
-        # Assign the updated list of enabled servers to the LVSService instance
-        self.assignServers()
+        # New servers found down by their first checks were not pooled;
+        # if too many servers are down, pool just enough of them anyway
+        # to meet the depool threshold
+        if not self.canDepool():
+            required = len(self.servers) * self.lvsservice.getDepoolThreshold()
+            for server in newServers:
+                if self.pooledServers >= required:
+                    break
+                if server.enabled and server.ready and not server.pooled:
+                    server.pooled = True
+                    self.pooledDownServers.add(server)
+
+        # Hand over the new, changed and removed servers to the LVSService
+        # instance, in a single batch
+        self.lvsservice.updateServers(servers)
 
 
 class Loopback:
@@ -629,6 +1025,7 @@ def installSignalHandlers():
 
 def main():
     from ConfigParser import SafeConfigParser
+    from pybal.config import ConfigCache, FileWatcher, HttpConfigurationObserver
 
     # Read the configuration file
     configFile = '/etc/pybal/pybal.conf'
@@ -645,6 +1042,59 @@ def main():
         # Install signal handlers
         installSignalHandlers()
 
+        # Global options needed before the services are created
+        if config.has_section('global'):
+            globalConfig = util.ConfigDict(config.items('global'))
+        else:
+            globalConfig = util.ConfigDict()
+        globalConfig.update(cliconfig)
+
+        # Servers start checks and hostname lookups as soon as their
+        # Coordinator has read its configuration, so set up the shared
+        # facilities they use first
+
+        # Set up the global probe budget
+        monitor.ProbeBudget.configure(globalConfig.getfloat('probe-rate', 0),
+                                      globalConfig.getfloat('probe-burst', 0),
+                                      reactor.seconds())
+        instrumentation.Metrics.addSource('probes', monitor.ProbeBudget.getStats)
+
+        # Set up the local source addresses for checks
+        sourceAddresses = globalConfig.get('source-addresses', '')
+        monitor.SourceAddressPool.configure(
+            [a.strip() for a in sourceAddresses.split(',') if a.strip()])
+        instrumentation.Metrics.addSource('sources', monitor.SourceAddressPool.getStats)
+        instrumentation.Metrics.addSource('monitors', monitor.MonitorRegistry.getStats)
+
+        # Set up the shared hostname resolution cache
+        resolver.HostnameCache.configure(
+            globalConfig.getint('dns-concurrency', resolver.HostnameCache.CONCURRENCY),
+            globalConfig.getint('dns-negative-ttl', resolver.HostnameCache.NEGATIVE_TTL))
+        instrumentation.Metrics.addSource('dns', resolver.HostnameCache.getStats)
+
+        # Record state transitions in a journal, from the start
+        if globalConfig.get('journal-file'):
+            journal.Journal.configure(
+                globalConfig['journal-file'],
+                globalConfig.getint('journal-max-size', journal.Journal.MAX_BYTES),
+                globalConfig.getint('journal-backups', journal.Journal.BACKUPS))
+            instrumentation.Metrics.addSource('journal', journal.Journal.getStats)
+
+        # Start remote configuration sources from their last good version
+        ConfigCache.configure(globalConfig.get('config-cache-dir'))
+
+        # Seed server states from the snapshot of a previous run, if any
+        stateFile = None
+        savedStates = {}
+        coordinators = {}
+        if globalConfig.get('state-file'):
+            stateFile = state.StateFile(
+                globalConfig['state-file'],
+                globalConfig.getint('state-interval', state.StateFile.INTERVAL))
+            savedStates = state.StateFile.load(
+                stateFile.path,
+                globalConfig.getint('state-max-age', state.StateFile.MAX_AGE))
+
         for section in config.sections():
             cfgtuple = {}
             if section != 'global':
@@ -671,9 +1121,13 @@ def main():
                     if num: servicename += '_%u' % num
                     services[servicename] = ipvs.LVSService(servicename, cfgtuple[num], configuration=configdict)
                     crd = Coordinator(services[servicename],
-                        configUrl=config.get(section, 'config'))
+                        configUrl=config.get(section, 'config'),
+                        savedState=savedStates.get(servicename))
                     log.info("Created LVS service '{}'".format(servicename))
                     instrumentation.PoolsRoot.addPool(crd.lvsservice.name, crd)
+                    coordinators[servicename] = crd
+                    if stateFile is not None:
+                        stateFile.addCoordinator(crd)
                     num += 1
 
         # Set up BGP
@@ -691,6 +1145,16 @@ def main():
 
         bgpannouncement = BGPFailover(configdict)
 
+        instrumentation.Metrics.addSource('files', FileWatcher.getStats)
+        instrumentation.Metrics.addSource('http', HttpConfigurationObserver.getStats)
+        instrumentation.Metrics.addSource('etcd', etcd.EtcdHealth.getStats)
+        instrumentation.Metrics.addSource('changes', lambda: dict(
+            (name, crd.getChangeStats()) for name, crd in coordinators.iteritems()))
+
+        # Save server states periodically
+        if stateFile is not None:
+            stateFile.start()
+
         # Run the web server for instrumentation
         if configdict.getboolean('instrumentation', False):
             from twisted.web.server import Site
@@ -0,0 +1,205 @@
+"""
+replay.py
+
+Replays a PyBal journal through Coordinator and LVSService, against a fake
+IPVS backend, for post-incident analysis and benchmarking.
+
+Usage: python -m pybal.replay [--verbose] journal [journal...]
+"""
+
+from __future__ import absolute_import
+
+import logging, sys, time
+
+from twisted.internet import defer, task
+
+import pybal.pybal
+from pybal import config, ipvs, journal, monitor, util
+from pybal.pybal import Coordinator, Server
+
+log = util.log
+
+
+class ReplayConfigurationObserver(config.ConfigurationObserver):
+    """ConfigurationObserver that leaves configuration changes to the replay.
+
+    Handles the 'replay://' scheme.
+    """
+
+    urlScheme = 'replay://'
+
+    def __init__(self, coordinator, configUrl, configuration=None):
+        self.coordinator = coordinator
+        self.configUrl = configUrl
+
+    def startObserving(self):
+        pass
+
+
+class FakeIPVSManager(ipvs.IPVSManager):
+    """IPVSManager that collects command lists instead of invoking ipvsadm"""
+
+    DryRun = True
+    commands = []
+
+    @classmethod
+    def modifyState(cls, cmdList):
+        cls.commands.append(list(cmdList))
+
+
+class ReplayLVSService(ipvs.LVSService):
+    """LVSService that leaves the host's interfaces and BGP alone"""
+
+    ipvsManager = FakeIPVSManager
+
+    def addServiceIP(self):
+        pass
+
+
+class ReplayServer(Server):
+    """Server that is ready right away, and has no monitors of its own"""
+
+    __slots__ = ()
+
+    def initialize(self, coordinator):
+        self.ready = True
+        self.up = self.DEF_STATE
+        self.pooled = self.DEF_STATE
+        self.maintainState()
+        return defer.succeed(True)
+
+
+class ReplayCoordinator(Coordinator):
+    """Coordinator that creates ReplayServers"""
+
+    serverClass = ReplayServer
+
+    def getMonitor(self, host, name):
+        """Returns the stand-in monitor of a server by name"""
+
+        server = self.servers.get(host)
+        if server is None:
+            return None
+        for m in server.monitors:
+            if m.name() == name:
+                return m
+        m = monitor.MonitoringProtocol(self, server, self.lvsservice.configuration)
+        m.__name__ = name
+        m.active = True
+        server.addMonitor(m)
+        return m
+
+
+class Replay(object):
+    """
+    Feeds journal records through ReplayCoordinators, on a clock that
+    follows the timestamps of the records, so that timers such as those
+    of change-rate and dampening fire as they did.
+    """
+
+    def __init__(self):
+        self.clock = task.Clock()
+        self.coordinators = {}
+        self.counts = dict((t, 0) for t in (
+            journal.Journal.SERVICE, journal.Journal.CONFIG, journal.Journal.RESULT,
+            journal.Journal.TRANSITION, journal.Journal.IPVS))
+        self.recordedCommands = []
+        FakeIPVSManager.commands = []
+
+    def feed(self, records):
+        """Replays (timestamp, recordType, data) records"""
+
+        reactor, pybal.pybal.reactor = pybal.pybal.reactor, self.clock
+        try:
+            for timestamp, recordType, data in records:
+                self.clock.advance(max(0, timestamp - self.clock.seconds()))
+                self.replayRecord(recordType, data)
+        finally:
+            pybal.pybal.reactor = reactor
+
+    def replayRecord(self, recordType, data):
+        """Replays a single record"""
+
+        self.counts[recordType] = self.counts.get(recordType, 0) + 1
+        if recordType == journal.Journal.SERVICE:
+            self.createService(*data)
+        elif recordType == journal.Journal.CONFIG:
+            name, added, removed, changed = data
+            crd = self.coordinators.get(name)
+            if crd is not None:
+                crd.applyConfigDiff(config.ConfigDiff(
+                    strKeys(added), set(map(str, removed)), strKeys(changed)))
+        elif recordType == journal.Journal.RESULT:
+            name, host, monitorName, up, reason = data
+            crd = self.coordinators.get(name)
+            m = crd and crd.getMonitor(str(host), str(monitorName))
+            if m is None:
+                return
+            elif up:
+                m._resultUp()
+            else:
+                m._resultDown(reason)
+        elif recordType == journal.Journal.IPVS:
+            self.recordedCommands.append(data)
+
+    def createService(self, name, (protocol, ip, port, scheduler), configuration):
+        configuration = util.ConfigDict((str(k), str(v)) for k, v in configuration.iteritems())
+        lvsservice = ReplayLVSService(
+            str(name), (str(protocol), str(ip), port, str(scheduler)), configuration)
+        self.coordinators[name] = ReplayCoordinator(lvsservice, 'replay://' + name)
+
+    def divergence(self):
+        """
+        Returns the number of IPVS command lists that differ between the
+        journal and the replay.
+        """
+
+        recorded, replayed = self.recordedCommands, FakeIPVSManager.commands
+        return (sum(1 for a, b in zip(recorded, replayed) if a != b) +
+                abs(len(recorded) - len(replayed)))
+
+
+def strKeys(d):
+    """Converts the (unicode) keys of JSON decoded dictionaries to str"""
+
+    if isinstance(d, dict):
+        return dict((str(k), strKeys(v)) for k, v in d.iteritems())
+    return d
+
+
+def main(args=sys.argv[1:]):
+    verbose = '--verbose' in args
+    paths = [a for a in args if a != '--verbose']
+    if not paths:
+        print >> sys.stderr, __doc__.strip().splitlines()[-1]
+        return 2
+
+    # Log the replayed events to stderr only when asked to
+    util.PyBalLogObserver.level = verbose and logging.DEBUG or logging.CRITICAL + 1
+
+    records = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            records.extend(journal.Journal.read(f))
+
+    replay = Replay()
+    start = time.time()
+    replay.feed(records)
+    elapsed = time.time() - start
+
+    for crd in replay.coordinators.itervalues():
+        print "%s: %d servers, %d up, %d pooled" % (
+            crd.lvsservice.name, len(crd.servers), crd.upServers, crd.pooledServers)
+    print "%d records (%d results, %d config changes) in %.3fs: %.0f records/s" % (
+        len(records), replay.counts[journal.Journal.RESULT],
+        replay.counts[journal.Journal.CONFIG], elapsed,
+        len(records) / elapsed if elapsed else 0)
+    if replay.recordedCommands:
+        print "%d IPVS command lists replayed, %d diverging from the journal" % (
+            len(FakeIPVSManager.commands), replay.divergence())
+    else:
+        print "%d IPVS command lists replayed" % len(FakeIPVSManager.commands)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
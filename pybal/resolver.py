@@ -0,0 +1,134 @@
+"""
+resolver.py
+
+Shared hostname resolution cache for PyBal
+"""
+
+from twisted.internet import defer, reactor
+from twisted.names import client, dns, error
+from twisted.python import failure
+
+from . import util
+
+import socket
+
+log = util.log
+
+
+class HostnameCache(object):
+    """
+    Cache of the addresses of server hostnames, shared by all services.
+    Positive answers are kept for their TTL and failed lookups (NXDOMAIN,
+    or no records of the requested type) for a fixed negative TTL.
+    Concurrent lookups of the same name are merged into one query, and the
+    number of queries in flight is bounded, so thousands of servers can be
+    initialized at once without flooding the resolvers.
+    """
+
+    TIMEOUT = (1, 2, 5)
+    MIN_TTL = 30
+    NEGATIVE_TTL = 60
+    CONCURRENCY = 32
+
+    resolver = None     # None means the default system resolver
+    entries = {}        # (hostname, family) -> (addresses, expiry time)
+    pending = {}        # (hostname, family) -> [Deferred, ...]
+    semaphore = defer.DeferredSemaphore(CONCURRENCY)
+    queries = 0
+    hits = 0
+
+    @classmethod
+    def configure(cls, concurrency=CONCURRENCY, negativeTTL=NEGATIVE_TTL, resolver=None):
+        """(Re)configures the cache, and drops its entries. Lookups in
+        flight are kept, and complete as usual."""
+
+        cls.semaphore = defer.DeferredSemaphore(concurrency)
+        cls.NEGATIVE_TTL = negativeTTL
+        cls.resolver = resolver
+        cls.entries = {}
+        cls.queries = cls.hits = 0
+
+    @classmethod
+    def lookup(cls, hostname, family, now=None):
+        """
+        Returns a Deferred that fires with a tuple (addresses, ttl) for
+        the addresses of the given family of hostname, and the number of
+        seconds they remain valid.
+        """
+
+        key = (hostname, family)
+        now = reactor.seconds() if now is None else now
+
+        try:
+            addresses, expires = cls.entries[key]
+        except KeyError:
+            pass
+        else:
+            if expires > now:
+                cls.hits += 1
+                return defer.succeed((addresses, expires - now))
+            del cls.entries[key]
+
+        d = defer.Deferred()
+        if key in cls.pending:
+            cls.pending[key].append(d)
+        else:
+            cls.pending[key] = [d]
+            cls.queries += 1
+            cls.semaphore.run(cls._query, hostname, family).addBoth(
+                cls._queryFinished, key, now)
+        return d
+
+    @classmethod
+    def _query(cls, hostname, family):
+        resolver = cls.resolver or client.getResolver()
+        if family == socket.AF_INET6:
+            return resolver.lookupIPV6Address(hostname, cls.TIMEOUT)
+        else:
+            return resolver.lookupAddress(hostname, cls.TIMEOUT)
+
+    @classmethod
+    def _queryFinished(cls, result, (hostname, family), now):
+        if isinstance(result, failure.Failure):
+            if result.check(error.DNSNameError):
+                addresses, ttl = frozenset(), cls.NEGATIVE_TTL
+            else:
+                # Transient errors are not cached
+                addresses, ttl = result, None
+        else:
+            addresses, ttl = cls.parseAnswers(result, hostname, family)
+
+        waiting = cls.pending.pop((hostname, family), [])
+        if ttl is None:
+            for d in waiting:
+                d.errback(addresses)
+        else:
+            cls.entries[(hostname, family)] = (addresses, now + ttl)
+            for d in waiting:
+                d.callback((addresses, ttl))
+
+    @classmethod
+    def parseAnswers(cls, (answers, authority, additional), hostname, family):
+        """
+        Returns a tuple (addresses, ttl) of the addresses of a hostname
+        in a DNS answer, and the lowest TTL among them.
+        """
+
+        recordType = (family == socket.AF_INET6) and dns.AAAA or dns.A
+        records = [r for r in answers
+                   if r.name == dns.Name(hostname) and r.type == recordType]
+        addresses = frozenset([intern(socket.inet_ntop(family, r.payload.address))
+                               for r in records])
+        if addresses:
+            return addresses, max(min(r.ttl for r in records), cls.MIN_TTL)
+        else:
+            return addresses, cls.NEGATIVE_TTL
+
+    @classmethod
+    def getStats(cls):
+        """Returns a dictionary of cache counters"""
+
+        return {'entries': len(cls.entries),
+                'pending': len(cls.pending),
+                'queries': cls.queries,
+                'hits': cls.hits}
@@ -0,0 +1,106 @@
+"""
+state.py
+
+Persistent server state snapshots for PyBal
+"""
+
+from twisted.internet import reactor, task
+
+from . import util
+
+import json, time
+
+log = util.log
+
+
+class StateFile(object):
+    """
+    Periodically writes the state of the servers of all Coordinators to a
+    local file, atomically, so that a restarted PyBal can seed its state
+    from it rather than from defaults.
+
+    The file is a JSON document:
+
+        {
+          "version": 1,
+          "timestamp": 1500000000.0,
+          "services": {
+            "text": {
+              "mw1001.eqiad.wmnet": {
+                "up": true, "pooled": true, "enabled": true, "weight": 10,
+                "monitors": {"ProxyFetch": {"up": true, "backoffSteps": 0}}
+              }
+            }
+          }
+        }
+    """
+
+    VERSION = 1
+    INTERVAL = 30
+    MAX_AGE = 3600
+
+    def __init__(self, path, interval=INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.coordinators = []
+        self.saveTask = task.LoopingCall(self.save)
+
+    def addCoordinator(self, coordinator):
+        """Includes a Coordinator's servers in the snapshots"""
+
+        self.coordinators.append(coordinator)
+
+    def start(self):
+        """Starts writing snapshots periodically, and on shutdown"""
+
+        self.saveTask.start(self.interval, now=False).addErrback(self.logError)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.save)
+
+    def logError(self, failure):
+        """Logs an error and keeps saving snapshots"""
+
+        log.err(failure, "Could not write state file {}".format(self.path))
+        if not self.saveTask.running:
+            self.saveTask.start(self.interval, now=False).addErrback(self.logError)
+
+    def dump(self):
+        """Returns the current state of all servers as a dictionary"""
+
+        return {
+            'version': self.VERSION,
+            'timestamp': time.time(),
+            'services': dict((crd.lvsservice.name, crd.snapshotState())
+                             for crd in self.coordinators)
+        }
+
+    def save(self):
+        """Writes a snapshot"""
+
+        util.atomicWrite(self.path, json.dumps(self.dump()))
+
+    @classmethod
+    def load(cls, path, maxAge=MAX_AGE, now=None):
+        """
+        Returns a dictionary mapping service names to the server states
+        saved in a snapshot file, or an empty dictionary if the file is
+        missing, invalid or older than maxAge seconds.
+        """
+
+        now = time.time() if now is None else now
+        try:
+            with open(path, 'rb') as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') != cls.VERSION:
+                raise ValueError("unsupported version %r" % snapshot.get('version'))
+            age = now - snapshot['timestamp']
+            services = snapshot['services']
+        except IOError:
+            return {}
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            log.warn("Ignoring invalid state file {}: {}".format(path, e))
+            return {}
+
+        if age > maxAge:
+            log.info("Ignoring state file {}, saved {:.0f}s ago".format(path, age))
+            return {}
+        return services
@@ -9,8 +9,11 @@
 import unittest
 
 import pybal.util
+import twisted.python.failure
 import twisted.test.proto_helpers
 import twisted.trial.unittest
+import twisted.web.client
+import twisted.web.http_headers
 from twisted.internet import defer
 
 
@@ -48,6 +51,7 @@ class StubCoordinator(object):
         self.up = None
         self.reason = None
         self.servers = {}
+        self.pooledDownServers = set()
 
     def resultUp(self, monitor):
         self.up = True
@@ -75,22 +79,34 @@ class StubLVSService(object):
 
 
 
-class MockClientGetPage(object):
-    def __init__(self, data):
-        self.return_value = data
+class MockResponse(object):
+    """Test stub for `twisted.web.iweb.IResponse`."""
 
-    def getPage(self, url):
-        d = defer.Deferred()
-        d.callback(self.return_value)
-        return d
+    def __init__(self, code=200, body='', headers=None):
+        self.code = code
+        self.phrase = 'Test'
+        self.body = body
+        self.headers = twisted.web.http_headers.Headers(headers or {})
 
-    def addErr(self, msg):
-        self.errMsg = ValueError(msg)
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(
+            twisted.python.failure.Failure(twisted.web.client.ResponseDone()))
 
-    def getPageError(self, url):
-        d = defer.Deferred()
-        d.errback(self.errMsg)
-        return d
+
+class MockAgent(object):
+    """Test stub for `twisted.web.client.Agent`."""
+
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        self.requests.append((method, uri, headers))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            return defer.fail(response)
+        return defer.succeed(response)
 
 
 class PyBalTestCase(twisted.trial.unittest.TestCase):
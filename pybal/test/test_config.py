@@ -8,13 +8,15 @@
 """
 import json
 import mock
-
+import os
 
 import pybal
 import pybal.config
 import pybal.etcd
 
-from .fixtures import PyBalTestCase, MockClientGetPage
+from twisted.internet import task
+
+from .fixtures import PyBalTestCase, MockAgent, MockResponse, StubCoordinator
 
 
 class DummyConfigurationObserver(pybal.config.ConfigurationObserver):
@@ -34,6 +36,121 @@ class ConfigurationObserverTestCase(PyBalTestCase):
             DummyConfigurationObserver
         )
 
+    def testDebounce(self):
+        """Test coalescing of configuration changes."""
+        configuration = pybal.util.ConfigDict({
+            'config-debounce': '0.5', 'config-debounce-max': '2'})
+        observer = pybal.config.ConfigurationObserver.fromUrl(
+            None, 'dummy://', configuration)
+        self.assertEquals((observer.debounce, observer.debounceMax), (0.5, 2))
+        observer.coordinator = mock.Mock()
+        clock = task.Clock()
+        with mock.patch('pybal.config.reactor', clock):
+            # Diffs are merged until the window passes without changes
+            observer.notifyConfigDiff(pybal.config.ConfigDiff(
+                added={'a': {'enabled': True}}))
+            clock.advance(0.4)
+            observer.notifyConfigDiff(pybal.config.ConfigDiff(
+                changed={'a': {'weight': 5}}, removed={'b'}))
+            clock.advance(0.4)
+            self.assertFalse(observer.coordinator.applyConfigDiff.called)
+            clock.advance(0.1)
+            observer.coordinator.applyConfigDiff.assert_called_once_with(
+                pybal.config.ConfigDiff(added={'a': {'enabled': True, 'weight': 5}},
+                                        removed={'b'}))
+            # A full configuration supersedes pending diffs
+            observer.notifyConfigDiff(pybal.config.ConfigDiff(removed={'a'}))
+            observer.notifyConfig({'c': {}})
+            observer.notifyConfigDiff(pybal.config.ConfigDiff(added={'d': {}}))
+            clock.advance(0.5)
+            observer.coordinator.onConfigUpdate.assert_called_once_with(
+                {'c': {}, 'd': {}})
+            self.assertEquals(observer.coordinator.applyConfigDiff.call_count, 1)
+            # A steady stream of changes is held back no longer than the max
+            for i in range(5):
+                observer.notifyConfig({'e': {'weight': i}})
+                clock.advance(0.45)
+            observer.coordinator.onConfigUpdate.assert_called_with(
+                {'e': {'weight': 4}})
+            self.assertEquals(observer.coordinator.onConfigUpdate.call_count, 2)
+            self.assertFalse(clock.getDelayedCalls())
+
+    def testNoDebounce(self):
+        """Test that changes are passed on right away by default."""
+        observer = DummyConfigurationObserver()
+        observer.coordinator = mock.Mock()
+        observer.notifyConfig({'a': {}})
+        observer.coordinator.onConfigUpdate.assert_called_once_with({'a': {}})
+        diff = pybal.config.ConfigDiff(removed={'a'})
+        observer.notifyConfigDiff(diff)
+        observer.coordinator.applyConfigDiff.assert_called_once_with(diff)
+
+
+class ConfigDiffTestCase(PyBalTestCase):
+    """Test case for `pybal.config.ConfigDiff`."""
+
+    def testCompute(self):
+        """Test `ConfigDiff.compute`."""
+        old = {
+            'a': {'enabled': True, 'weight': 10},
+            'b': {'enabled': True, 'weight': 10},
+            'c': {'enabled': True, 'weight': 10},
+        }
+        new = {
+            'a': {'enabled': True, 'weight': 10},
+            'b': {'enabled': False, 'weight': 10, 'fwmethod': 'g'},
+            'd': {'enabled': True, 'weight': 5},
+        }
+        diff = pybal.config.ConfigDiff.compute(old, new)
+        self.assertEquals(diff.added, {'d': {'enabled': True, 'weight': 5}})
+        self.assertEquals(diff.removed, {'c'})
+        self.assertEquals(diff.changed,
+                          {'b': {'enabled': False, 'fwmethod': 'g'}})
+        self.assertEquals(str(diff), '1 added, 1 changed, 1 removed')
+        self.assertFalse(pybal.config.ConfigDiff.compute(new, new))
+        self.assertEquals(pybal.config.ConfigDiff.compute(None, new).added,
+                          new)
+
+    def testApply(self):
+        """Test `ConfigDiff.apply`."""
+        old = {
+            'a': {'enabled': True, 'weight': 10},
+            'b': {'enabled': True, 'weight': 10},
+        }
+        new = {
+            'a': {'enabled': False, 'weight': 10},
+            'c': {'enabled': True, 'weight': 5},
+        }
+        config = dict(old)
+        pybal.config.ConfigDiff.compute(old, new).apply(config)
+        self.assertEquals(config, new)
+        # Unchanged host configurations are shared, not modified
+        self.assertEquals(old['a'], {'enabled': True, 'weight': 10})
+
+    def testMerge(self):
+        """Test `ConfigDiff.merge`."""
+        configs = [
+            {'a': {'enabled': True, 'weight': 10},
+             'b': {'enabled': True, 'weight': 10},
+             'c': {'enabled': True, 'weight': 10}},
+            {'a': {'enabled': False, 'weight': 10},
+             'c': {'enabled': True, 'weight': 10},
+             'd': {'enabled': True, 'weight': 5}},
+            {'a': {'enabled': False, 'weight': 20},
+             'b': {'enabled': True, 'weight': 1},
+             'e': {'enabled': True, 'weight': 5}},
+        ]
+        diff = pybal.config.ConfigDiff.compute(configs[0], configs[1])
+        diff.merge(pybal.config.ConfigDiff.compute(configs[1], configs[2]))
+        self.assertEquals(diff.added, {'e': {'enabled': True, 'weight': 5}})
+        self.assertEquals(diff.removed, {'c'})
+        self.assertEquals(diff.changed, {
+            'a': {'enabled': False, 'weight': 20},
+            'b': {'enabled': True, 'weight': 1}})
+        config = dict(configs[0])
+        diff.apply(config)
+        self.assertEquals(config, configs[2])
+
 
 class FileConfigurationObserverTestCase(PyBalTestCase):
     """Test case for `pybal.config.FileConfigurationObserver`."""
@@ -121,6 +238,233 @@ class FileConfigurationObserverTestCase(PyBalTestCase):
         self.flushLoggedErrors(KeyError)
 
 
+    def testReloadConfigDigest(self):
+        """Rewriting a file with the same contents doesn't parse it."""
+        self.observer.parseConfig = mock.MagicMock(return_value="some_config")
+        m = mock.mock_open(read_data="123")
+        with mock.patch('os.stat', side_effect=['stat1', 'stat2']), \
+                mock.patch('__builtin__.open', m, True):
+            self.observer.reloadConfig()
+            self.observer.reloadConfig()
+        self.assertEquals(self.observer.lastFileStat, 'stat2')
+        self.assertEquals(self.observer.parseConfig.call_count, 1)
+
+    def testParseLegacyLine(self):
+        """`FileConfigurationObserver.parseLegacyLine` agrees with
+        `ast.literal_eval` on the common shape, and leaves the rest to it."""
+        lines = [
+            "{'host': 'mw1200', 'weight': 10, 'enabled': True}",
+            "{ 'host':'mw1201','weight':0 , 'enabled':False, }",
+            '{"host": "mw1202", "fwmethod": "g", "weight": -1}',
+            "{}",
+        ]
+        for line in lines:
+            self.assertEquals(self.observer.parseLegacyLine(line),
+                              pybal.config.ast.literal_eval(line))
+        for line in ["{'host': 'mw1200', 'weight': 010}",
+                     "{'host': 'mw1200', 'weight': 1.5}",
+                     "{'host': 'mw\\'1200'}",
+                     "{'host': 'mw1200' 'weight': 1}",
+                     "{'host': 'mw1200', 'enabled': None}",
+                     "['mw1200']"]:
+            self.assertIsNone(self.observer.parseLegacyLine(line))
+        legacy_config = "{'host': 'mw1200', 'weight': 1.5, 'enabled': True}"
+        self.assertEquals(self.observer.parseLegacyConfig(legacy_config),
+                          {'mw1200': {'weight': 1.5, 'enabled': True}})
+
+    def testStartObserving(self):
+        """Watched files are only polled as a fallback."""
+        self.observer.reloadTask = mock.Mock()
+        with mock.patch.object(pybal.config.FileWatcher, 'watch',
+                               return_value=True):
+            self.observer.startObserving()
+        self.observer.reloadTask.start.assert_called_with(
+            self.observer.FALLBACK_INTERVAL)
+        with mock.patch.object(pybal.config.FileWatcher, 'watch',
+                               return_value=False):
+            self.observer.startObserving()
+        self.observer.reloadTask.start.assert_called_with(1)
+
+
+class ConfigCacheTestCase(PyBalTestCase):
+    """Test case for `pybal.config.ConfigCache`."""
+
+    url = 'http://example.com/pybal-config/example.json'
+
+    def setUp(self):
+        super(ConfigCacheTestCase, self).setUp()
+        directory = self.mktemp()
+        os.mkdir(directory)
+        self.patch(pybal.config.ConfigCache, 'directory', directory)
+
+    def testSaveLoad(self):
+        """Test `ConfigCache.save` and `ConfigCache.load`."""
+        ConfigCache = pybal.config.ConfigCache
+        self.assertEquals(ConfigCache.load(self.url), (None, None))
+        config = {'mw1200': {'enabled': True, 'weight': 10}}
+        ConfigCache.save(self.url, config, 42)
+        self.assertEquals(ConfigCache.load(self.url), (config, 42))
+        self.assertEquals(ConfigCache.load(self.url + '?other'), (None, None))
+        # Invalid caches are ignored
+        with open(ConfigCache.path(self.url), 'w') as f:
+            f.write('{"url": ')
+        self.assertEquals(ConfigCache.load(self.url), (None, None))
+
+    def testDisabled(self):
+        """Nothing is cached without a cache directory."""
+        self.patch(pybal.config.ConfigCache, 'directory', None)
+        pybal.config.ConfigCache.save(self.url, {})
+        self.assertEquals(pybal.config.ConfigCache.load(self.url), (None, None))
+
+    def testHttpConfigurationObserver(self):
+        """HTTP observers start from the cache, and update it."""
+        pybal.config.ConfigCache.save(self.url, {'mw1200': {'weight': 1}})
+        observer = pybal.config.HttpConfigurationObserver(
+            self.coordinator, self.url)
+        agent = MockAgent()
+        agent.responses = [ValueError('Unreachable'), MockResponse(
+            200, HttpConfigurationObserverTestCase.data)]
+        with mock.patch.object(observer, 'getAgent', return_value=agent), \
+                mock.patch('pybal.config.reactor', task.Clock()) as clock:
+            observer.debounce = 0.5
+            observer.startObserving()
+            # The cached configuration is debounced like any other
+            self.assertFalse(hasattr(self.coordinator, 'config'))
+            clock.advance(0.5)
+            self.assertEquals(self.coordinator.config, {'mw1200': {'weight': 1}})
+            clock.advance(1)
+            clock.advance(0.5)
+        config = json.loads(HttpConfigurationObserverTestCase.data)
+        self.assertEquals(self.coordinator.config, config)
+        self.assertEquals(pybal.config.ConfigCache.load(self.url), (config, None))
+        self.flushLoggedErrors(ValueError)
+
+
+class FileWatcherTestCase(PyBalTestCase):
+    """Test case for `pybal.config.FileWatcher`."""
+
+    def setUp(self):
+        super(FileWatcherTestCase, self).setUp()
+        self.patch(pybal.config.FileWatcher, 'observers', {})
+        self.patch(pybal.config.FileWatcher, 'directories', set())
+        self.patch(pybal.config.FileWatcher, 'notifier', mock.Mock())
+        self.patch(pybal.config.FileWatcher, 'events', 0)
+
+    def getObserver(self, path):
+        observer = mock.Mock(filePath=path)
+        self.assertTrue(pybal.config.FileWatcher.watch(observer))
+        return observer
+
+    def testWatch(self):
+        """Each directory is watched once, and events reach the observers
+        of the file."""
+        a = self.getObserver('/etc/pybal/pools/a')
+        b = self.getObserver('/etc/pybal/pools/b')
+        a2 = self.getObserver('/etc/pybal/pools/a')
+        notifier = pybal.config.FileWatcher.notifier
+        self.assertEquals(notifier.watch.call_count, 1)
+        self.assertEquals(notifier.watch.call_args[0][0].path,
+                          '/etc/pybal/pools')
+
+        callback = notifier.watch.call_args[1]['callbacks'][0]
+        path = pybal.config.filepath.FilePath('/etc/pybal/pools/a')
+        callback(None, path, 0)
+        self.assertTrue(a.onFileEvent.called)
+        self.assertTrue(a2.onFileEvent.called)
+        self.assertFalse(b.onFileEvent.called)
+        # Other files in the directory are ignored
+        callback(None, path.sibling('a.tmp'), 0)
+        self.assertEquals(a.onFileEvent.call_count, 1)
+        self.assertEquals(pybal.config.FileWatcher.getStats(),
+                          {'files': 2, 'directories': 1, 'events': 2})
+
+    def testWatchFailure(self):
+        """Files that can't be watched are polled instead."""
+        pybal.config.FileWatcher.notifier.watch.side_effect = OSError
+        self.assertFalse(pybal.config.FileWatcher.watch(
+            mock.Mock(filePath='/nonexistent/a')))
+        self.assertEquals(pybal.config.FileWatcher.observers, {})
+
+
+class MultiPoolConfigurationObserverTestCase(PyBalTestCase):
+    """Test case for `pybal.config.MultiPoolConfigurationObserver`."""
+
+    def setUp(self):
+        super(MultiPoolConfigurationObserverTestCase, self).setUp()
+        self.patch(pybal.config.PoolDocument, 'documents', {})
+        self.path = self.mktemp()
+        self.writeDocument({
+            'text': {'mw1200': {'enabled': True, 'weight': 10}},
+            'upload': {'cp1050': {'enabled': True, 'weight': 10}},
+        })
+
+    def writeDocument(self, document):
+        with open(self.path, 'w') as f:
+            json.dump(document, f)
+
+    def getObserver(self, pool, configuration=None):
+        coordinator = StubCoordinator()
+        coordinator.config = None
+        observer = pybal.config.ConfigurationObserver.fromUrl(
+            coordinator, 'pools://%s#%s' % (self.path, pool), configuration)
+        with mock.patch.object(pybal.config.FileWatcher, 'watch',
+                               return_value=True):
+            observer.startObserving()
+        return observer
+
+    def testOnDocumentUpdate(self):
+        """Pools get their own section of a shared document."""
+        text = self.getObserver('text')
+        upload = self.getObserver('upload')
+        missing = self.getObserver('missing')
+        document = pybal.config.PoolDocument.documents[self.path]
+        self.addCleanup(document.fileObserver.reloadTask.stop)
+        self.assertEquals(text.coordinator.config,
+                          {'mw1200': {'enabled': True, 'weight': 10}})
+        self.assertEquals(upload.coordinator.config,
+                          {'cp1050': {'enabled': True, 'weight': 10}})
+        self.assertIsNone(missing.coordinator.config)
+
+        # Only pools whose section changed are updated
+        upload.coordinator.config = None
+        self.writeDocument({
+            'text': {'mw1200': {'enabled': False, 'weight': 10}},
+            'upload': {'cp1050': {'enabled': True, 'weight': 10}},
+        })
+        document.fileObserver.reloadConfig()
+        self.assertEquals(text.coordinator.config,
+                          {'mw1200': {'enabled': False, 'weight': 10}})
+        self.assertIsNone(upload.coordinator.config)
+
+    def testDebounce(self):
+        """Changes to the document are debounced once for all pools."""
+        clock = task.Clock()
+        self.patch(pybal.config, 'reactor', clock)
+        text = self.getObserver('text', pybal.util.ConfigDict({
+            'config-debounce': '0.5'}))
+        upload = self.getObserver('upload', pybal.util.ConfigDict({
+            'config-debounce': '1'}))
+        document = pybal.config.PoolDocument.documents[self.path]
+        self.addCleanup(document.fileObserver.reloadTask.stop)
+        self.assertEquals(document.fileObserver.debounce, 1)
+        clock.advance(1)
+        self.assertIsNotNone(text.coordinator.config)
+
+        self.writeDocument({
+            'text': {'mw1200': {'enabled': False, 'weight': 10}},
+            'upload': {'cp1050': {'enabled': False, 'weight': 10}},
+        })
+        document.fileObserver.reloadConfig()
+        clock.advance(0.5)
+        self.assertEquals(text.coordinator.config,
+                          {'mw1200': {'enabled': True, 'weight': 10}})
+        clock.advance(0.5)
+        self.assertEquals(text.coordinator.config,
+                          {'mw1200': {'enabled': False, 'weight': 10}})
+        self.assertEquals(upload.coordinator.config,
+                          {'cp1050': {'enabled': False, 'weight': 10}})
+
+
 class HttpConfigurationObserverTestCase(PyBalTestCase):
     data = """
     {
@@ -139,20 +483,51 @@ class HttpConfigurationObserverTestCase(PyBalTestCase):
 
     def testReloadConfig(self):
         """Test `HttpConfigurationObserver.reloadConfig`"""
-        m = MockClientGetPage(self.data)
-        with mock.patch('twisted.web.client.getPage', m.getPage):
+        agent = MockAgent()
+        agent.responses.append(MockResponse(200, self.data, {'ETag': ['"1"']}))
+        with mock.patch.object(self.observer, 'getAgent', return_value=agent):
             self.observer.reloadConfig()
         self.assertEquals(self.coordinator.config, json.loads(self.data))
+        self.assertEquals(self.observer.etag, '"1"')
 
-        errMsg = 'Hamsters!'
-        m.addErr(errMsg)
-        self.observer.logError = mock.MagicMock()
-        with mock.patch('twisted.web.client.getPage', m.getPageError):
+        # Unchanged configurations are not fetched again
+        self.coordinator.config = None
+        agent.responses.append(MockResponse(304))
+        with mock.patch.object(self.observer, 'getAgent', return_value=agent):
             self.observer.reloadConfig()
-        # Configuration hasn't changed
-        self.assertEquals(self.coordinator.config, json.loads(self.data))
-        # Error was logged
-        self.assertTrue(self.observer.logError.called)
+        headers = agent.requests[-1][2]
+        self.assertEquals(headers.getRawHeaders('If-None-Match'), ['"1"'])
+        self.assertIsNone(self.coordinator.config)
+
+        # Errors fail the Deferred
+        agent.responses.append(MockResponse(500, 'Hamsters!'))
+        with mock.patch.object(self.observer, 'getAgent', return_value=agent):
+            d = self.observer.reloadConfig()
+        self.failureResultOf(d, pybal.config.error.Error)
+        self.assertIsNone(self.coordinator.config)
+
+    def testBackoff(self):
+        """Failed fetches are retried with backoff."""
+        clock = task.Clock()
+        agent = MockAgent()
+        agent.responses = [ValueError('Hamsters!')] * 3 + [
+            MockResponse(200, self.data)]
+        with mock.patch.object(self.observer, 'getAgent', return_value=agent), \
+                mock.patch('pybal.config.reactor', clock), \
+                mock.patch('random.random', return_value=0):
+            self.observer.startObserving()
+            self.assertEquals(len(agent.requests), 1)
+            clock.advance(1)
+            self.assertEquals(len(agent.requests), 2)
+            clock.advance(1)
+            self.assertEquals(len(agent.requests), 2)
+            clock.advance(1)
+            self.assertEquals(len(agent.requests), 3)
+            clock.advance(4)
+            self.assertEquals(len(agent.requests), 4)
+            self.assertEquals(self.coordinator.config, json.loads(self.data))
+            self.assertEquals(self.observer.backoff.failures, 0)
+        self.flushLoggedErrors(ValueError)
 
     def testOnConfigReceived(self):
         """Test `HttpConfigurationObserver.OnConfigReceived`"""
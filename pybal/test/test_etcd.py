@@ -10,12 +10,16 @@
 import copy
 import json
 import mock
+import os
 import urlparse
 
 import pybal
 import pybal.config
 import pybal.etcd
-from .fixtures import PyBalTestCase
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from .fixtures import PyBalTestCase, StubCoordinator
 
 
 class EtcdConfigurationObserverTestCase(PyBalTestCase):
@@ -35,27 +39,6 @@ class EtcdConfigurationObserverTestCase(PyBalTestCase):
         self.assertEquals(obs.key, '/config/text')
         self.assertEquals(obs.waitIndex, None)
 
-    def testGetPath(self):
-        self.assertEquals(self.observer.getPath(),
-                          '/v2/keys/config/text?recursive=true')
-        self.observer.waitIndex = 4
-        url = urlparse.urlparse(self.observer.getPath())
-        self.assertEquals(url.path, '/v2/keys/config/text')
-        self.assertDictEqual(dict(urlparse.parse_qsl(url.query)),
-                             {'wait': 'true', 'waitIndex': '4',
-                              'recursive': 'true' })
-
-    def testGetMaxModifiedIndex(self):
-        nodes = {
-            'modifiedIndex': 40,
-            'nodes': [
-                {'modifiedIndex': 4},
-                {'modifiedIndex': 3},
-                {'modifiedIndex': 15},
-            ]
-        }
-        self.assertEquals(40, self.observer.getMaxModifiedIndex(nodes))
-
     def testOnUpdate(self):
         create = {
             "action":"set",
@@ -100,39 +83,45 @@ class EtcdConfigurationObserverTestCase(PyBalTestCase):
                 "createdIndex": 12
             }
         }
-        self.observer.coordinator.onConfigUpdate = mock.MagicMock()
+        ConfigDiff = pybal.config.ConfigDiff
+        coordinator = self.observer.coordinator
+        coordinator.onConfigUpdate = mock.MagicMock()
+        coordinator.applyConfigDiff = mock.MagicMock()
         self.observer.lastConfig = {}
         # Add a node
-        self.observer.onUpdate(create, 0)
-        self.observer.coordinator.onConfigUpdate.assert_called_with({'1': {'enabled': True, u'weight': 10}})
+        self.observer.onFullRead(create, 0)
+        coordinator.onConfigUpdate.assert_called_with({'1': {'enabled': True, u'weight': 10}})
         # Add another one
         self.observer.onUpdate(create_another, 11)
-        self.observer.coordinator.onConfigUpdate.assert_called_with(
-            {'1': {'enabled': True, u'weight': 10},
-             '2': {'enabled': True, u'weight': 10}}
-        )
+        coordinator.applyConfigDiff.assert_called_with(
+            ConfigDiff(added={'2': {'enabled': True, u'weight': 10}}))
+        self.assertEquals(self.observer.waitIndex, 12)
 
         # Depool a server
         self.observer.onUpdate(depool, 12)
-        self.observer.coordinator.onConfigUpdate.assert_called_with(
-            {'1': {'enabled': False, u'weight': 10},
-             '2': {'enabled': True, u'weight': 10}}
-        )
+        coordinator.applyConfigDiff.assert_called_with(
+            ConfigDiff(changed={'1': {'enabled': False}}))
 
         # Set it to inactive
         self.observer.onUpdate(inactive, 12)
-        self.observer.coordinator.onConfigUpdate.assert_called_with(
-            {'2': {'enabled': True, u'weight': 10}}
-        )
+        coordinator.applyConfigDiff.assert_called_with(
+            ConfigDiff(removed={'1'}))
 
         # repool it
         self.observer.onUpdate(create, 11)
 
         # Delete a server
         self.observer.onUpdate(delete, 13)
-        self.observer.coordinator.onConfigUpdate.assert_called_with(
-            {'2': {'enabled': True, u'weight': 10}}
-        )
+        coordinator.applyConfigDiff.assert_called_with(
+            ConfigDiff(removed={'1'}))
+        self.assertEquals(self.observer.lastConfig,
+                          {'2': {'enabled': True, u'weight': 10}})
+        self.assertEquals(coordinator.onConfigUpdate.call_count, 1)
+
+        # Events that change nothing are not passed on
+        coordinator.applyConfigDiff.reset_mock()
+        self.observer.onUpdate(delete, 13)
+        self.assertFalse(coordinator.applyConfigDiff.called)
 
 
 class EtcdClientTestCase(PyBalTestCase):
@@ -141,10 +130,8 @@ class EtcdClientTestCase(PyBalTestCase):
         super(EtcdClientTestCase, self).setUp()
         self.protocol = pybal.etcd.EtcdClient()
         # mock factory
-        self.protocol.factory = pybal.etcd.EtcdConfigurationObserver(
-            self.coordinator,
-            'etcd://example.com/config/text'
-        )
+        self.protocol.factory = pybal.etcd.EtcdSession('example.com', 2379)
+        self.protocol.factory.key = '/config/text'
         self.protocol.factory.onFailure =  mock.MagicMock()
         # mock transport
         self.protocol.transport = mock.MagicMock()
@@ -181,3 +168,256 @@ class EtcdClientTestCase(PyBalTestCase):
         self.protocol.handleStatus('1.1', '200', 'OK')
         self.protocol.handleResponse(resp)
         self.protocol.factory.onUpdate.assert_called_with(json.loads(resp), 0)
+
+    def testStreamingWatch(self):
+        """Watch events are decoded as they arrive, on one connection."""
+        self.protocol.factory.onUpdate = mock.MagicMock()
+        self.protocol.factory.waitIndex = 5
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.assertIn('stream=true', self.protocol.transport.value())
+        self.protocol.transport.clear()
+
+        events = [{'action': 'set', 'node': {'key': '/testdir/%d' % i,
+                                             'modifiedIndex': 5 + i}}
+                  for i in range(3)]
+        data = ''.join(json.dumps(event) + '\n' for event in events)
+        self.protocol.dataReceived(
+            'HTTP/1.1 200 OK\r\n'
+            'X-Etcd-Index: 4\r\n'
+            'Transfer-Encoding: chunked\r\n\r\n')
+        # The first event and a half arrive in one chunk
+        split = data.index('\n') + 10
+        for chunk in (data[:split], data[split:]):
+            self.protocol.dataReceived('%x\r\n%s\r\n' % (len(chunk), chunk))
+            if chunk is data[:split]:
+                self.protocol.factory.onUpdate.assert_called_once_with(
+                    events[0], 4)
+        self.assertEquals([c[0][0] for c in
+                           self.protocol.factory.onUpdate.call_args_list],
+                          events)
+        self.assertEquals(self.protocol.transport.value(), '')
+
+        # When etcd ends the watch, it is re-issued on the same connection
+        self.protocol.dataReceived('0\r\n\r\n')
+        self.assertTrue(self.protocol.transport.value().startswith(
+            'GET /v2/keys/config/text?'))
+        self.assertFalse(self.protocol.transport.disconnecting)
+        self.assertFalse(self.protocol.factory.onFailure.called)
+
+    def testPersistentConnection(self):
+        """The watch follows the initial GET on the same connection."""
+        self.protocol.factory.onUpdate = mock.MagicMock(
+            side_effect=lambda update, index: setattr(
+                self.protocol.factory, 'waitIndex', index + 1))
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.assertNotIn('wait=true', self.protocol.transport.value())
+        self.protocol.transport.clear()
+        body = '{"action":"get","node":{"key":"/config/text","dir":true}}'
+        self.protocol.dataReceived(
+            'HTTP/1.1 200 OK\r\n'
+            'X-Etcd-Index: 7\r\n'
+            'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        self.protocol.factory.onUpdate.assert_called_once_with(
+            json.loads(body), 7)
+        self.assertIn('waitIndex=8', self.protocol.transport.value())
+        self.assertFalse(self.protocol.transport.disconnecting)
+
+    def testEventIndexCleared(self):
+        """A compacted watch index is recovered from with a full read."""
+        self.protocol.factory.waitIndex = 5
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.protocol.transport.clear()
+        body = json.dumps({'errorCode': 401, 'index': 2000,
+                           'message': 'The event in requested index is '
+                                      'outdated and cleared'})
+        self.protocol.dataReceived(
+            'HTTP/1.1 400 Bad Request\r\n'
+            'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        self.assertIsNone(self.protocol.factory.waitIndex)
+        request = self.protocol.transport.value()
+        self.assertTrue(request.startswith(
+            'GET /v2/keys/config/text?recursive=true HTTP/1.1'))
+        self.assertFalse(self.protocol.factory.onFailure.called)
+
+
+class EtcdSessionTestCase(PyBalTestCase):
+    """Test case for `pybal.etcd.EtcdSession`."""
+
+    tree = {
+        'action': 'get',
+        'node': {'key': '/pools', 'dir': True, 'nodes': [
+            {'key': '/pools/text', 'dir': True, 'nodes': [
+                {'key': '/pools/text/mw1', 'modifiedIndex': 3,
+                 'value': '{"pooled": "yes", "weight": 10}'},
+            ]},
+            {'key': '/pools/upload', 'dir': True, 'nodes': [
+                {'key': '/pools/upload/cp1', 'modifiedIndex': 4,
+                 'value': '{"pooled": "yes", "weight": 10}'},
+            ]},
+        ]}
+    }
+
+    def setUp(self):
+        super(EtcdSessionTestCase, self).setUp()
+        self.patch(pybal.etcd.EtcdSession, 'sessions', {})
+        self.clock = task.Clock()
+        self.patch(pybal.etcd, 'reactor', self.clock)
+        self.patch(pybal.config, 'reactor', self.clock)
+        self.patch(pybal.config.ConfigCache, 'pending', {})
+        self.patch(pybal.config.ConfigCache, 'saveCall', None)
+
+    def getObserver(self, key):
+        observer = pybal.etcd.EtcdConfigurationObserver(
+            StubCoordinator(), 'etcd://example.com%s' % key)
+        observer.coordinator.applyConfigDiff = mock.Mock()
+        observer.startObserving()
+        return observer
+
+    def testGetPath(self):
+        session = pybal.etcd.EtcdSession('example.com', 2379)
+        session.key = '/config/text'
+        self.assertEquals(session.getPath(),
+                          '/v2/keys/config/text?recursive=true')
+        session.waitIndex = 4
+        url = urlparse.urlparse(session.getPath())
+        self.assertEquals(url.path, '/v2/keys/config/text')
+        self.assertDictEqual(dict(urlparse.parse_qsl(url.query)),
+                             {'wait': 'true', 'waitIndex': '4',
+                              'recursive': 'true', 'stream': 'true'})
+
+    def testCommonPrefix(self):
+        commonPrefix = pybal.etcd.EtcdSession.commonPrefix
+        self.assertEquals(commonPrefix(['/pools/text']), '/pools/text')
+        self.assertEquals(commonPrefix(['/pools/text', '/pools/text2/']),
+                          '/pools')
+        self.assertEquals(commonPrefix(['/a/b', '/c/d']), '/')
+
+    def testRouting(self):
+        """One session watches the common prefix for all pools."""
+        text = self.getObserver('/pools/text')
+        upload = self.getObserver('/pools/upload')
+        session = pybal.etcd.EtcdSession.sessions[('example.com', 2379)]
+        self.assertIsNone(session.connector)
+        with mock.patch.object(self.clock, 'connectSSL', create=True) as connectSSL:
+            self.clock.advance(0)
+        self.assertEquals(connectSSL.call_count, 1)
+        self.assertEquals(session.key, '/pools')
+
+        session.onUpdate(self.tree, 10)
+        self.assertEquals(text.coordinator.config,
+                          {'mw1': {'enabled': True, u'weight': 10}})
+        self.assertEquals(upload.coordinator.config,
+                          {'cp1': {'enabled': True, u'weight': 10}})
+
+        event = {'action': 'set', 'node': {
+            'key': '/pools/upload/cp2', 'modifiedIndex': 11,
+            'value': '{"pooled": "no", "weight": 5}'}}
+        session.onUpdate(event, 10)
+        self.assertEquals(session.waitIndex, 12)
+        self.assertFalse(text.coordinator.applyConfigDiff.called)
+        upload.coordinator.applyConfigDiff.assert_called_once_with(
+            pybal.config.ConfigDiff(added={'cp2': {'enabled': False,
+                                                   u'weight': 5}}))
+        # Events of unobserved keys only advance the index
+        event['node'].update(key='/pools/other/x', modifiedIndex=12)
+        session.onUpdate(event, 10)
+        self.assertEquals(session.waitIndex, 13)
+        self.assertEquals(upload.coordinator.applyConfigDiff.call_count, 1)
+
+    def testBadValue(self):
+        """A malformed value only affects the pool it belongs to."""
+        text = self.getObserver('/pools/text')
+        upload = self.getObserver('/pools/upload')
+        text.lastConfig = {'mw0': {'enabled': True}}
+        session = pybal.etcd.EtcdSession.sessions[('example.com', 2379)]
+        with mock.patch.object(self.clock, 'connectSSL', create=True):
+            self.clock.advance(0)
+        tree = copy.deepcopy(self.tree)
+        tree['node']['nodes'][0]['nodes'][0]['value'] = '{"pooled": '
+        session.onUpdate(tree, 10)
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEquals(upload.coordinator.config,
+                          {'cp1': {'enabled': True, u'weight': 10}})
+        self.assertEquals(session.waitIndex, 11)
+
+        # A later event of the pool is still applied as a change
+        event = {'action': 'set', 'node': {
+            'key': '/pools/text/mw1', 'modifiedIndex': 11,
+            'value': '{"pooled": "yes", "weight": 10}'}}
+        session.onUpdate(event, 11)
+        text.coordinator.applyConfigDiff.assert_called_once_with(
+            pybal.config.ConfigDiff(added={'mw1': {'enabled': True, u'weight': 10}}))
+        self.assertEquals(text.lastConfig, {'mw0': {'enabled': True},
+                                            'mw1': {'enabled': True, u'weight': 10}})
+
+    def testResumeFromCache(self):
+        """Observers start from their cached configuration, and the
+        session watches from the oldest cached index."""
+        directory = self.mktemp()
+        os.mkdir(directory)
+        self.patch(pybal.config.ConfigCache, 'directory', directory)
+        pybal.config.ConfigCache.save('etcd://example.com/pools/text',
+                                      {'mw1': {'enabled': True}}, 8)
+        pybal.config.ConfigCache.save('etcd://example.com/pools/upload',
+                                      {'cp1': {'enabled': True}}, 12)
+        text = self.getObserver('/pools/text')
+        upload = self.getObserver('/pools/upload')
+        self.assertEquals(text.coordinator.config, {'mw1': {'enabled': True}})
+        session = pybal.etcd.EtcdSession.sessions[('example.com', 2379)]
+        with mock.patch.object(self.clock, 'connectSSL', create=True):
+            self.clock.advance(0)
+        self.assertEquals(session.waitIndex, 8)
+
+        # Events already in a cached configuration are skipped
+        event = {'action': 'set', 'node': {
+            'key': '/pools/upload/cp1', 'modifiedIndex': 10,
+            'value': '{"pooled": "no"}'}}
+        session.onUpdate(event, 10)
+        self.assertFalse(upload.coordinator.applyConfigDiff.called)
+        event['node'].update(key='/pools/text/mw1')
+        session.onUpdate(event, 10)
+        text.coordinator.applyConfigDiff.assert_called_once_with(
+            pybal.config.ConfigDiff(changed={'mw1': {'enabled': False}}))
+
+        # The cache is written once for a burst of events
+        event['node'].update(modifiedIndex=11, value='{"pooled": "yes"}')
+        session.onUpdate(event, 11)
+        with mock.patch.object(pybal.config.ConfigCache, 'save') as save:
+            self.clock.advance(pybal.config.ConfigCache.SAVE_INTERVAL)
+        save.assert_called_once_with(text.configUrl, {'mw1': {'enabled': True}}, 12)
+        self.assertEquals(pybal.config.ConfigCache.pending, {})
+
+
+class EtcdHealthTestCase(PyBalTestCase):
+    """Test case for `pybal.etcd.EtcdHealth`."""
+
+    def setUp(self):
+        super(EtcdHealthTestCase, self).setUp()
+        self.patch(pybal.etcd.EtcdHealth, 'clusters', {})
+        self.clock = task.Clock()
+        self.patch(pybal.etcd, 'reactor', self.clock)
+
+    def testReconnectBackoff(self):
+        """Reconnects back off while the cluster is down."""
+        session = pybal.etcd.EtcdSession('example.com', 2379)
+        self.assertIs(session.health,
+                      pybal.etcd.EtcdHealth.get('example.com', 2379))
+        connector = mock.Mock()
+        reason = failure.Failure(error.ConnectionRefusedError())
+        with mock.patch('random.random', return_value=0):
+            session.clientConnectionFailed(connector, reason)
+            session.clientConnectionFailed(connector, reason)
+        self.assertFalse(session.health.healthy)
+        self.assertEquals([call.getTime() for call in self.clock.getDelayedCalls()],
+                          [1, 2])
+        self.clock.advance(1)
+        self.assertEquals(connector.connect.call_count, 1)
+
+        # A response resets the backoff
+        session.onResponding()
+        self.assertTrue(session.health.healthy)
+        self.assertEquals(session.health.backoff.failures, 0)
+        # A healthy connection that was closed is reconnected right away
+        connector.reset_mock()
+        session.clientConnectionLost(connector, reason)
+        self.assertTrue(connector.connect.called)
@@ -15,7 +15,7 @@ from twisted.web.server import Site
 from twisted.test import proto_helpers
 from .fixtures import PyBalTestCase, ServerStub
 from pybal.instrumentation import Resp404, ServerRoot, PoolsRoot
-from pybal.instrumentation import PoolServers, PoolServer, Alerts
+from pybal.instrumentation import PoolServers, PoolServer, Alerts, Metrics
 
 
 class WebBaseTestCase(PyBalTestCase):
@@ -106,6 +106,24 @@ class AlertsTestCase(WebBaseTestCase):
                           r.render_GET(self.request))
 
 
+class MetricsTestCase(WebBaseTestCase):
+    """Test case for `pybal.instrumentation.Metrics`"""
+    path = '/metrics'
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        Metrics.addSource('test', lambda: {'a': 1, 'b': {'c': 2}})
+        self.addCleanup(Metrics.removeSource, 'test')
+
+    def test_render(self):
+        """Test case for `Metrics.render_GET`"""
+        r = Metrics()
+        self.assertEquals(json.loads(r.render_GET(self.request))['test'],
+                          {'a': 1, 'b': {'c': 2}})
+        self.request.requestHeaders.getRawHeaders.return_value = 'text/http'
+        self.assertIn("test.a: 1\ntest.b.c: 2\n", r.render_GET(self.request))
+
+
 class PoolsRootTestCase(WebBaseTestCase):
     """Test case for `pybal.instrumentation.PoolsRoot`"""
     path = '/pools'
@@ -157,6 +175,15 @@ class PoolServerTestCase(WebBaseTestCase):
         resp = json.loads(r.render_GET(self.request))
         self.assertEquals(resp, {u'pooled': True, u'up': True, u'weight': 10})
 
+    def test_render_POST(self):
+        """Test case for `PoolServer.render_POST`"""
+        server = self.coordinators[0].servers['mw1001']
+        server.recheck = mock.MagicMock()
+        r = PoolServer(server)
+        resp = json.loads(r.render_POST(self.request))
+        self.assertEquals(resp, {u'recheck': True})
+        server.recheck.assert_called_once_with()
+
 
 class SiteTest(WebBaseTestCase):
 
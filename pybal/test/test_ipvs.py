@@ -157,6 +157,39 @@ class LVSServiceTestCase(PyBalTestCase):
             ['-d -t 127.0.0.1:80 -r %s' % s for s in 'abc']
         )
 
+    def testUpdateServers(self):
+        """Test `LVSService.updateServers`."""
+        lvs_service = pybal.ipvs.LVSService('http', self.service, self.config)
+        servers = dict((host, ServerStub(host)) for host in 'abcd')
+        for server in servers.values():
+            server.fwmethod = 'g'
+        lvs_service.servers = {servers['a'], servers['b']}
+        servers['a'].pooled = True
+        servers['c'].pooled = True
+        lvs_service.ipvsManager.cmdList = None
+        lvs_service.updateServers(servers.values())
+        self.assertEquals(
+            sorted(lvs_service.ipvsManager.cmdList),
+            ['-a -t 127.0.0.1:80 -r c -g',
+             '-d -t 127.0.0.1:80 -r b',
+             '-e -t 127.0.0.1:80 -r a -g'])
+        self.assertEquals(lvs_service.servers, {servers['a'], servers['c']})
+        # Nothing to change means no ipvsadm invocation
+        lvs_service.ipvsManager.cmdList = None
+        lvs_service.updateServers([servers['d']])
+        self.assertIsNone(lvs_service.ipvsManager.cmdList)
+
+    def testChangeServerIP(self):
+        """Test `LVSService.changeServerIP`."""
+        lvs_service = pybal.ipvs.LVSService('http', self.service, self.config)
+        server = ServerStub('a', '10.0.0.2')
+        server.fwmethod = 'g'
+        lvs_service.changeServerIP(server, '10.0.0.1')
+        self.assertEquals(lvs_service.ipvsManager.cmdList,
+                          ['-d -t 127.0.0.1:80 -r 10.0.0.1',
+                           '-a -t 127.0.0.1:80 -r 10.0.0.2 -g'])
+        self.assertEquals(server.ip, '10.0.0.2')
+
     def testAddServer(self):
         """Test `LVSService.addServer`."""
         lvs_service = pybal.ipvs.LVSService('http', self.service, self.config)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.journal`.
+
+"""
+import errno
+import os
+import shutil
+import tempfile
+
+import mock
+
+from pybal.journal import Journal
+
+from .fixtures import PyBalTestCase
+
+
+class JournalTestCase(PyBalTestCase):
+    """Test case for `pybal.journal.Journal`."""
+
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'journal')
+        self.addCleanup(Journal.configure, None)
+
+    def read(self, path=None):
+        with open(path or self.path, 'rb') as f:
+            return list(Journal.read(f))
+
+    def testRecord(self):
+        """Records read back in order."""
+        Journal.record(Journal.IPVS, ['-C'])    # Not enabled yet
+        Journal.configure(self.path)
+        Journal.record(Journal.RESULT, ['test', 'mw1001', 'ProxyFetch', False, 'timeout'], now=1.5)
+        Journal.record(Journal.IPVS, ['-d -t 10.0.0.1:80 -r mw1001'], now=2)
+        self.assertEquals(self.read(), [
+            (1.5, Journal.RESULT, ['test', 'mw1001', 'ProxyFetch', False, 'timeout']),
+            (2.0, Journal.IPVS, ['-d -t 10.0.0.1:80 -r mw1001'])])
+        self.assertEquals(Journal.getStats(), {'records': 2})
+
+    def testTruncated(self):
+        """A truncated last record is skipped."""
+        Journal.configure(self.path)
+        Journal.record(Journal.IPVS, ['-C'], now=1)
+        Journal.record(Journal.IPVS, ['-C'], now=2)
+        Journal.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        self.assertEquals(self.read(), [(1.0, Journal.IPVS, ['-C'])])
+
+    def testRotate(self):
+        """The journal is rotated when it grows too large."""
+        Journal.configure(self.path, maxBytes=100, backups=2)
+        for i in range(20):
+            Journal.record(Journal.TRANSITION, ['test', 'mw%04d' % i, 'up', True], now=i)
+        self.assertItemsEqual(os.listdir(self.directory),
+                              ['journal', 'journal.1', 'journal.2'])
+        records = (self.read(self.path + '.2') + self.read(self.path + '.1') +
+                   self.read())
+        timestamps = [r[0] for r in records]
+        self.assertEquals(timestamps, range(20 - len(timestamps), 20))
+
+    def testWriteError(self):
+        """Journaling stops at the first write error."""
+        Journal.configure(self.path)
+        Journal.record(Journal.IPVS, ['-C'], now=1)
+        Journal.file.close()
+        Journal.file = mock.Mock()
+        Journal.file.write.side_effect = IOError(errno.ENOSPC, 'No space left on device')
+        Journal.record(Journal.IPVS, ['-C'], now=2)
+        self.assertIsNone(Journal.file)
+        Journal.record(Journal.IPVS, ['-C'], now=3)
+        self.assertEquals(self.read(), [(1.0, Journal.IPVS, ['-C'])])
+        self.assertEquals(Journal.getStats(), {'records': 1})
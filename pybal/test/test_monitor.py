@@ -6,23 +6,36 @@
   This module contains tests for `pybal.monitor`.
 
 """
+import errno
+import gc
 import unittest
 
+import mock
+
 import pybal.monitor
 import pybal.util
 import twisted.internet
+import twisted.internet.error
+import twisted.internet.task
+import twisted.python.failure
+from pybal.monitors.idleconnection import IdleConnectionMonitoringProtocol
+from pybal.monitors.proxyfetch import ProxyFetchMonitoringProtocol
+from pybal.pybal import Server
 
 from .fixtures import PyBalTestCase
 
 
+class TestMonitoringProtocol(pybal.monitor.MonitoringProtocol):
+    __name__ = 'TestMonitor'
+    __slots__ = ()
+
+
 class MonitoringProtocolTestCase(PyBalTestCase):
     """Test case for `pybal.monitor.MonitoringProtocol`."""
 
     def setUp(self):
         super(MonitoringProtocolTestCase, self).setUp()
-        self.monitor = pybal.monitor.MonitoringProtocol(
-            self.coordinator, None, self.config)
-        self.monitor.__name__ = 'TestMonitor'
+        self.monitor = TestMonitoringProtocol(self.coordinator, None, self.config)
         self.reactor = twisted.internet.reactor
 
     def testRun(self):
@@ -72,6 +85,72 @@ class MonitoringProtocolTestCase(PyBalTestCase):
         self.monitor._resultDown()
         self.assertIsNone(self.coordinator.up)
 
+    def testInitPriority(self):
+        """`MonitoringProtocol.__init__` validates the probe priority."""
+        self.assertEquals(self.monitor.priority, 'normal')
+        self.config['probe-priority'] = 'critical'
+        monitor = pybal.monitor.MonitoringProtocol(
+            self.coordinator, None, self.config)
+        self.assertEquals(monitor.priority, 'critical')
+        self.config['probe-priority'] = 'urgent'
+        with self.assertRaises(ValueError):
+            pybal.monitor.MonitoringProtocol(
+                self.coordinator, None, self.config)
+
+    def testScheduleCheck(self):
+        """`MonitoringProtocol._scheduleCheck` defers to the probe budget."""
+        clock = twisted.internet.task.Clock()
+        self.monitor.reactor = clock
+        check = mock.MagicMock()
+        pybal.monitor.ProbeBudget.configure(1, 1, clock.seconds())
+        self.addCleanup(pybal.monitor.ProbeBudget.configure, 0)
+
+        self.monitor._scheduleCheck(10, check)
+        clock.advance(10)
+        self.assertEquals(check.call_count, 1)
+        # The budget is exhausted now
+        self.monitor._scheduleCheck(0, check)
+        clock.advance(0)
+        self.assertEquals(check.call_count, 1)
+        self.assertTrue(self.monitor.checkCall.active())
+        clock.advance(1)
+        self.assertEquals(check.call_count, 2)
+
+    def testBackoff(self):
+        """Checks back off exponentially while the monitor is down."""
+        self.config['testmonitor.backoff-factor'] = '2'
+        self.config['testmonitor.backoff-max'] = '50'
+        self.monitor = TestMonitoringProtocol(self.coordinator, None, self.config)
+        clock = twisted.internet.task.Clock()
+        self.monitor.reactor = clock
+        self.monitor.run()
+        self.assertEquals(self.monitor.backoffFactor, 2)
+
+        intervals = []
+        for i in range(5):
+            self.monitor._resultDown()
+            intervals.append(self.monitor._backoffInterval(10))
+        self.assertEquals(intervals, [20, 40, 50, 50, 50])
+        # Resets as soon as the monitor is up again
+        self.monitor._resultUp()
+        self.assertEquals(self.monitor._backoffInterval(10), 10)
+
+    def testRecheck(self):
+        """Test `MonitoringProtocol.recheck`."""
+        self.config['testmonitor.backoff-factor'] = '3'
+        self.monitor = TestMonitoringProtocol(self.coordinator, None, self.config)
+        clock = twisted.internet.task.Clock()
+        self.monitor.reactor = clock
+        self.monitor.run()
+        self.monitor._resultDown()
+        check = mock.MagicMock()
+        self.monitor._scheduleCheck(10, check)
+        self.assertEquals(self.monitor.checkCall.getTime(), 30)
+        self.monitor.recheck()
+        self.assertEquals(self.monitor.backoffSteps, 0)
+        clock.advance(0)
+        check.assert_called_once_with()
+
     def testGetConfigString(self):
         """Test `MonitoringProtocol._getConfigString`."""
         self.config['testmonitor.strValue'] = 'abc'
@@ -81,6 +160,11 @@ class MonitoringProtocolTestCase(PyBalTestCase):
         with self.assertRaises(ValueError):
             self.monitor._getConfigString('badStrValue')
 
+    def testGetConfigFloat(self):
+        """Test `MonitoringProtocol._getConfigFloat`."""
+        self.config['testmonitor.floatValue'] = '1.5'
+        self.assertEquals(self.monitor._getConfigFloat('floatValue'), 1.5)
+
     def testGetConfigInt(self):
         """Test `MonitoringProtocol._getConfigInt`."""
         self.config['testmonitor.intValue'] = 123
@@ -91,6 +175,21 @@ class MonitoringProtocolTestCase(PyBalTestCase):
         self.config['testmonitor.boolValue'] = 'false'
         self.assertFalse(self.monitor._getConfigBool('boolValue'))
 
+    def testGetConfigCached(self):
+        """Typed options are parsed once per service configuration."""
+        self.config['testmonitor.intValue'] = '123'
+        self.config['testmonitor.boolValue'] = 'yes'
+        self.assertEquals(self.monitor._getConfigInt('intValue'), 123)
+        self.assertTrue(self.monitor._getConfigBool('boolValue'))
+        # Bypass the cache invalidation of ConfigDict
+        dict.__setitem__(self.config, 'testmonitor.intValue', 'invalid')
+        dict.__setitem__(self.config, 'testmonitor.boolValue', 'invalid')
+        self.assertEquals(self.monitor._getConfigInt('intValue'), 123)
+        self.assertTrue(self.monitor._getConfigBool('boolValue'))
+        self.config['testmonitor.intValue'] = '456'
+        self.assertEquals(self.monitor._getConfigInt('intValue'), 456)
+        self.assertEquals(self.monitor._getConfigInt('missing', 7), 7)
+
     def testGetConfigStringList(self):
         """Test `MonitoringProtocol._getConfigStringList`."""
         self.config['testmonitor.strListValue'] = '"abc"'
@@ -108,3 +207,259 @@ class MonitoringProtocolTestCase(PyBalTestCase):
         self.config['testmonitor.emptyStrListValue'] = '[]'
         with self.assertRaises(ValueError):
             self.monitor._getConfigStringList('emptyStrListValue')
+
+
+class MonitorPlanTestCase(PyBalTestCase):
+    """Test case for `pybal.monitor.MonitorPlan`."""
+
+    def setUp(self):
+        super(MonitorPlanTestCase, self).setUp()
+        self.config['monitors'] = '["ProxyFetch", "IdleConnection"]'
+        self.config['proxyfetch.url'] = '["http://example.com/"]'
+        pybal.monitor.MonitorPlan._plans.clear()
+
+    def testInit(self):
+        """Test `MonitorPlan.__init__`."""
+        plan = pybal.monitor.MonitorPlan('test', self.config)
+        self.assertEquals(plan.monitorClasses, [ProxyFetchMonitoringProtocol,
+                                                IdleConnectionMonitoringProtocol])
+
+        self.config['monitors'] = '["ProxyFetch", "DoesNotExist"]'
+        plan = pybal.monitor.MonitorPlan('test', self.config)
+        self.assertEquals(plan.monitorClasses, [ProxyFetchMonitoringProtocol])
+        self.flushLoggedErrors()
+
+        self.config['monitors'] = '"ProxyFetch"'
+        plan = pybal.monitor.MonitorPlan('test', self.config)
+        self.assertEquals(plan.monitorClasses, [])
+        self.flushLoggedErrors()
+
+        del self.config['monitors']
+        with self.assertRaises(KeyError):
+            pybal.monitor.MonitorPlan('test', self.config)
+
+    def testForService(self):
+        """`MonitorPlan.forService` compiles a plan once per service."""
+        plan = pybal.monitor.MonitorPlan.forService(self.lvsservice)
+        self.assertIs(pybal.monitor.MonitorPlan.forService(self.lvsservice),
+                      plan)
+        self.lvsservice.configuration = pybal.util.ConfigDict(self.config)
+        self.assertIsNot(pybal.monitor.MonitorPlan.forService(self.lvsservice),
+                         plan)
+
+    def testCreateMonitors(self):
+        """Test `MonitorPlan.createMonitors`."""
+        plan = pybal.monitor.MonitorPlan.forService(self.lvsservice)
+        with mock.patch('__builtin__.eval', side_effect=eval) as mock_eval:
+            monitors = plan.createMonitors(self.coordinator, self.server)
+            monitors += plan.createMonitors(self.coordinator, self.server)
+        self.assertEquals([type(m) for m in monitors], plan.monitorClasses * 2)
+        for m in monitors:
+            self.assertIs(m.server, self.server)
+            self.assertFalse(m.active)
+        # The URL list is only parsed for the first server
+        self.assertEquals(mock_eval.call_count, 1)
+
+
+class MonitorRegistryTestCase(PyBalTestCase):
+    """Test case for `pybal.monitor.MonitorRegistry`."""
+
+    def setUp(self):
+        super(MonitorRegistryTestCase, self).setUp()
+        registry = pybal.monitor.MonitorRegistry
+        patchers = [
+            mock.patch.object(registry, 'monitors', set()),
+            mock.patch.object(registry, 'shutdownTrigger', None),
+            mock.patch.object(twisted.internet.reactor, 'addSystemEventTrigger')
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addSystemEventTrigger = twisted.internet.reactor.addSystemEventTrigger
+
+    def createMonitor(self, server):
+        monitor = pybal.monitor.MonitoringProtocol(
+            self.coordinator, server, self.config)
+        monitor.__name__ = 'TestMonitor'
+        return monitor
+
+    def testRunStop(self):
+        """Monitors are registered while running."""
+        monitor = self.createMonitor(self.server)
+        self.assertNotIn(monitor, pybal.monitor.MonitorRegistry.monitors)
+        monitor.run()
+        self.assertIn(monitor, pybal.monitor.MonitorRegistry.monitors)
+        monitor.stop()
+        self.assertNotIn(monitor, pybal.monitor.MonitorRegistry.monitors)
+
+    def testStopAll(self):
+        """Test `MonitorRegistry.stopAll`."""
+        monitors = [self.createMonitor(self.server) for i in range(3)]
+        for monitor in monitors:
+            monitor.run()
+        self.addSystemEventTrigger.assert_called_once_with(
+            'before', 'shutdown', pybal.monitor.MonitorRegistry.stopAll)
+        pybal.monitor.MonitorRegistry.stopAll()
+        for monitor in monitors:
+            self.assertFalse(monitor.active)
+        self.assertEquals(pybal.monitor.MonitorRegistry.getStats(),
+                          {'running': 0})
+
+    def testChurn(self):
+        """Servers that come and go don't leave monitors behind."""
+        def cycle():
+            server = Server('localhost', self.lvsservice)
+            for i in range(3):
+                monitor = self.createMonitor(server)
+                server.addMonitor(monitor)
+                monitor.run()
+            server.destroy()
+
+        cycle()
+        gc.collect()
+        count = sum(1 for o in gc.get_objects()
+                    if isinstance(o, pybal.monitor.MonitoringProtocol))
+        for i in range(100):
+            cycle()
+        gc.collect()
+        self.assertEquals(
+            sum(1 for o in gc.get_objects()
+                if isinstance(o, pybal.monitor.MonitoringProtocol)),
+            count)
+        self.assertEquals(len(pybal.monitor.MonitorRegistry.monitors), 0)
+        self.assertEquals(self.addSystemEventTrigger.call_count, 1)
+
+
+class ProbeBudgetTestCase(PyBalTestCase):
+    """Test case for `pybal.monitor.ProbeBudget`."""
+
+    def setUp(self):
+        super(ProbeBudgetTestCase, self).setUp()
+        self.budget = pybal.monitor.ProbeBudget
+        self.budget.configure(10, 10, now=0)
+        self.addCleanup(self.budget.configure, 0)
+
+    def testUnlimited(self):
+        """Without a configured rate, probes are never deferred."""
+        self.budget.configure(0)
+        for i in range(1000):
+            self.assertEquals(self.budget.acquire('low', 0), 0)
+        self.assertEquals(self.budget.getStats(), {'rate': 0})
+
+    def testPriorities(self):
+        """Lower priority probes are deferred first."""
+        for i in range(5):
+            self.assertEquals(self.budget.acquire('low', 0), 0)
+        # Low priority probes leave half of the burst in reserve
+        self.assertTrue(self.budget.acquire('low', 0) > 0)
+        for i in range(5):
+            self.assertEquals(self.budget.acquire('normal', 0), 0)
+        self.assertTrue(self.budget.acquire('normal', 0) > 0)
+        # Critical probes always go through
+        for i in range(5):
+            self.assertEquals(self.budget.acquire('critical', 0), 0)
+
+        self.assertEquals(self.budget.granted, 15)
+        self.assertEquals(self.budget.exhausted, 6)
+        self.assertEquals(self.budget.deferred,
+                          {'low': 1, 'normal': 1, 'critical': 0})
+
+    def testGetStats(self):
+        """Test `ProbeBudget.getStats`."""
+        self.budget.configure(10, 10, now=twisted.internet.reactor.seconds())
+        self.budget.acquire('normal', twisted.internet.reactor.seconds())
+        stats = self.budget.getStats()
+        self.assertEquals(stats['rate'], 10)
+        self.assertEquals(stats['granted'], 1)
+        self.assertEquals(stats['deferred']['normal'], 0)
+
+    def testExhausted(self):
+        """The budget only counts as exhausted when no tokens are left
+        after refilling."""
+        for i in range(10):
+            self.budget.acquire('normal', 0)
+        self.assertEquals(self.budget.exhausted, 0)
+        self.assertEquals(self.budget.acquire('normal', 0.1), 0)
+        self.assertEquals(self.budget.exhausted, 0)
+        self.assertTrue(self.budget.acquire('normal', 0.1) > 0)
+        self.assertEquals(self.budget.exhausted, 1)
+
+    def testDeferredOnce(self):
+        """A postponed probe is counted as deferred once, however often
+        it is retried."""
+        clock = twisted.internet.task.Clock()
+        monitor = pybal.monitor.MonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=clock)
+        for i in range(10):
+            self.budget.acquire('normal', 0)
+        check = mock.Mock()
+        # Low priority probes wait for half of the burst to refill
+        monitor.priority = 'low'
+        monitor._startCheck(check)
+        # Other probes take the refilled tokens, so the retry is deferred
+        # again
+        clock.advance(0.3)
+        self.budget.acquire('normal', clock.seconds())
+        self.budget.acquire('normal', clock.seconds())
+        clock.advance(0.3)
+        self.assertFalse(check.called)
+        clock.advance(0.3)
+        check.assert_called_once_with()
+        self.assertEquals(self.budget.deferred['low'], 1)
+        self.assertEquals(self.budget.granted, 13)
+
+
+class SourceAddressPoolTestCase(PyBalTestCase):
+    """Test case for `pybal.monitor.SourceAddressPool`."""
+
+    def setUp(self):
+        super(SourceAddressPoolTestCase, self).setUp()
+        self.pool = pybal.monitor.SourceAddressPool
+        self.pool.configure(['10.0.0.1', '10.0.0.2', '2001:db8::1'])
+        self.pool.portRange = 2
+        self.addCleanup(self.pool.configure, [])
+        self.addCleanup(setattr, self.pool, 'portRange', None)
+
+    def testAcquire(self):
+        """Sources are spread round robin, per address family."""
+        sources = [self.pool.acquire('10.1.0.1', 80) for i in range(3)]
+        self.assertEquals(sources, ['10.0.0.1', '10.0.0.2', '10.0.0.1'])
+        self.assertEquals(self.pool.acquire('2001:db8::2', 80), '2001:db8::1')
+        self.pool.configure([])
+        self.assertEquals(self.pool.acquire('10.1.0.1', 80), '')
+
+    def testAcquireAccounting(self):
+        """With port accounting, sources can run out of ports."""
+        sources = [self.pool.acquire('10.1.0.1', 80, True) for i in range(4)]
+        self.assertEquals(sorted(sources), ['10.0.0.1', '10.0.0.1',
+                                            '10.0.0.2', '10.0.0.2'])
+        self.assertIsNone(self.pool.acquire('10.1.0.1', 80, True))
+        self.assertEquals(self.pool.portsExhausted, 1)
+        # Which is not counted as a failed connection attempt
+        self.assertEquals(self.pool.localExhaustion, 0)
+        # Other destinations are not affected
+        self.assertEquals(self.pool.acquire('10.1.0.2', 80, True), '10.0.0.1')
+        # Lingered connections release their port right away
+        self.pool.release('10.0.0.2', '10.1.0.1', 80, lingered=True)
+        self.assertEquals(self.pool.acquire('10.1.0.1', 80, True), '10.0.0.2')
+        self.assertEquals(self.pool.getStats()['ports-in-use'], 5)
+
+    def testReleaseTimeWait(self):
+        """Ports are held for the TIME_WAIT period after a normal close."""
+        clock = twisted.internet.task.Clock()
+        source = self.pool.acquire('10.1.0.1', 80, True)
+        with mock.patch.object(pybal.monitor, 'reactor', clock):
+            self.pool.release(source, '10.1.0.1', 80)
+        self.assertEquals(self.pool.getStats()['ports-in-use'], 1)
+        clock.advance(self.pool.TIME_WAIT)
+        self.assertEquals(self.pool.getStats()['ports-in-use'], 0)
+
+    def testIsLocalExhaustion(self):
+        """Test `SourceAddressPool.isLocalExhaustion`."""
+        failure = twisted.python.failure.Failure(
+            twisted.internet.error.ConnectError(errno.EADDRNOTAVAIL, 'no'))
+        self.assertTrue(self.pool.isLocalExhaustion(failure))
+        failure = twisted.python.failure.Failure(
+            twisted.internet.error.ConnectionRefusedError(errno.ECONNREFUSED))
+        self.assertFalse(self.pool.isLocalExhaustion(failure))
+        self.assertEquals(self.pool.getStats()['local-exhaustion'], 1)
@@ -6,10 +6,20 @@
   This module contains tests for `pybal.monitors`.
 
 """
+import errno
 import unittest
 
+import mock
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+import pybal.monitor
 import pybal.util
+from pybal.monitors.dnsquery import DNSQueryMonitoringProtocol
 from pybal.monitors.idleconnection import IdleConnectionMonitoringProtocol
+from pybal.monitors.ipvsstats import (IPVSSnapshot,
+                                      IPVSStatsMonitoringProtocol)
 
 from .fixtures import PyBalTestCase
 
@@ -54,9 +64,231 @@ class IdleConnectionMonitoringProtocolTestCase(PyBalTestCase):
         self.monitor.clientConnectionMade()
         self.assertTrue(self.monitor.up)
 
+    def testClientConnectionFailed(self):
+        """Test `IdleConnectionMonitoringProtocol.clientConnectionFailed`."""
+        self.monitor.clock = task.Clock()
+        self.monitor.run()
+        connector = self.reactor.connectors.pop()
+        self.monitor.up = True
+        reason = failure.Failure(error.ConnectBindError(errno.EADDRNOTAVAIL, ''))
+        self.monitor.clientConnectionFailed(connector, reason)
+        # Local resource exhaustion does not reflect on the server
+        self.assertTrue(self.monitor.up)
+        reason = failure.Failure(error.ConnectionRefusedError())
+        self.monitor.clientConnectionFailed(connector, reason)
+        self.assertFalse(self.monitor.up)
+        self.monitor.stop()
+
     def testBuildProtocol(self):
         """Test `IdleConnectionMonitoringProtocol.buildProtocol`."""
         self.monitor.run()
         self.monitor.up = False
         self.monitor.buildProtocol(None)
         self.assertTrue(self.monitor.up)
+
+    def testPortAccounting(self):
+        """With port accounting, connections wait for a free port."""
+        pool = pybal.monitor.SourceAddressPool
+        pool.configure(['10.0.0.1'])
+        self.addCleanup(pool.configure, [])
+        self.patch(pool, 'portRange', 1)
+        self.config['idleconnection.port-accounting'] = 'yes'
+        self.config['idleconnection.linger-close'] = 'yes'
+        monitors = []
+        for i in range(2):
+            monitor = IdleConnectionMonitoringProtocol(
+                self.coordinator, self.server, self.config)
+            monitor.reactor = proto_helpers.MemoryReactorClock()
+            monitor.run()
+            monitors.append(monitor)
+        self.assertEquals(monitors[0].reactor.tcpClients[0][4], ('10.0.0.1', 0))
+        self.assertEquals(monitors[1].reactor.tcpClients, [])
+        self.assertEquals(pool.getStats()['ports-exhausted'], 1)
+        # Stopping releases the port
+        monitors[0].stop()
+        monitors[1].reactor.advance(monitors[1].delay)
+        self.assertEquals(monitors[1].reactor.tcpClients[0][4], ('10.0.0.1', 0))
+        monitors[1].stop()
+        self.assertEquals(pool.getStats()['ports-in-use'], 0)
+
+
+class DNSQueryMonitoringProtocolTestCase(PyBalTestCase):
+    """Test case for `pybal.monitors.DNSQueryMonitoringProtocol`."""
+
+    def testPortAccounting(self):
+        """With port accounting, checks are skipped when out of ports."""
+        pool = pybal.monitor.SourceAddressPool
+        pool.configure(['10.0.0.1'])
+        self.addCleanup(pool.configure, [])
+        self.patch(pool, 'portRange', 1)
+        self.config['dnsquery.hostnames'] = '["example.com"]'
+        self.config['dnsquery.port-accounting'] = 'yes'
+        monitors = [DNSQueryMonitoringProtocol(self.coordinator, self.server, self.config)
+                    for i in range(2)]
+        with mock.patch.object(DNSQueryMonitoringProtocol, '_scheduleCheck') as scheduleCheck:
+            for monitor in monitors:
+                monitor.run()
+                monitor.resolver.lookupAddress = mock.Mock(return_value=defer.Deferred())
+                monitor.resolver.lookupIPV6Address = monitor.resolver.lookupAddress
+                monitor.check()
+            self.assertEquals(monitors[0].resolver.sourceAddress, '10.0.0.1')
+            self.assertEquals(pool.getStats()['ports-exhausted'], 1)
+            self.assertFalse(monitors[1].resolver.lookupAddress.called)
+            # The port is released when the query finishes
+            monitors[0].DNSQueryDeferred.callback(([], [], []))
+            self.assertEquals(pool.getStats()['ports-in-use'], 0)
+        monitors[0].stop()
+        # Stopping cancels the query Deferred, which never ran for the other
+        monitors[1].DNSQueryDeferred.addErrback(lambda failure: None)
+        monitors[1].stop()
+
+
+class IPVSSnapshotTestCase(PyBalTestCase):
+    """Test case for `pybal.monitors.ipvsstats.IPVSSnapshot`."""
+
+    table = [
+        "IP Virtual Server version 1.2.1 (size=4096)\n",
+        "Prot LocalAddress:Port Scheduler Flags\n",
+        "  -> RemoteAddress:Port Forward Weight ActiveConn InActConn\n",
+        "TCP  7F000001:0050 rr \n",
+        "  -> 0A000001:0050      Route   10     5          3         \n",
+        "  -> 0A000002:0050      Route   10     0          150       \n",
+        "FWM  00000001 wlc \n",
+        "  -> 0A000003:0000      Route   10     1          1         \n",
+        "TCP  [2620:0000:0862:ed1a:0000:0000:0000:0001]:01BB sh \n",
+        "  -> [2620:0000:0862:ed1a:0000:0000:0000:0002]:01BB      Route   1      7          0         \n",
+    ]
+
+    stats = [
+        "   Total Incoming Outgoing         Incoming         Outgoing\n",
+        "   Conns  Packets  Packets            Bytes            Bytes\n",
+        "      1A       FF        0              100                0\n",
+        "\n",
+        " Conns/s   Pkts/s   Pkts/s          Bytes/s          Bytes/s\n",
+        "       2        B        0               C0                0\n",
+    ]
+
+    def testParseTable(self):
+        """Test `IPVSSnapshot.parseTable`."""
+        services = IPVSSnapshot.parseTable(self.table)
+        self.assertEquals(services, {
+            ('tcp', '127.0.0.1', 80): {
+                ('10.0.0.1', 80): (5, 3),
+                ('10.0.0.2', 80): (0, 150),
+            },
+            ('tcp', '2620:0:862:ed1a::1', 443): {
+                ('2620:0:862:ed1a::2', 443): (7, 0),
+            },
+        })
+
+    def testParseStats(self):
+        """Test `IPVSSnapshot.parseStats`."""
+        totals = IPVSSnapshot.parseStats(self.stats)
+        self.assertEquals(totals['conns'], 26)
+        self.assertEquals(totals['inpkts'], 255)
+        self.assertEquals(totals['conns/s'], 2)
+        self.assertEquals(totals['inbytes/s'], 192)
+
+    def testServiceConnections(self):
+        """Test `IPVSSnapshot.serviceConnections`."""
+        snapshot = IPVSSnapshot(IPVSSnapshot.parseTable(self.table))
+        self.assertEquals(
+            snapshot.serviceConnections(('tcp', '127.0.0.1', 80)), 158)
+        self.assertEquals(
+            snapshot.serviceConnections(('udp', '127.0.0.1', 53)), 0)
+
+
+class IPVSStatsMonitoringProtocolTestCase(PyBalTestCase):
+    """Test case for `pybal.monitors.IPVSStatsMonitoringProtocol`."""
+
+    service = ('tcp', '127.0.0.1', 80)
+
+    def setUp(self):
+        super(IPVSStatsMonitoringProtocolTestCase, self).setUp()
+        self.config['ipvsstats.samples'] = '2'
+        self.server.ip = '10.0.0.1'
+        self.monitor = IPVSStatsMonitoringProtocol(
+            self.coordinator, self.server, self.config)
+        self.monitor.active = True
+
+    def snapshot(self, *counters):
+        destinations = dict((('10.0.0.%d' % (i + 1), 80), c)
+                            for i, c in enumerate(counters))
+        return IPVSSnapshot({self.service: destinations}, {'conns/s': 1})
+
+    def testInspectHealthy(self):
+        """A destination with active connections is up."""
+        self.monitor.inspect(self.snapshot((5, 3), (5, 3)))
+        self.assertTrue(self.coordinator.up)
+
+    def testInspectNotPooled(self):
+        """A destination missing from the table is up."""
+        self.monitor.inspect(self.snapshot())
+        self.assertTrue(self.coordinator.up)
+        self.monitor.inspect(self.snapshot((0, 150), (5, 3)))
+        self.monitor.inspect(self.snapshot((0, 150), (5, 3)))
+        self.assertFalse(self.coordinator.up)
+        # Once depooled, the server is left to the other monitors
+        self.monitor.inspect(self.snapshot())
+        self.assertTrue(self.coordinator.up)
+        self.assertTrue(self.monitor.up)
+        self.assertEquals(self.monitor.anomalies, 0)
+
+    def testRun(self):
+        """Checks are scheduled through the base class."""
+        with mock.patch.object(IPVSStatsMonitoringProtocol, '_scheduleCheck') as scheduleCheck, \
+                mock.patch.object(IPVSStatsMonitoringProtocol, 'getSnapshot',
+                                  return_value=self.snapshot((5, 3))):
+            self.monitor.active = False
+            self.monitor.run()
+            scheduleCheck.assert_called_once_with(
+                self.monitor.intvCheck, self.monitor.check)
+            self.monitor.check()
+            self.assertEquals(scheduleCheck.call_count, 2)
+            self.assertTrue(self.coordinator.up)
+        self.monitor.stop()
+
+    def testProbeBudget(self):
+        """Checks are not subject to the probe budget."""
+        check = mock.Mock()
+        with mock.patch.object(pybal.monitor.ProbeBudget, 'acquire', return_value=10) as acquire:
+            self.monitor._startCheck(check)
+        self.assertFalse(acquire.called)
+        check.assert_called_once_with()
+
+    def testInspectInactiveOnly(self):
+        """Many inactive and no active connections is an anomaly."""
+        self.monitor.inspect(self.snapshot((5, 3), (5, 3)))
+        self.monitor.inspect(self.snapshot((0, 150), (5, 3)))
+        self.assertTrue(self.coordinator.up)
+        self.monitor.inspect(self.snapshot((0, 150), (5, 3)))
+        self.assertFalse(self.coordinator.up)
+        self.assertIn('inactive', self.coordinator.reason)
+        # Recovery
+        self.monitor.inspect(self.snapshot((5, 3), (5, 3)))
+        self.assertTrue(self.coordinator.up)
+
+    def testInspectStoppedReceiving(self):
+        """A destination which stopped receiving connections is down."""
+        self.monitor.inspect(self.snapshot((0, 0), (50, 3)))
+        self.monitor.inspect(self.snapshot((0, 0), (50, 3)))
+        # Never saw traffic, so nothing to compare against
+        self.assertTrue(self.coordinator.up)
+        self.monitor.inspect(self.snapshot((5, 3), (50, 3)))
+        self.monitor.inspect(self.snapshot((0, 0), (50, 3)))
+        self.monitor.inspect(self.snapshot((0, 0), (50, 3)))
+        self.assertFalse(self.coordinator.up)
+
+    def testGetSnapshotShared(self):
+        """The kernel tables are read at most once per interval."""
+        snapshot = self.snapshot((1, 1))
+        with mock.patch.object(IPVSSnapshot, 'read',
+                               return_value=snapshot) as read:
+            IPVSStatsMonitoringProtocol.snapshot = None
+            self.assertIs(IPVSStatsMonitoringProtocol.getSnapshot(100, 10),
+                          snapshot)
+            IPVSStatsMonitoringProtocol.getSnapshot(105, 10)
+            self.assertEquals(read.call_count, 1)
+            IPVSStatsMonitoringProtocol.getSnapshot(110, 10)
+            self.assertEquals(read.call_count, 2)
+        IPVSStatsMonitoringProtocol.snapshot = None
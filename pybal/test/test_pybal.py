@@ -8,8 +8,11 @@
 """
 import sys
 import mock
+import pybal.config
+from twisted.internet import defer, reactor, task
 from .fixtures import PyBalTestCase
-from pybal.pybal import parseCommandLine
+from pybal.monitor import MonitoringProtocol
+from pybal.pybal import parseCommandLine, Server, Coordinator
 
 
 class TestBaseUtils(PyBalTestCase):
@@ -33,3 +36,413 @@ class TestBaseUtils(PyBalTestCase):
             with self.assertRaises(SystemExit) as exc:
                 parseCommandLine(config)
                 self.assertEquals(exc.exception.code, 0)
+
+
+class ServerTestCase(PyBalTestCase):
+    """Test case for `pybal.pybal.Server`."""
+
+    def setUp(self):
+        super(ServerTestCase, self).setUp()
+        self.server = Server('localhost', self.lvsservice)
+        self.monitors = []
+        for i in range(3):
+            m = MonitoringProtocol(self.coordinator, self.server, self.config)
+            m.__name__ = 'TestMonitor%d' % i
+            self.monitors.append(m)
+
+    def testAddMonitor(self):
+        """Test `Server.addMonitor`."""
+        self.monitors[0].up = True
+        for m in self.monitors:
+            self.server.addMonitor(m)
+        self.server.addMonitor(self.monitors[0])
+        self.assertEquals(self.server.upMonitors, 1)
+        self.server.removeMonitors()
+        self.assertEquals(self.server.upMonitors, 0)
+        # Removed monitors no longer count
+        self.monitors[1].up = True
+        self.assertEquals(self.server.upMonitors, 0)
+
+    def testCalcStatus(self):
+        """Test `Server.calcStatus` and `Server.calcPartialStatus`."""
+        # No monitors means up
+        self.assertTrue(self.server.calcStatus())
+        self.assertTrue(self.server.calcPartialStatus())
+
+        for m in self.monitors:
+            self.server.addMonitor(m)
+        self.assertFalse(self.server.calcStatus())
+        self.assertFalse(self.server.calcPartialStatus())
+
+        self.monitors[0].up = True
+        self.monitors[0].up = True
+        self.assertFalse(self.server.calcStatus())
+        self.assertTrue(self.server.calcPartialStatus())
+        self.assertEquals(self.server.textStatus(),
+                          'enabled/partially up/not pooled')
+
+        for m in self.monitors:
+            m.up = True
+        self.assertTrue(self.server.calcStatus())
+
+        self.monitors[1].up = False
+        self.monitors[2].up = None
+        self.assertEquals(self.server.upMonitors, 1)
+
+    def testMerge(self):
+        """Test `Server.merge`."""
+        self.server.merge({'weight': 20, 'enabled': False, 'foo': 'bar'})
+        self.assertEquals(self.server.weight, 20)
+        self.assertFalse(self.server.enabled)
+        self.assertTrue(self.server.modified)
+        self.assertFalse(hasattr(self.server, 'foo'))
+        self.assertFalse(hasattr(self.server, '__dict__'))
+
+    def testInternHost(self):
+        """Hostnames from JSON configurations are unicode."""
+        self.assertEquals(Server.internHost(u'mw1200'), 'mw1200')
+        self.assertIsInstance(Server.internHost(u'mw1200'), str)
+        self.assertIs(Server.internHost(u'mw1200'), Server.internHost('mw1200'))
+        self.assertEquals(Server.internHost(u'b\xfccher.example'), 'b\xc3\xbccher.example')
+
+    def testRefreshHostname(self):
+        """A changed address moves the server in the background."""
+        self.server.ip = '10.0.0.1'
+        self.server.pooled = True
+        self.lvsservice.changeServerIP = mock.Mock()
+        with mock.patch('pybal.resolver.HostnameCache.lookup',
+                        return_value=defer.succeed((frozenset(['10.0.0.2']), 60))), \
+                mock.patch.object(reactor, 'callLater') as mock_callLater:
+            self.server.refreshHostname()
+        self.assertEquals(self.server.ip, '10.0.0.2')
+        self.lvsservice.changeServerIP.assert_called_once_with(
+            self.server, '10.0.0.1')
+        mock_callLater.assert_called_once_with(60, self.server.refreshHostname)
+
+        # An unchanged address leaves everything alone
+        self.lvsservice.changeServerIP.reset_mock()
+        with mock.patch('pybal.resolver.HostnameCache.lookup',
+                        return_value=defer.succeed((frozenset(['10.0.0.2',
+                                                               '10.0.0.3']), 60))), \
+                mock.patch.object(reactor, 'callLater'):
+            self.server.refreshHostname()
+        self.assertEquals(self.server.ip, '10.0.0.2')
+        self.assertFalse(self.lvsservice.changeServerIP.called)
+
+        # Disabled servers keep refreshing, destroyed ones stop
+        self.server.enabled = False
+        lookup = defer.Deferred()
+        with mock.patch('pybal.resolver.HostnameCache.lookup', return_value=lookup), \
+                mock.patch.object(reactor, 'callLater') as mock_callLater:
+            self.server.refreshHostname()
+            lookup.callback((frozenset(['10.0.0.2']), 60))
+            mock_callLater.assert_called_once_with(60, self.server.refreshHostname)
+            mock_callLater.reset_mock()
+            lookup = defer.Deferred()
+            with mock.patch('pybal.resolver.HostnameCache.lookup', return_value=lookup):
+                self.server.refreshHostname()
+            self.server.destroy()
+            lookup.callback((frozenset(['10.0.0.2']), 60))
+            self.assertFalse(mock_callLater.called)
+
+    def testStartupCheck(self):
+        """With startup-check, servers only become ready after their first checks."""
+        self.config['startup-check'] = 'yes'
+        server = Server('127.0.0.1', self.lvsservice)
+        with mock.patch.object(Server, '_ready') as mock_ready:
+            server.initialize(self.coordinator)
+        self.assertTrue(mock_ready.called)
+
+        for m in self.monitors:
+            self.server.addMonitor(m)
+        clock = task.Clock()
+        with mock.patch('pybal.pybal.reactor', clock), \
+                mock.patch.object(Server, 'createMonitoringInstances'):
+            d = self.server._ready(None, self.coordinator)
+        self.assertFalse(d.called)
+        self.assertFalse(self.server.ready)
+
+        self.monitors[0].firstCheck = False
+        self.monitors[0].up = True
+        self.server.checkStartup()
+        self.assertFalse(d.called)
+        for m in self.monitors[1:]:
+            m.firstCheck = False
+            m.up = True
+        self.server.checkStartup()
+        self.assertTrue(self.successResultOf(d))
+        self.assertTrue(self.server.ready)
+        self.assertTrue(self.server.up)
+        self.assertTrue(self.server.pooled)
+        self.assertEquals(clock.getDelayedCalls(), [])
+
+    def testStartupDeadline(self):
+        """Servers become ready at the startup deadline."""
+        self.config['startup-check'] = 'yes'
+        self.config['startup-deadline'] = '5'
+        for m in self.monitors:
+            self.server.addMonitor(m)
+        clock = task.Clock()
+        with mock.patch('pybal.pybal.reactor', clock), \
+                mock.patch.object(Server, 'createMonitoringInstances'):
+            d = self.server._ready(None, self.coordinator)
+            clock.advance(4)
+            self.assertFalse(d.called)
+            clock.advance(1)
+        self.assertTrue(self.successResultOf(d))
+        self.assertTrue(self.server.ready)
+        self.assertFalse(self.server.up)
+        self.assertFalse(self.server.pooled)
+
+    def testRestoreState(self):
+        """Servers resume from a saved state."""
+        self.server.savedState = {
+            'up': False, 'pooled': True, 'enabled': True, 'weight': 10,
+            'monitors': {'TestMonitor0': {'up': False, 'backoffSteps': 2},
+                         'TestMonitor1': {'up': True}}}
+        plan = mock.Mock()
+        plan.createMonitors.return_value = self.monitors
+        with mock.patch('pybal.monitor.MonitorPlan.forService',
+                        return_value=plan), \
+                mock.patch.object(MonitoringProtocol, 'run') as mock_run:
+            self.assertTrue(self.server._ready(None, self.coordinator))
+        self.assertTrue(self.server.ready)
+        self.assertFalse(self.server.up)
+        self.assertTrue(self.server.pooled)
+        self.assertIn(self.server, self.coordinator.pooledDownServers)
+        self.assertIsNone(self.server.savedState)
+        self.assertEquals(mock_run.call_count, 3)
+        self.assertEquals([m.up for m in self.monitors], [False, True, None])
+        self.assertEquals(self.monitors[0].backoffSteps, 2)
+        self.assertEquals(self.server.upMonitors, 1)
+        self.assertEquals(
+            self.server.snapshotState()['monitors']['TestMonitor1'],
+            {'up': True, 'backoffSteps': 0})
+
+    def testRestoreStateStartupCheck(self):
+        """With startup-check, restored servers still await their first
+        checks, and saved results count at the deadline."""
+        self.config['startup-check'] = 'yes'
+        self.config['startup-deadline'] = '5'
+        self.server.savedState = {
+            'up': True, 'pooled': True, 'enabled': True, 'weight': 10,
+            'monitors': {'TestMonitor0': {'up': True},
+                         'TestMonitor1': {'up': True},
+                         'TestMonitor2': {'up': False}}}
+        plan = mock.Mock()
+        plan.createMonitors.return_value = self.monitors
+        clock = task.Clock()
+        with mock.patch('pybal.monitor.MonitorPlan.forService',
+                        return_value=plan), \
+                mock.patch.object(MonitoringProtocol, 'run'), \
+                mock.patch.object(MonitoringProtocol, 'recheck') as mock_recheck, \
+                mock.patch('pybal.pybal.reactor', clock):
+            d = self.server._ready(None, self.coordinator)
+            self.assertEquals(mock_recheck.call_count, 3)
+            self.assertFalse(d.called)
+            self.assertFalse(self.server.ready)
+            self.monitors[0].firstCheck = False
+            self.server.checkStartup()
+            clock.advance(5)
+        self.assertTrue(self.successResultOf(d))
+        self.assertIsNone(self.server.savedState)
+        self.assertFalse(self.server.up)
+        self.assertFalse(self.server.pooled)
+
+    def testCalcQuorumStatus(self):
+        """Test `Server.calcQuorumStatus`."""
+        self.assertTrue(self.server.calcQuorumStatus(2))
+        for m in self.monitors:
+            self.server.addMonitor(m)
+        self.monitors[0].up = True
+        self.assertFalse(self.server.calcQuorumStatus(2))
+        self.monitors[2].up = True
+        self.assertTrue(self.server.calcQuorumStatus(2))
+        self.assertFalse(self.server.calcQuorumStatus(5))
+
+
+class CoordinatorTestCase(PyBalTestCase):
+    """Test case for `pybal.pybal.Coordinator`."""
+
+    def setUp(self):
+        super(CoordinatorTestCase, self).setUp()
+        self.lvsservice.getDepoolThreshold = lambda: .5
+        with mock.patch('pybal.config.ConfigurationObserver.fromUrl'):
+            self.coordinator = Coordinator(self.lvsservice, 'file:///dev/null')
+        self.servers = [Server('server%d' % i, self.lvsservice)
+                        for i in range(4)]
+        for server in self.servers:
+            server.up = server.pooled = True
+            self.coordinator.addServer(server)
+
+    def testServerCounters(self):
+        """Server state changes update the Coordinator counters."""
+        self.assertEquals(self.coordinator.upServers, 4)
+        self.assertEquals(self.coordinator.pooledServers, 4)
+        self.servers[0].up = False
+        self.servers[0].up = False
+        self.servers[1].pooled = False
+        self.assertEquals(self.coordinator.upServers, 3)
+        self.assertEquals(self.coordinator.pooledServers, 3)
+        self.coordinator.removeServer(self.servers[1])
+        self.assertEquals(self.coordinator.upServers, 2)
+        self.assertEquals(self.coordinator.pooledServers, 3)
+        # Removed servers no longer count
+        self.servers[1].up = False
+        self.assertEquals(self.coordinator.upServers, 2)
+
+    def testOnConfigUpdate(self):
+        """`Coordinator.onConfigUpdate` only touches changed servers."""
+        self.lvsservice.initServer = mock.Mock()
+        self.lvsservice.updateServers = mock.Mock()
+        self.coordinator.serverConfig = dict(
+            (server.host, {'enabled': True, 'weight': 10})
+            for server in self.servers)
+        serverConfig = dict(self.coordinator.serverConfig)
+        serverConfig['server0'] = {'enabled': True, 'weight': 20}
+        del serverConfig['server1']
+        with mock.patch.object(Server, 'initialize',
+                               return_value=defer.succeed(True)):
+            serverConfig['server4'] = {'enabled': True, 'weight': 10}
+            self.coordinator.onConfigUpdate(serverConfig)
+
+        self.assertEquals(self.servers[0].weight, 20)
+        self.assertNotIn('server1', self.coordinator.servers)
+        self.assertFalse(self.servers[1].pooled)
+        self.assertEquals(self.coordinator.pooledServers, 3)
+        self.assertIs(self.coordinator.serverConfig, serverConfig)
+        servers = self.lvsservice.updateServers.call_args[0][0]
+        self.assertEquals(sorted(server.host for server in servers),
+                          ['server0', 'server1', 'server4'])
+
+    def testServerInitDone(self):
+        """New servers found down stay pooled only as far as needed to
+        meet the depool threshold."""
+        self.lvsservice.updateServers = mock.Mock()
+        # Modified servers that were depooled for good reason
+        for server in self.servers[:2]:
+            server.up = server.pooled = False
+        newServers = [Server('new%d' % i, self.lvsservice) for i in range(4)]
+        for server in newServers:
+            server.ready = True
+            server.up = server.pooled = False
+            self.coordinator.addServer(server)
+        newServers[0].up = newServers[0].pooled = True
+        newServers[1].enabled = False
+        self.assertFalse(self.coordinator.canDepool())
+        self.coordinator._serverInitDone(
+            [], newServers, newServers + self.servers[:2])
+        # 4 of the 8 servers
+        self.assertEquals(self.coordinator.pooledServers, 4)
+        self.assertEquals([s.pooled for s in newServers], [True, False, True, False])
+        self.assertFalse(self.servers[0].pooled)
+        self.assertFalse(self.servers[1].pooled)
+        self.assertEquals(self.coordinator.pooledDownServers, set(newServers[2:3]))
+        self.lvsservice.updateServers.assert_called_once_with(
+            newServers + self.servers[:2])
+
+    def testApplyConfigDiff(self):
+        """`Coordinator.applyConfigDiff` keeps the server list in sync."""
+        self.coordinator.onConfigDiff = mock.Mock()
+        diff = pybal.config.ConfigDiff(added={'server0': {'weight': 10}})
+        self.coordinator.applyConfigDiff(diff)
+        self.coordinator.applyConfigDiff(
+            pybal.config.ConfigDiff(changed={'server0': {'enabled': False}}))
+        self.assertEquals(self.coordinator.serverConfig,
+                          {'server0': {'weight': 10, 'enabled': False}})
+        self.coordinator.onConfigDiff.assert_any_call(diff)
+
+    def testCanDepool(self):
+        """Test `Coordinator.canDepool`."""
+        self.assertTrue(self.coordinator.canDepool())
+        self.servers[0].up = False
+        self.servers[1].up = False
+        self.assertTrue(self.coordinator.canDepool())
+        self.servers[2].up = False
+        self.assertFalse(self.coordinator.canDepool())
+
+    def testCanDepoolHeldBack(self):
+        """Servers held back by the change rate or dampening don't count
+        toward the depool threshold, but disabled servers do."""
+        self.lvsservice.removeServer = mock.Mock(
+            side_effect=lambda server: setattr(server, 'pooled', False))
+        # Held back by the change rate and by dampening
+        self.servers[0].pooled = False
+        self.coordinator.pendingServers.add(self.servers[0])
+        self.servers[1].pooled = False
+        self.coordinator.dampeners['server1'] = mock.Mock(suppressed=True)
+        self.assertEquals(self.coordinator.upServers, 4)
+        self.assertEquals(self.coordinator.heldBackServers(), 2)
+        monitor = mock.Mock(server=self.servers[2])
+        monitor.name.return_value = 'TestMonitor'
+        self.coordinator.resultDown(monitor, 'test')
+        self.assertTrue(self.servers[2].pooled)
+        self.assertFalse(self.lvsservice.removeServer.called)
+        self.assertIn(self.servers[2], self.coordinator.pooledDownServers)
+
+        # Disabled servers that are up still count
+        del self.coordinator.dampeners['server1']
+        self.servers[1].enabled = False
+        self.assertEquals(self.coordinator.heldBackServers(), 1)
+        self.assertTrue(self.coordinator.canDepool())
+
+    def testChangeRate(self):
+        """Depool/repool changes beyond the change rate are delayed."""
+        self.lvsservice.configuration['change-rate'] = '1'
+        self.lvsservice.configuration['change-burst'] = '2'
+        self.lvsservice.getDepoolThreshold = lambda: 0
+        self.lvsservice.removeServer = mock.Mock(
+            side_effect=lambda server: setattr(server, 'pooled', False))
+        self.lvsservice.addServer = mock.Mock(
+            side_effect=lambda server: setattr(server, 'pooled', True))
+        clock = task.Clock()
+        with mock.patch('pybal.pybal.reactor', clock), \
+                mock.patch('pybal.config.ConfigurationObserver.fromUrl'):
+            coordinator = Coordinator(self.lvsservice, 'file:///dev/null')
+            for server in self.servers:
+                server.enabled = server.ready = True
+                coordinator.addServer(server)
+            for server in self.servers[:3]:
+                server.up = False
+                coordinator.depool(server)
+            self.assertEquals(self.lvsservice.removeServer.call_count, 2)
+            self.assertEquals(coordinator.pendingServers, set([self.servers[2]]))
+            self.assertEquals(coordinator.getChangeStats()['pending'], 1)
+            # The third server came back up before its depool was allowed
+            self.servers[2].up = True
+            clock.advance(1)
+            self.assertEquals(self.lvsservice.removeServer.call_count, 2)
+            self.assertFalse(coordinator.pendingServers)
+
+    def testDampening(self):
+        """Flapping servers stay depooled until their penalty decays."""
+        self.lvsservice.configuration['dampening-half-life'] = '60'
+        self.lvsservice.removeServer = mock.Mock(
+            side_effect=lambda server: setattr(server, 'pooled', False))
+        self.lvsservice.addServer = mock.Mock(
+            side_effect=lambda server: setattr(server, 'pooled', True))
+        clock = task.Clock()
+        server = self.servers[0]
+        server.enabled = server.ready = True
+        monitor = mock.Mock(server=server, firstCheck=False)
+        monitor.name.return_value = 'TestMonitor'
+        with mock.patch('pybal.pybal.reactor', clock), \
+                mock.patch('pybal.config.ConfigurationObserver.fromUrl'):
+            coordinator = Coordinator(self.lvsservice, 'file:///dev/null')
+            for s in self.servers:
+                coordinator.addServer(s)
+            server.addMonitor(monitor)
+            for i in range(2):
+                monitor.up = False
+                coordinator.resultDown(monitor)
+                self.assertFalse(server.pooled)
+                monitor.up = True
+                coordinator.resultUp(monitor)
+            # Suppressed after the second flap
+            self.assertFalse(server.pooled)
+            stats = coordinator.getChangeStats()
+            self.assertEquals(stats['suppressed'], ['server0'])
+            self.assertEquals(stats['penalties']['server0'], 2000)
+            clock.advance(90)
+            self.assertTrue(server.pooled)
+            self.assertEquals(coordinator.getChangeStats()['suppressed'], [])
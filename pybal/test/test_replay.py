@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.replay`.
+
+"""
+from twisted.internet import reactor
+
+import pybal.pybal
+from pybal.journal import Journal
+from pybal.replay import Replay, FakeIPVSManager
+
+from .fixtures import PyBalTestCase
+
+
+class ReplayTestCase(PyBalTestCase):
+    """Test case for `pybal.replay.Replay`."""
+
+    def testFeed(self):
+        """Journal records are replayed through Coordinator and LVSService."""
+        hosts = dict(('mw%d' % i, {'enabled': True, 'weight': 10})
+                     for i in range(4))
+        records = [
+            (0, Journal.SERVICE, [u'test', [u'tcp', u'10.0.0.1', 80, u'rr'],
+                                  {u'monitors': u"['ProxyFetch']"}]),
+            (1, Journal.CONFIG, [u'test', hosts, [], {}]),
+            (2, Journal.RESULT, [u'test', u'mw0', u'ProxyFetch', False, u'timeout']),
+            (3, Journal.RESULT, [u'test', u'mw1', u'ProxyFetch', True, None]),
+            (4, Journal.CONFIG, [u'test', {}, [u'mw3'], {u'mw2': {u'weight': 5}}]),
+            (5, Journal.RESULT, [u'test', u'unknown', u'ProxyFetch', False, None]),
+        ]
+        replay = Replay()
+        replay.feed(records)
+
+        crd = replay.coordinators['test']
+        self.assertEquals(sorted(crd.servers), ['mw0', 'mw1', 'mw2'])
+        self.assertEquals(crd.upServers, 2)
+        self.assertEquals(crd.pooledServers, 2)
+        self.assertEquals(crd.servers['mw2'].weight, 5)
+        self.assertEquals(FakeIPVSManager.commands[-1],
+                          ['-e -t 10.0.0.1:80 -r mw2 -w 5 -g',
+                           '-d -t 10.0.0.1:80 -r mw3'])
+        self.assertEquals(replay.counts[Journal.RESULT], 3)
+
+    def testChangeRate(self):
+        """Rate limited changes are made at their recorded time."""
+        hosts = dict(('mw%d' % i, {'enabled': True, 'weight': 10})
+                     for i in range(4))
+        records = [
+            (100, Journal.SERVICE, [u'test', [u'tcp', u'10.0.0.1', 80, u'rr'],
+                                    {u'monitors': u"['ProxyFetch']",
+                                     u'change-rate': u'0.5', u'change-burst': u'1'}]),
+            (100, Journal.CONFIG, [u'test', hosts, [], {}]),
+            (101, Journal.RESULT, [u'test', u'mw0', u'ProxyFetch', False, u'timeout']),
+            (101, Journal.RESULT, [u'test', u'mw1', u'ProxyFetch', False, u'timeout']),
+        ]
+        replay = Replay()
+        replay.feed(records)
+        self.assertIs(pybal.pybal.reactor, reactor)
+        crd = replay.coordinators['test']
+        self.assertEquals(crd.pendingServers, set([crd.servers['mw1']]))
+
+        # The depool of mw1 happens once the journal gets there
+        replay.feed([(104, Journal.RESULT, [u'test', u'mw2', u'ProxyFetch', True, None])])
+        self.assertFalse(crd.pendingServers)
+        self.assertFalse(crd.servers['mw1'].pooled)
+        self.assertEquals(FakeIPVSManager.commands[-1], ['-d -t 10.0.0.1:80 -r mw1'])
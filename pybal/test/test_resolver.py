@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.resolver`.
+
+"""
+import socket
+
+import mock
+from twisted.internet import defer
+from twisted.names import dns, error
+
+from pybal.resolver import HostnameCache
+
+from .fixtures import PyBalTestCase
+
+
+def answer(hostname, addresses, ttl=300, recordType=dns.A):
+    record = {dns.A: dns.Record_A, dns.AAAA: dns.Record_AAAA}[recordType]
+    return ([dns.RRHeader(hostname, recordType, ttl=ttl,
+                          payload=record(address, ttl))
+             for address in addresses], [], [])
+
+
+class HostnameCacheTestCase(PyBalTestCase):
+    """Test case for `pybal.resolver.HostnameCache`."""
+
+    def setUp(self):
+        super(HostnameCacheTestCase, self).setUp()
+        self.resolver = mock.Mock()
+        self.queries = []
+
+        def lookup(hostname, timeout):
+            d = defer.Deferred()
+            self.queries.append((hostname, d))
+            return d
+
+        self.resolver.lookupAddress.side_effect = lookup
+        self.resolver.lookupIPV6Address.side_effect = lookup
+        self.patch(HostnameCache, 'pending', {})
+        HostnameCache.configure(concurrency=2, resolver=self.resolver)
+        self.addCleanup(HostnameCache.configure)
+
+    def testLookup(self):
+        """Answers are cached for their TTL."""
+        results = []
+        HostnameCache.lookup('a.example', socket.AF_INET, now=0
+            ).addCallback(results.append)
+        self.queries[0][1].callback(answer('a.example', ['10.0.0.1', '10.0.0.2']))
+        self.assertEquals(results, [(frozenset(['10.0.0.1', '10.0.0.2']), 300)])
+        HostnameCache.lookup('a.example', socket.AF_INET, now=100
+            ).addCallback(results.append)
+        self.assertEquals(results[1], (frozenset(['10.0.0.1', '10.0.0.2']), 200))
+        self.assertEquals(len(self.queries), 1)
+        # Expired
+        HostnameCache.lookup('a.example', socket.AF_INET, now=300)
+        self.assertEquals(len(self.queries), 2)
+
+    def testAddressFamily(self):
+        """Only the requested address family is queried."""
+        results = []
+        HostnameCache.lookup('a.example', socket.AF_INET6, now=0
+            ).addCallback(results.append)
+        self.assertFalse(self.resolver.lookupAddress.called)
+        self.queries[0][1].callback(
+            answer('a.example', ['2001:db8::1'], recordType=dns.AAAA))
+        self.assertEquals(results, [(frozenset(['2001:db8::1']), 300)])
+
+    def testNegativeCaching(self):
+        """NXDOMAIN answers are cached for the negative TTL."""
+        results = []
+        HostnameCache.lookup('a.example', socket.AF_INET, now=0
+            ).addCallback(results.append)
+        self.queries[0][1].errback(error.DNSNameError())
+        self.assertEquals(results, [(frozenset(), HostnameCache.NEGATIVE_TTL)])
+        HostnameCache.lookup('a.example', socket.AF_INET, now=1)
+        self.assertEquals(len(self.queries), 1)
+
+    def testTransientError(self):
+        """Timeouts are passed on and not cached."""
+        d = HostnameCache.lookup('a.example', socket.AF_INET, now=0)
+        self.queries[0][1].errback(error.DNSQueryTimeoutError(None))
+        self.failureResultOf(d, error.DNSQueryTimeoutError)
+        HostnameCache.lookup('a.example', socket.AF_INET, now=1)
+        self.assertEquals(len(self.queries), 2)
+
+    def testConcurrency(self):
+        """Lookups of the same name are merged, and concurrency is bounded."""
+        results = []
+        for i in range(3):
+            HostnameCache.lookup('a.example', socket.AF_INET, now=0
+                ).addCallback(results.append)
+        HostnameCache.lookup('b.example', socket.AF_INET, now=0)
+        HostnameCache.lookup('c.example', socket.AF_INET, now=0)
+        self.assertEquals([q[0] for q in self.queries], ['a.example', 'b.example'])
+        self.queries[0][1].callback(answer('a.example', ['10.0.0.1']))
+        self.assertEquals(len(results), 3)
+        self.assertEquals([q[0] for q in self.queries],
+                          ['a.example', 'b.example', 'c.example'])
+        self.assertEquals(HostnameCache.getStats(),
+                          {'entries': 1, 'pending': 2, 'queries': 3, 'hits': 0})
+
+    def testConfigureInFlight(self):
+        """Lookups in flight complete after the cache is reconfigured."""
+        results = []
+        HostnameCache.lookup('a.example', socket.AF_INET, now=0
+            ).addCallback(results.append)
+        HostnameCache.configure(concurrency=4, resolver=self.resolver)
+        HostnameCache.lookup('a.example', socket.AF_INET, now=0
+            ).addCallback(results.append)
+        self.assertEquals(len(self.queries), 1)
+        self.queries[0][1].callback(answer('a.example', ['10.0.0.1']))
+        self.assertEquals(results, [(frozenset(['10.0.0.1']), 300)] * 2)
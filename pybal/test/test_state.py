@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.state`.
+
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+
+from pybal.state import StateFile
+
+from .fixtures import PyBalTestCase
+
+
+class StateFileTestCase(PyBalTestCase):
+    """Test case for `pybal.state.StateFile`."""
+
+    def setUp(self):
+        super(StateFileTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'state.json')
+        self.stateFile = StateFile(self.path)
+        self.coordinator.lvsservice = self.lvsservice
+        self.coordinator.snapshotState = mock.Mock(return_value={
+            'mw1001': {'up': False, 'pooled': True, 'enabled': True,
+                       'weight': 10, 'monitors': {'ProxyFetch': {'up': False}}}
+        })
+        self.stateFile.addCoordinator(self.coordinator)
+
+    def testSaveLoad(self):
+        """Saved snapshots load back."""
+        self.stateFile.save()
+        self.assertEquals(os.listdir(self.directory), ['state.json'])
+        services = StateFile.load(self.path)
+        self.assertEquals(services, {
+            'test': self.coordinator.snapshotState.return_value})
+
+    def testLoadMissing(self):
+        """A missing file means no saved state."""
+        self.assertEquals(StateFile.load(self.path), {})
+
+    def testLoadInvalid(self):
+        """Invalid or outdated files are ignored."""
+        with open(self.path, 'w') as f:
+            f.write('{"version": 1, "timest')
+        self.assertEquals(StateFile.load(self.path), {})
+
+        with open(self.path, 'w') as f:
+            json.dump({'version': 0, 'timestamp': 0, 'services': {}}, f)
+        self.assertEquals(StateFile.load(self.path), {})
+
+        self.stateFile.save()
+        self.assertEquals(StateFile.load(self.path, maxAge=60,
+                                         now=self.stateFile.dump()['timestamp'] + 61),
+                          {})
@@ -78,6 +78,111 @@ class ConfigDictTestCase(PyBalTestCase):
         with self.assertRaises(ValueError):
             self.config.getboolean('float')
 
+    def testGetParsed(self):
+        """Test `ConfigDict.getparsed()`."""
+        parser = mock.MagicMock(side_effect=int)
+        self.assertEqual(self.config.getparsed('int', parser), 3)
+        self.assertEqual(self.config.getparsed('int', parser), 3)
+        self.assertEqual(parser.call_count, 1)
+        self.assertEqual(self.config.getparsed('missing', parser, 4), 4)
+        with self.assertRaises(KeyError):
+            self.config.getparsed('missing', parser)
+        # Modifications invalidate the cache
+        self.config['int'] = '5'
+        self.assertEqual(self.config.getparsed('int', parser), 5)
+        self.config.update({'int': '6'})
+        self.assertEqual(self.config.getparsed('int', parser), 6)
+        self.assertEqual(parser.call_count, 3)
+
+
+class AtomicWriteTestCase(PyBalTestCase):
+    """Test case for `pybal.util.atomicWrite`."""
+
+    def testAtomicWrite(self):
+        """Test `util.atomicWrite`."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        path = os.path.join(directory, 'test')
+        self.addCleanup(os.unlink, path)
+        pybal.util.atomicWrite(path, 'one')
+        pybal.util.atomicWrite(path, 'two')
+        with open(path) as f:
+            self.assertEquals(f.read(), 'two')
+        # No temporary files are left behind
+        self.assertEquals(os.listdir(directory), ['test'])
+
+
+class TokenBucketTestCase(PyBalTestCase):
+    """Test case for `pybal.util.TokenBucket`."""
+
+    def testConsume(self):
+        """Test `TokenBucket.consume()`."""
+        bucket = pybal.util.TokenBucket(2, 4, now=0)
+        for i in range(4):
+            self.assertEqual(bucket.consume(0), 0)
+        self.assertEqual(bucket.consume(0), 0.5)
+        # Refills at the configured rate, up to the burst size
+        self.assertEqual(bucket.consume(0.5), 0)
+        bucket.refill(100)
+        self.assertEqual(bucket.tokens, 4)
+
+    def testConsumeReserve(self):
+        """`TokenBucket.consume()` leaves the reserve alone."""
+        bucket = pybal.util.TokenBucket(1, 4, now=0)
+        self.assertEqual(bucket.consume(0, reserve=2), 0)
+        self.assertEqual(bucket.consume(0, reserve=2), 0)
+        self.assertEqual(bucket.consume(0, reserve=2), 1)
+        self.assertEqual(bucket.consume(0), 0)
+
+    def testConsumeForce(self):
+        """Forced consumption goes into bounded debt."""
+        bucket = pybal.util.TokenBucket(1, 2, now=0)
+        for i in range(10):
+            self.assertEqual(bucket.consume(0, force=True), 0)
+        self.assertEqual(bucket.tokens, -2)
+
+
+class BackoffTestCase(PyBalTestCase):
+    """Test case for `pybal.util.Backoff`."""
+
+    def testNextDelay(self):
+        """Delays grow exponentially up to the maximum, with jitter."""
+        backoff = pybal.util.Backoff(1, 10)
+        with mock.patch('random.random', return_value=0):
+            self.assertEqual([backoff.nextDelay() for i in range(6)],
+                             [1, 2, 4, 8, 10, 10])
+        with mock.patch('random.random', return_value=1):
+            self.assertEqual(backoff.nextDelay(), 5)
+        backoff.reset()
+        with mock.patch('random.random', return_value=0):
+            self.assertEqual(backoff.nextDelay(), 1)
+
+
+class DampenerTestCase(PyBalTestCase):
+    """Test case for `pybal.util.Dampener`."""
+
+    def testFlap(self):
+        """Flaps beyond the suppress threshold suppress until reuse."""
+        dampener = pybal.util.Dampener(60, now=0)
+        self.assertFalse(dampener.flap(0))
+        self.assertFalse(dampener.isSuppressed(0))
+        self.assertTrue(dampener.flap(0))
+        self.assertTrue(dampener.isSuppressed(0))
+        # 2000 decays to 750 in log2(2000/750) half-lives
+        delay = dampener.reuseDelay(0)
+        self.assertAlmostEqual(delay, 60 * 1.415, places=1)
+        self.assertTrue(dampener.isSuppressed(delay - 1))
+        self.assertFalse(dampener.isSuppressed(delay + 1))
+        self.assertEqual(dampener.reuseDelay(delay + 1), 0)
+
+    def testMaxSuppress(self):
+        """Suppression lasts at most maxSuppress after the last flap."""
+        dampener = pybal.util.Dampener(60, maxSuppress=120, now=0)
+        for i in range(100):
+            dampener.flap(0)
+        self.assertAlmostEqual(dampener.reuseDelay(0), 120)
+        self.assertFalse(dampener.isSuppressed(121))
+
 
 class DummyObserver(object):
 
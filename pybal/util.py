@@ -4,7 +4,11 @@ Copyright (C) 2006-2008 by Mark Bergsma <mark@nedworks.org>
 
 LVS Squid balancer/monitor for managing the Wikimedia Squid servers using LVS
 """
+import math
+import os
+import random
 import sys
+import tempfile
 from twisted.python import log as tw_log
 from twisted.python import util
 import logging
@@ -20,7 +24,80 @@ def get_subclasses(cls):
     return subclasses
 
 
+def atomicWrite(path, data):
+    """Write data to a file such that readers, and the file after a crash,
+    see either the old or the new contents in full."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmpPath = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                   dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpPath, path)
+    except:
+        os.unlink(tmpPath)
+        raise
+    # Persist the rename itself
+    dirfd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
 class ConfigDict(dict):
+    """Dictionary of configuration options with typed accessors.
+
+    Values derived through getparsed() are cached until the dictionary
+    is modified.
+    """
+
+    def __setitem__(self, key, value):
+        self.__dict__.pop('_parsed', None)
+        super(ConfigDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.__dict__.pop('_parsed', None)
+        super(ConfigDict, self).__delitem__(key)
+
+    def clear(self):
+        self.__dict__.pop('_parsed', None)
+        super(ConfigDict, self).clear()
+
+    def pop(self, *args):
+        self.__dict__.pop('_parsed', None)
+        return super(ConfigDict, self).pop(*args)
+
+    def popitem(self):
+        self.__dict__.pop('_parsed', None)
+        return super(ConfigDict, self).popitem()
+
+    def setdefault(self, key, default=None):
+        self.__dict__.pop('_parsed', None)
+        return super(ConfigDict, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.__dict__.pop('_parsed', None)
+        super(ConfigDict, self).update(*args, **kwargs)
+
+    def getparsed(self, key, parser, default=None):
+        """Returns parser(self[key]), parsing every key only once."""
+        cache = self.__dict__.setdefault('_parsed', {})
+        try:
+            return cache[key, parser]
+        except KeyError:
+            pass
+        try:
+            value = self[key]
+        except KeyError:
+            if default is not None:
+                return default
+            else:
+                raise
+        result = cache[key, parser] = parser(value)
+        return result
 
     def getint(self, key, default=None):
         try:
@@ -41,15 +118,19 @@ class ConfigDict(dict):
             else:
                 raise
         else:
-            if value in (True, False):
-                return value
-            value = value.strip().lower()
-            if value in ('t', 'true', 'y', 'yes', 'on', '1'):
-                return True
-            elif value in ('f', 'false', 'n', 'no', 'off', '0'):
-                return False
-            else:
-                raise ValueError
+            return self.parseBoolean(value)
+
+    @staticmethod
+    def parseBoolean(value):
+        if value in (True, False):
+            return value
+        value = value.strip().lower()
+        if value in ('t', 'true', 'y', 'yes', 'on', '1'):
+            return True
+        elif value in ('f', 'false', 'n', 'no', 'off', '0'):
+            return False
+        else:
+            raise ValueError
 
     def getfloat(self, key, default=None):
         try:
@@ -62,6 +143,120 @@ class ConfigDict(dict):
         # do not intercept ValueError
 
 
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    Holds up to `burst` tokens, refilled at `rate` tokens per second.
+    Times are passed in explicitly, typically from reactor.seconds().
+    """
+
+    def __init__(self, rate, burst=None, now=0):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = now
+
+    def refill(self, now):
+        """Adds the tokens accumulated since the last update."""
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now, reserve=0, force=False):
+        """Takes a token if that leaves at least `reserve` tokens in the
+        bucket, or unconditionally if `force` is set, in which case the
+        bucket may go into debt of up to `burst` tokens.
+
+        Returns 0 if a token was taken, or else the number of seconds
+        until one can be.
+        """
+        self.refill(now)
+        if self.tokens - 1 >= reserve or force:
+            self.tokens = max(self.tokens - 1, -self.burst)
+            return 0
+        return (reserve + 1 - self.tokens) / self.rate
+
+
+class Backoff(object):
+    """Exponential backoff with jitter.
+
+    Delays start at `initial` seconds and grow by `factor` with every
+    consecutive failure, up to `maximum`. Each delay is shortened by a
+    random fraction of up to `jitter`, so that clients recovering from the
+    same outage don't retry in lockstep.
+    """
+
+    def __init__(self, initial, maximum, factor=2, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.failures = 0
+
+    def nextDelay(self):
+        """Records a failure, and returns the number of seconds to wait."""
+        delay = min(self.initial * self.factor ** self.failures, self.maximum)
+        if delay < self.maximum:
+            self.failures += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        """Records a success."""
+        self.failures = 0
+
+
+class Dampener(object):
+    """Flap dampening, as in BGP route flap dampening (RFC 2439).
+
+    Every flap adds `penalty` to a figure of merit that decays
+    exponentially with the given half-life. Once it exceeds `suppress`,
+    the subject is suppressed until it has decayed below `reuse` again.
+    The figure of merit is capped such that suppression lasts at most
+    `maxSuppress` seconds after the last flap.
+    """
+
+    def __init__(self, halfLife, penalty=1000, suppress=2000, reuse=750,
+                 maxSuppress=None, now=0):
+        self.halfLife = float(halfLife)
+        self.penalty = penalty
+        self.suppress = suppress
+        self.reuse = reuse
+        maxSuppress = maxSuppress or 4 * self.halfLife
+        self.maxPenalty = reuse * 2 ** (maxSuppress / self.halfLife)
+        self.value = 0.0
+        self.updated = now
+        self.suppressed = False
+
+    def decay(self, now):
+        """Decays the figure of merit up to now."""
+        if now > self.updated:
+            self.value *= 0.5 ** ((now - self.updated) / self.halfLife)
+            self.updated = now
+        if self.suppressed and self.value < self.reuse:
+            self.suppressed = False
+
+    def flap(self, now):
+        """Adds the penalty of a flap. Returns whether this started a
+        suppression."""
+        self.decay(now)
+        self.value = min(self.value + self.penalty, self.maxPenalty)
+        if not self.suppressed and self.value >= self.suppress:
+            self.suppressed = True
+            return True
+        return False
+
+    def isSuppressed(self, now):
+        self.decay(now)
+        return self.suppressed
+
+    def reuseDelay(self, now):
+        """Returns the number of seconds until suppression ends."""
+        self.decay(now)
+        if not self.suppressed:
+            return 0
+        return self.halfLife * math.log(self.value / self.reuse, 2)
+
+
 class PyBalLogObserver(tw_log.FileLogObserver):
     """Simple log observer derived from FileLogObserver"""
     level = logging.INFO